@@ -0,0 +1,117 @@
+'''
+Benchmarks the assembly of the station covariance matrix and basis
+vectors in *pygeons.main.gptools.station_sigma_and_p* against the
+previous implementation, which looped over the stations. The time
+series are daily and span ten years for 200 stations, and 10% of the
+data are missing.
+'''
+import time
+import numpy as np
+import scipy.sparse as sp
+from pygeons.main import gpstation
+from pygeons.main.gptools import (composite,
+                                  station_sigma_and_p)
+
+np.random.seed(1)
+
+Nt = 3650
+Nx = 200
+missing = 0.1
+station_model = ['spwen12','linear']
+station_params = [1.0,0.1]
+
+
+def station_sigma_and_p_loop(gp,time,mask):
+  '''
+  Previous implementation of *station_sigma_and_p*
+  '''
+  diff = np.array([0])
+  sigma_i = gp._covariance(time,time,diff,diff)
+  p_i = gp._basis(time,diff)
+  Nt,Np = p_i.shape
+  _,Nx = mask.shape
+  Nu = np.sum(~mask)
+  if sp.issparse(sigma_i):
+    sigma_i = sigma_i.tocoo()
+    data_i = sigma_i.data
+    rows_i = sigma_i.row
+    cols_i = sigma_i.col
+
+  else:
+    data_i = sigma_i.ravel()
+    rows_i,cols_i = np.mgrid[:Nt,:Nt].astype(np.int32)
+    rows_i = rows_i.ravel()
+    cols_i = cols_i.ravel()
+
+  p_data_i = p_i.ravel()
+  p_rows_i,p_cols_i = np.mgrid[:Nt,:Np].astype(np.int32)
+  p_rows_i = p_rows_i.ravel()
+  p_cols_i = p_cols_i.ravel()
+  data,rows,cols = [],[],[]
+  p_data,p_rows,p_cols = [],[],[]
+  for i in range(Nx):
+    mask_i = mask[rows_i,i] | mask[cols_i,i]
+    data += [data_i[~mask_i]]
+    rows += [i + rows_i[~mask_i]*Nx]
+    cols += [i + cols_i[~mask_i]*Nx]
+    mask_i = mask[p_rows_i,i]
+    p_data += [p_data_i[~mask_i]]
+    p_rows += [i + p_rows_i[~mask_i]*Nx]
+    p_cols += [i*Np + p_cols_i[~mask_i]]
+
+  data = np.hstack(data)
+  rows = np.hstack(rows)
+  cols = np.hstack(cols)
+  p_data = np.hstack(p_data)
+  p_rows = np.hstack(p_rows)
+  p_cols = np.hstack(p_cols)
+  idx_map = np.cumsum(~mask.ravel()) - 1
+  rows = idx_map[rows]
+  cols = idx_map[cols]
+  p_rows = idx_map[p_rows]
+  if data.size > 0.5*Nu**2:
+    sigma = np.zeros((Nu,Nu))
+    sigma[rows,cols] = data
+
+  else:
+    sigma = sp.csc_matrix((data,(rows,cols)),(Nu,Nu),dtype=float)
+
+  p = np.zeros((Nu,Nx*Np))
+  p[p_rows,p_cols] = p_data
+  if p.size != 0:
+    u,s,_ = np.linalg.svd(p,full_matrices=False)
+    keep = s > 1e-12*s.max()
+    p = u[:,keep]
+
+  return sigma,p
+
+
+t = 51544.0 + np.arange(Nt)[:,None]
+mask = np.random.random((Nt,Nx)) < missing
+gp = composite(station_model,station_params,gpstation.CONSTRUCTORS)
+
+start = time.time()
+sigma1,p1 = station_sigma_and_p_loop(gp,t,mask)
+time1 = time.time() - start
+
+start = time.time()
+sigma2,p2 = station_sigma_and_p(gp,t,mask)
+time2 = time.time() - start
+
+print('number of unmasked data : %s' % np.sum(~mask))
+print('loop over stations      : %.2f s' % time1)
+print('vectorized              : %.2f s' % time2)
+diff = sigma1 - sigma2
+if sp.issparse(diff):
+  diff = diff.data
+
+if diff.size == 0:
+  diff = np.zeros(1)
+
+print('max covariance difference : %.3e' % np.max(np.abs(diff)))
+# the basis vectors are only unique up to a rotation, so compare the
+# projections onto them
+x = np.random.normal(0.0,1.0,p1.shape[0])
+proj1 = p1.dot(p1.T.dot(x))
+proj2 = p2.dot(p2.T.dot(x))
+print('max projection difference : %.3e' % np.max(np.abs(proj1 - proj2)))
@@ -2,4 +2,4 @@ from pygeons.glossary import GLOSSARY
 from pygeons.io.io import pygeons_toh5,pygeons_totext,pygeons_info,pygeons_crop,pygeons_merge
 from pygeons.plot.plot import pygeons_vector_view,pygeons_strain_view
 from pygeons.clean.clean import pygeons_clean
-from pygeons.main.main import pygeons_strain,pygeons_reml,pygeons_autoclean,pygeons_fit
+from pygeons.main.main import pygeons_strain,pygeons_reml,pygeons_autoclean,pygeons_fit,pygeons_prescreen
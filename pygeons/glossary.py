@@ -610,6 +610,176 @@ algorithm more sensitive. This should not be any lower than about 2.0.
 '''
 }
 #####################################################################
+OUTLIER_METHOD = {
+'type':str,
+'metavar':'STR',
+'choices':['refit','loo'],
+'help':
+''' 
+Method for detecting outliers. If this is "refit" then the Gaussian
+process is fit to the data again after each pass of outlier
+detection. If this is "loo" then outliers are detected from
+leave-one-out residuals, which only requires factoring the covariance
+matrix once and is much faster for large datasets. Defaults to
+"refit".
+'''
+}
+#####################################################################
+SPATIAL_TILES = {
+'type':int,
+'metavar':'INT',
+'help':
+''' 
+If this is given then the stations are split into this many clusters
+with k-means, and outliers are detected for each cluster
+independently. Each cluster is padded with the stations within two
+length scales of the network model, so that the edges of the clusters
+are constrained from both sides. The outliers found for the padding
+stations are ignored. The clusters are distributed between the worker
+processes.
+'''
+}
+#####################################################################
+TIME_WINDOW = {
+'type':float,
+'metavar':'FLOAT',
+'help':
+''' 
+If this is given then the observation times are split into windows
+that are this many days long, and outliers are detected for each
+window independently. Each window is padded with the observations
+within two time scales of the network model. This can be combined
+with *spatial-tiles*.
+'''
+}
+#####################################################################
+PRESCREEN_WINDOW = {
+'type':float,
+'metavar':'FLOAT',
+'help':
+''' 
+Length of the rolling window, in days, used to detect gross outliers.
+Each observation is compared to the median of the observations in the
+window centered on it. For *pygeons autoclean*, the gross outliers are
+only removed before the data editing algorithm if this is given.
+Defaults to 30.0 for *pygeons prescreen*.
+'''
+}
+#####################################################################
+PRESCREEN_TOL = {
+'type':float,
+'metavar':'FLOAT',
+'help':
+''' 
+Tolerance for gross outlier detection. An observation is a gross
+outlier if its difference from the rolling median exceeds this many
+robust standard deviations, which are estimated from the median
+absolute deviation in the window. This should be large enough that
+only blunders are removed. Defaults to 10.0.
+'''
+}
+#####################################################################
+STARTS_FILE = {
+'type':str,
+'metavar':'STR',
+'help':
+''' 
+Name of a text file containing starting points for the REML
+optimization. Each row contains the network hyperparameters followed
+by the station hyperparameters. The hyperparameters are optimized
+starting from each row, and the results are written to an HDF5 file.
+'''
+}
+#####################################################################
+GRID_SIZE = {
+'type':int,
+'metavar':'INT',
+'help':
+''' 
+Number of log-spaced values for each free hyperparameter in a grid
+search. The likelihood is evaluated at each point on the grid and
+written to an HDF5 file. The hyperparameters are then optimized
+starting from the best point on the grid.
+'''
+}
+#####################################################################
+GRID_WIDTH = {
+'type':float,
+'metavar':'FLOAT',
+'help':
+''' 
+Number of orders of magnitude spanned by the grid for each free
+hyperparameter. The grid is centered on the initial guess. Defaults
+to 2.0.
+'''
+}
+#####################################################################
+WARM_START = {
+'type':str,
+'metavar':'STR',
+'help':
+''' 
+Name of a JSON file of REML results from a previous run. The
+hyperparameters for each direction are initialized with the previous
+optimal values, and the optimizer is initialized with its final state
+from the previous run, so that it converges in fewer iterations. The
+Gaussian process models must be the same as in the previous run.
+'''
+}
+#####################################################################
+VECCHIA_NEIGHBORS = {
+'type':int,
+'metavar':'INT',
+'help':
+''' 
+If this is given then the likelihood is approximated with Vecchia's
+approximation, where each observation is conditioned on this many of
+its nearest neighbors in space and time. The cost of each likelihood
+evaluation then scales linearly with the number of observations,
+which makes REML feasible for large networks. Larger values give more
+accurate approximations. Values of about 10 to 30 are typical.
+'''
+}
+#####################################################################
+POSTERIOR_PROBES = {
+'type':int,
+'metavar':'INT',
+'help':
+''' 
+If this is given then the posterior standard deviations are estimated
+with this many random probe vectors rather than computed exactly.
+This is much faster for large networks. The relative error of the
+estimates decreases with the square root of the number of probe
+vectors, and a summary of the errors is logged. Values of about 30 to
+100 are typical.
+'''
+}
+#####################################################################
+POSTERIOR_SEED = {
+'type':int,
+'metavar':'INT',
+'help':
+''' 
+Seed for the random number generator which generates the probe vectors
+used with *--posterior-probes*. The estimates are reproducible for a
+given seed. Defaults to 0.
+'''
+}
+#####################################################################
+WORKERS = {
+'type':int, 
+'metavar':'INT', 
+'help': 
+''' 
+Number of worker processes used to process the east, north, and
+vertical components in parallel. When REML is given a starts file or
+a grid size, the points on the likelihood surface are also
+distributed between the worker processes. The BLAS threads are
+divided between the worker processes. If this is 0 then the
+components are processed serially. Defaults to 0.
+'''
+}
+#####################################################################
 
 GLOSSARY = {
 'input_text_file':INPUT_TEXT_FILE,
@@ -674,4 +844,17 @@ GLOSSARY = {
 'network_fix':NETWORK_FIX,
 'station_fix':STATION_FIX,
 'outlier_tol':OUTLIER_TOL,
+'outlier_method':OUTLIER_METHOD,
+'spatial_tiles':SPATIAL_TILES,
+'time_window':TIME_WINDOW,
+'prescreen_window':PRESCREEN_WINDOW,
+'prescreen_tol':PRESCREEN_TOL,
+'starts_file':STARTS_FILE,
+'grid_size':GRID_SIZE,
+'grid_width':GRID_WIDTH,
+'warm_start':WARM_START,
+'vecchia_neighbors':VECCHIA_NEIGHBORS,
+'posterior_probes':POSTERIOR_PROBES,
+'posterior_seed':POSTERIOR_SEED,
+'workers':WORKERS,
 }
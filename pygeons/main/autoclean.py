@@ -2,26 +2,231 @@
 Contains a data editing algorithm.
 '''
 import numpy as np
+import scipy.sparse as sp
 import logging
 from pygeons.main import gpnetwork
 from pygeons.main import gpstation
 from pygeons.main.gptools import (composite,
                                   station_sigma_and_p)  
+from pygeons.main.factor import (FactorizationContext,
+                                 PartitionedSolver,
+                                 SparseFactor)
 from rbf.gauss import (_as_sparse_or_array,
-                       outliers)
+                       _as_covariance)
 logger = logging.getLogger(__name__)
 
 
+def _restrict(A,keep):
+  ''' 
+  Returns a copy of the covariance matrix *A* where the rows and
+  columns for the data which are not in *keep* are replaced with the
+  rows and columns of the identity matrix. Solving a system with this
+  matrix is equivalent to solving the system for the data in *keep*,
+  provided that the right-hand side is zero for the other data. If
+  *A* is sparse then the sparsity pattern is unchanged, so that its
+  symbolic factorization can be reused.
+  '''
+  if sp.issparse(A):
+    A = sp.csc_matrix(A,copy=True)
+    A.sum_duplicates()
+    rows = A.indices
+    cols = np.repeat(np.arange(A.shape[1]),np.diff(A.indptr))
+    # explicitly store zeros rather than removing the entries
+    A.data[~(keep[rows] & keep[cols])] = 0.0
+    A.data[(rows == cols) & ~keep[rows]] = 1.0
+
+  else:
+    A = np.array(A,copy=True)
+    A[~keep,:] = 0.0
+    A[:,~keep] = 0.0
+    A[~keep,~keep] = 1.0
+
+  return A
+
+
+def _outliers(d,s,mu,sigma,p,tol,factorization,maxitr=50):
+  ''' 
+  Returns the indices of outliers in *d*, which has uncertainties *s*,
+  for the Gaussian process described by *mu*, *sigma*, and *p*. This
+  is the same algorithm as *rbf.gauss.outliers*. The Gaussian process
+  is fit to the data that are not outliers, and data whose residuals
+  exceed *tol* times the RMS of the normalized residuals are
+  identified as outliers. This is repeated until the outliers do not
+  change.
+
+  The outliers are excluded by replacing their rows and columns in
+  the covariance matrix rather than removing them, so that every
+  iteration factors a matrix with the same sparsity pattern with the
+  *FactorizationContext*, *factorization*.
+  '''
+  n,m = p.shape
+  A = _as_sparse_or_array(sigma + _as_covariance(s))
+  out = np.zeros(n,dtype=bool)
+  itr = 0
+  while True:
+    logger.debug('Starting iteration %s of outlier detection routine'
+                 % (itr+1))
+    keep = ~out
+    Ai = _restrict(A,keep)
+    pi = sp.diags(keep.astype(float)).dot(p)
+    di = (d - mu)*keep
+    Ksolver = PartitionedSolver(factorization.factor(Ai),pi)
+    vec1,vec2 = Ksolver.solve(di,np.zeros(m))
+    del Ai,pi,di,Ksolver
+    # *vec1* is zero for the outliers
+    fit = mu + sigma.dot(vec1) + p.dot(vec2)
+    res = np.abs(fit - d)/s
+    rms = np.sqrt(np.mean(res[keep]**2))
+    new_out = res > tol*rms
+    if np.all(out == new_out):
+      break
+
+    out = new_out
+    itr += 1
+    if itr == maxitr:
+      logger.warning('Reached the maximum number of iterations')
+      break
+
+  logger.debug('Detected %s outliers out of %s observations' %
+               (np.sum(out),n))
+  return np.nonzero(out)[0]
+
+
+def _exclusion_vectors(A,idx,keep):
+  ''' 
+  Returns sparse matrices *U* and *D* such that 
+
+    _restrict(A,keep) + U.dot(U.T) - D.dot(D.T)
+
+  is _restrict(A,keep) with the data in *idx* also excluded. *idx*
+  must be in *keep*. Excluding one datum replaces its row and column
+  with the row and column of the identity matrix, which is a rank 2
+  modification. If *w* is the column for the datum without its
+  diagonal and *e* is the corresponding column of the identity
+  matrix, then the modification is
+
+    (w - e).dot((w - e).T)/2 - (w + e).dot((w + e).T)/2 + (1 - a)*e.dot(e.T)
+
+  where *a* is the diagonal.
+  '''
+  A = sp.csc_matrix(A)
+  n = A.shape[0]
+  keep = np.copy(keep)
+  U,D = [],[]
+  for i in idx:
+    keep[i] = False
+    w = A[:,i].multiply(keep[:,None])
+    e = sp.csc_matrix(([1.0],([i],[0])),shape=(n,1))
+    U += [(w - e)/np.sqrt(2.0)]
+    D += [(w + e)/np.sqrt(2.0)]
+    delta = 1.0 - A[i,i]
+    if delta > 0.0:
+      U += [np.sqrt(delta)*e]
+    elif delta < 0.0:
+      D += [np.sqrt(-delta)*e]
+
+  U = sp.hstack(U + [sp.csc_matrix((n,0))]).tocsc()
+  D = sp.hstack(D + [sp.csc_matrix((n,0))]).tocsc()
+  return U,D
+
+
+def _loo_outliers(d,s,mu,sigma,p,tol,factorization,maxitr=50):
+  ''' 
+  Returns the indices of outliers in *d*, which has uncertainties *s*,
+  for the Gaussian process described by *mu*, *sigma*, and *p*. This
+  uses leave-one-out (LOO) residuals, which are the residuals between
+  each datum and the posterior predicted from all the other data.
+  They have the closed form 
+
+    r_i = (M.dot(d - mu))_i/M_ii
+
+  where *M* is the upper left block of the inverse of the partitioned
+  covariance matrix, and the standard deviation of *r_i* is
+  1/sqrt(M_ii). Data whose standardized LOO residuals exceed *tol*
+  times the RMS of the standardized LOO residuals are identified as
+  outliers. The outliers are excluded and this is repeated until no
+  new outliers are found. Unlike *_outliers*, data that are identified
+  as outliers are never restored.
+
+  The covariance matrix is factored once with the
+  *FactorizationContext*, *factorization*. If the factorization is
+  sparse then the outliers are excluded with low rank updates and
+  downdates of the Cholesky factor rather than factoring the matrix
+  again.
+  '''
+  n,m = p.shape
+  A = _as_sparse_or_array(sigma + _as_covariance(s))
+  Afactor = factorization.factor(A)
+  if isinstance(Afactor,SparseFactor):
+    # do not modify the factorization stored in the context
+    Afactor = Afactor.copy()
+
+  out = np.zeros(n,dtype=bool)
+  itr = 0
+  while True:
+    logger.debug('Starting iteration %s of LOO outlier detection '
+                 'routine' % (itr+1))
+    keep = ~out
+    Ksolver = PartitionedSolver(Afactor,
+                                sp.diags(keep.astype(float)).dot(p))
+    Md,_ = Ksolver.solve((d - mu)*keep,np.zeros(m))
+    Mdiag = Ksolver.quad_diag()
+    del Ksolver
+    # standardized LOO residuals
+    res = np.zeros(n)
+    res[keep] = np.abs(Md[keep])/np.sqrt(Mdiag[keep])
+    rms = np.sqrt(np.mean(res[keep]**2))
+    new_idx = np.nonzero(res > tol*rms)[0]
+    if new_idx.size == 0:
+      break
+
+    if isinstance(Afactor,SparseFactor):
+      U,D = _exclusion_vectors(A,new_idx,keep)
+      # apply the updates before the downdates so that every
+      # intermediate matrix is positive definite
+      Afactor.update(U)
+      Afactor.update(D,subtract=True)
+      out[new_idx] = True
+
+    else:
+      out[new_idx] = True
+      Afactor = factorization.factor(_restrict(A,~out))
+
+    itr += 1
+    if itr == maxitr:
+      logger.warning('Reached the maximum number of iterations')
+      break
+
+  logger.debug('Detected %s outliers out of %s observations' %
+               (np.sum(out),n))
+  return np.nonzero(out)[0]
+
+
 def autoclean(t,x,d,sd,
               network_model,
               network_params,
               station_model,
               station_params,
-              tol):
+              tol,
+              factorization=None,
+              method='refit'):
   ''' 
   Returns a dataset that has been cleaned of outliers using a data
   editing algorithm.
+
+  *method* is either 'refit', which fits the Gaussian process to the
+  data again after each pass of outlier detection (see *_outliers*),
+  or 'loo', which identifies outliers from leave-one-out residuals
+  (see *_loo_outliers*). 'loo' only factors the covariance matrix
+  once.
+
+  *factorization* is a *FactorizationContext* used to factor the
+  sparse covariance matrix, which can be shared between calls so that
+  the sparsity pattern is only analyzed once.
   '''
+  if factorization is None:
+    factorization = FactorizationContext()
+
   t = np.asarray(t,dtype=float)
   x = np.asarray(x,dtype=float)
   de = np.array(d,dtype=float,copy=True)
@@ -49,12 +254,17 @@ def autoclean(t,x,d,sd,
   # combine station gp with the network gp
   mu = np.zeros(zu.shape[0])  
   sigma = _as_sparse_or_array(sta_sigma + net_sigma)
-  p = np.hstack((sta_p,net_p))
+  # keep the station basis vectors sparse
+  p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
   del sta_sigma,net_sigma,sta_p,net_p
   # returns the indices of outliers 
-  out_idx = outliers(du,sdu,
-                     mu=mu,sigma=sigma,p=p,
-                     tol=tol)
+  if method == 'refit':
+    out_idx = _outliers(du,sdu,mu,sigma,p,tol,factorization)
+  elif method == 'loo':
+    out_idx = _loo_outliers(du,sdu,mu,sigma,p,tol,factorization)
+  else:
+    raise ValueError('*method* must be "refit" or "loo"')
+
   # mask the outliers in *de* and *sde*
   r,c = np.nonzero(~mask)
   de[r[out_idx],c[out_idx]] = np.nan
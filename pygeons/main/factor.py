@@ -0,0 +1,414 @@
+''' 
+Module for factoring covariance matrices which are built repeatedly
+with the same sparsity pattern.
+
+A sparse Cholesky factorization with CHOLMOD has a symbolic phase,
+which finds a fill-reducing ordering and the sparsity pattern of the
+factor, and a numeric phase. The symbolic phase only depends on the
+sparsity pattern of the matrix, which does not change between the
+likelihood evaluations in *reml*, between the east, north and
+vertical components, or between the iterations of *autoclean*. A
+*FactorizationContext* keeps the symbolic factorization and only
+repeats the numeric phase for matrices with the same sparsity
+pattern.
+'''
+import numpy as np
+import scipy.sparse as sp
+import logging
+from scipy.linalg import (cho_factor,
+                          cho_solve,
+                          solve_triangular)
+logger = logging.getLogger(__name__)
+try:
+  from sksparse import cholmod
+  HAS_CHOLMOD = True
+except ImportError:
+  HAS_CHOLMOD = False
+  logger.debug('Could not import CHOLMOD. Sparse covariance matrices '
+               'will be factored as dense matrices')
+
+
+def _pattern_keys(L):
+  ''' 
+  Returns a sorted key for each non-zero of the CSC matrix *L*, which
+  has sorted indices. The key for the non-zero in row *i* and column
+  *j* is j*n + i, which can be used to find the location of any
+  non-zero with *np.searchsorted*.
+  '''
+  n = L.shape[0]
+  col = np.repeat(np.arange(n,dtype=np.int64),np.diff(L.indptr))
+  return col*n + L.indices
+
+
+def _takahashi(L):
+  ''' 
+  Returns the entries of inv(L.dot(L.T)) at the non-zeros of *L*,
+  where *L* is a lower triangular CSC matrix with sorted indices. The
+  entries are in the same order as *L.data*. This is a selected
+  inversion, which uses the Takahashi recurrences to compute the
+  entries of the inverse at the non-zeros of *L*. Those are the only
+  entries of the inverse needed by the recurrences.
+  '''
+  n = L.shape[0]
+  indptr,indices,data = L.indptr,L.indices,L.data
+  keys = _pattern_keys(L)
+  # entries of the inverse at the non-zeros of *L*
+  Z = np.zeros(data.shape[0])
+  for j in range(n-1,-1,-1):
+    start,stop = indptr[j],indptr[j+1]
+    # the first non-zero in each column is on the diagonal
+    ljj = data[start]
+    rows = indices[start+1:stop]
+    l = data[start+1:stop]
+    if rows.size == 0:
+      Z[start] = 1.0/ljj**2
+      continue
+
+    # gather the entries of the inverse for all pairs of *rows*. These
+    # are non-zeros of *L* because the sparsity pattern of a Cholesky
+    # factor is closed under this operation
+    a,b = np.triu_indices(rows.size)
+    Zrr = np.empty((rows.size,rows.size))
+    vals = Z[np.searchsorted(keys,rows[a]*np.int64(n) + rows[b])]
+    Zrr[a,b] = vals
+    Zrr[b,a] = vals
+    zr = -Zrr.dot(l)/ljj
+    Z[start+1:stop] = zr
+    Z[start] = (1.0/ljj - l.dot(zr))/ljj
+
+  return Z
+
+
+class DenseFactor(object):
+  ''' 
+  Cholesky factorization of a dense positive definite matrix
+  '''
+  def __init__(self,A):
+    self.factor = cho_factor(A,lower=True)
+    self._inverse = None
+
+  def solve(self,b):
+    ''' 
+    Returns inv(A).dot(b)
+    '''
+    if sp.issparse(b):
+      b = b.toarray()
+
+    return cho_solve(self.factor,b)
+
+  def log_det(self):
+    ''' 
+    Returns the log determinant of A
+    '''
+    return 2*np.sum(np.log(np.diag(self.factor[0])))
+
+  def inverse_diagonal(self,chunk_size=1000):
+    ''' 
+    Returns the diagonals of inv(A). The columns of inv(A) are
+    computed in chunks of *chunk_size* columns so that inv(A) is never
+    stored.
+    '''
+    n = self.factor[0].shape[0]
+    out = np.empty(n)
+    for start in range(0,n,chunk_size):
+      stop = min(start + chunk_size,n)
+      cols = np.arange(stop - start)
+      E = np.zeros((n,stop - start))
+      E[start + cols,cols] = 1.0
+      out[start:stop] = self.solve(E)[start + cols,cols]
+
+    return out
+
+  def inverse_trace(self,B):
+    ''' 
+    Returns tr(inv(A).dot(B)) for a symmetric matrix *B*, which can be
+    sparse. inv(A) is computed on the first call and kept for
+    subsequent calls.
+    '''
+    if self._inverse is None:
+      n = self.factor[0].shape[0]
+      self._inverse = self.solve(np.eye(n))
+
+    # inv(A) and B are symmetric, so the trace is the sum of their
+    # elementwise product
+    if sp.issparse(B):
+      return B.multiply(self._inverse).sum()
+    else:
+      return np.sum(B*self._inverse)
+
+
+class SparseFactor(object):
+  ''' 
+  Cholesky factorization of a sparse positive definite matrix, which
+  wraps a CHOLMOD factor
+  '''
+  def __init__(self,factor):
+    self.factor = factor
+    self._selected = None
+
+  def solve(self,b):
+    ''' 
+    Returns inv(A).dot(b)
+    '''
+    if sp.issparse(b):
+      b = b.toarray()
+
+    return self.factor.solve_A(b)
+
+  def log_det(self):
+    ''' 
+    Returns the log determinant of A
+    '''
+    return self.factor.logdet()
+
+  def _selected_inverse(self):
+    ''' 
+    Returns the Cholesky factor *L*, the permutation *P*, and the
+    entries of the inverse of the permuted matrix at the non-zeros of
+    *L* (see *_takahashi*). These are computed on the first call and
+    kept for subsequent calls.
+    '''
+    if self._selected is None:
+      logger.debug('Computing a selected inversion ...')
+      # L.dot(L.T) is A with its rows and columns permuted by P
+      L = sp.csc_matrix(self.factor.L())
+      L.sort_indices()
+      P = self.factor.P()
+      self._selected = (L,P,_takahashi(L))
+      logger.debug('Done')
+
+    return self._selected
+
+  def inverse_diagonal(self):
+    ''' 
+    Returns the diagonals of inv(A), computed with a selected
+    inversion of the Cholesky factor (see *_takahashi*)
+    '''
+    L,P,Z = self._selected_inverse()
+    out = np.empty(L.shape[0])
+    out[P] = Z[L.indptr[:-1]]
+    return out
+
+  def inverse_trace(self,B):
+    ''' 
+    Returns tr(inv(A).dot(B)) for a symmetric sparse matrix *B*. Only
+    the entries of inv(A) at the non-zeros of *B* are needed. They are
+    taken from the selected inversion, since the non-zeros of *A*,
+    and usually those of *B*, are non-zeros of the Cholesky factor.
+    Entries which are not in the selected inversion are computed by
+    solving for their columns of inv(A).
+    '''
+    if not sp.issparse(B):
+      B = sp.csc_matrix(B)
+
+    L,P,Z = self._selected_inverse()
+    n = L.shape[0]
+    B = B.tocoo()
+    # the non-zeros of *B* in the lower triangle of the permuted matrix
+    Pinv = np.empty(n,dtype=np.int64)
+    Pinv[P] = np.arange(n)
+    r,c = Pinv[B.row],Pinv[B.col]
+    r,c = np.maximum(r,c),np.minimum(r,c)
+    keys = _pattern_keys(L)
+    query = c*n + r
+    loc = np.minimum(np.searchsorted(keys,query),len(keys) - 1)
+    found = keys[loc] == query
+    vals = np.where(found,Z[loc],0.0)
+    if not np.all(found):
+      missing = ~found
+      logger.debug('Solving for %s entries of the inverse which are not '
+                   'in the selected inversion' % np.sum(missing))
+      cols = np.unique(B.col[missing])
+      E = np.zeros((n,cols.size))
+      E[cols,np.arange(cols.size)] = 1.0
+      Ai = self.solve(E)
+      vals[missing] = Ai[B.row[missing],np.searchsorted(cols,B.col[missing])]
+
+    return np.sum(B.data*vals)
+
+  def copy(self):
+    ''' 
+    Returns a copy of the factorization, which can be modified with
+    *update* without modifying this factorization
+    '''
+    return SparseFactor(self.factor.copy())
+
+  def update(self,C,subtract=False):
+    ''' 
+    Modifies the factorization of A in place so that it is the
+    factorization of A + C.dot(C.T), or A - C.dot(C.T) if *subtract*
+    is True. *C* is a sparse (N,K) matrix. This is a rank *K* update
+    or downdate of the Cholesky factor, which is much cheaper than
+    factoring the modified matrix. Raises a *np.linalg.LinAlgError* if
+    the modified matrix is not positive definite.
+    '''
+    # CHOLMOD expects the rows of *C* to be permuted like the factor
+    C = sp.csc_matrix(C)[self.factor.P()]
+    # the selected inversion is for the old factorization
+    self._selected = None
+    try:
+      self.factor.update_inplace(C,subtract=subtract)
+    except cholmod.CholmodNotPositiveDefiniteError as err:
+      raise np.linalg.LinAlgError(str(err))
+
+
+class FactorizationContext(object):
+  ''' 
+  Factors positive definite matrices and reuses the symbolic
+  factorization of sparse matrices with the same sparsity pattern.
+
+  Only one symbolic factorization is kept, which is replaced when a
+  matrix with a different sparsity pattern is factored. The
+  factorization returned by *factor* shares its numeric values with
+  the context, and so it is only valid until the next call to
+  *factor*.
+
+  CHOLMOD factors cannot be pickled, so copies of the context, such as
+  those sent to worker processes, start without a symbolic
+  factorization.
+  '''
+  def __init__(self):
+    self._factor = None
+    self._indptr = None
+    self._indices = None
+    # number of symbolic and numeric factorizations
+    self.analyses = 0
+    self.factorizations = 0
+
+  def __getstate__(self):
+    return {}
+
+  def __setstate__(self,state):
+    self.__init__()
+
+  def _same_pattern(self,A):
+    if self._factor is None:
+      return False
+
+    return (np.array_equal(A.indptr,self._indptr) &
+            np.array_equal(A.indices,self._indices))
+
+  def factor(self,A):
+    ''' 
+    Returns the Cholesky factorization of *A*, which can be a dense
+    array or a sparse matrix. Raises a *np.linalg.LinAlgError* if *A*
+    is not positive definite.
+    '''
+    self.factorizations += 1
+    if sp.issparse(A) & (not HAS_CHOLMOD):
+      A = A.toarray()
+
+    if not sp.issparse(A):
+      return DenseFactor(A)
+
+    A = sp.csc_matrix(A)
+    # CHOLMOD expects sorted indices without duplicates
+    A.sum_duplicates()
+    if not self._same_pattern(A):
+      logger.debug('Analyzing the sparsity pattern of a %s by %s '
+                   'matrix with %s non-zeros' % (A.shape + (A.nnz,)))
+      self._factor = cholmod.analyze(A)
+      self._indptr = np.copy(A.indptr)
+      self._indices = np.copy(A.indices)
+      self.analyses += 1
+
+    try:
+      self._factor.cholesky_inplace(A)
+    except cholmod.CholmodNotPositiveDefiniteError as err:
+      raise np.linalg.LinAlgError(str(err))
+
+    return SparseFactor(self._factor)
+
+
+class PartitionedSolver(object):
+  ''' 
+  Solves the system of equations
+
+    | A   P | | x |   | a |
+    | P.T 0 | | y | = | b |
+
+  where *A* is described by a *DenseFactor* or a *SparseFactor*. This
+  has the same interface as *rbf.gauss._PartitionedPosDefSolver*.
+
+  Parameters
+  ----------
+  Afactor : DenseFactor or SparseFactor
+
+  P : (N,M) array
+
+  '''
+  def __init__(self,Afactor,P):
+    self.Afactor = Afactor
+    self.P = P
+    # inv(A).dot(P)
+    self.AiP = Afactor.solve(P)
+    H = P.T.dot(self.AiP)
+    if P.shape[1] > 0:
+      self.H_factor = cho_factor(H,lower=True)
+    else:
+      self.H_factor = None
+
+    self._W = None
+
+  def _weights(self):
+    ''' 
+    Returns inv(L_H).dot(P.T).dot(inv(A)), where L_H is the Cholesky
+    decomposition of H = P.T.dot(inv(A)).dot(P). The upper left block
+    of the inverse of the partitioned matrix is then inv(A) -
+    W.T.dot(W).
+    '''
+    if self._W is None:
+      self._W = solve_triangular(np.tril(self.H_factor[0]),self.AiP.T,
+                                 lower=True)
+
+    return self._W
+
+  def solve(self,a,b):
+    ''' 
+    Returns *x* and *y* for the given *a* and *b*
+    '''
+    Aia = self.Afactor.solve(a)
+    if self.H_factor is None:
+      return Aia,np.zeros((0,) + Aia.shape[1:])
+
+    y = cho_solve(self.H_factor,self.P.T.dot(Aia) - b)
+    x = Aia - self.AiP.dot(y)
+    return x,y
+
+  def quad_diag(self):
+    ''' 
+    Returns the diagonals of the upper left block of the inverse of
+    the partitioned matrix, which is
+
+      inv(A) - inv(A).dot(P).dot(inv(H)).dot(P.T).dot(inv(A))
+
+    where H = P.T.dot(inv(A)).dot(P).
+    '''
+    out = self.Afactor.inverse_diagonal()
+    if self.H_factor is not None:
+      out -= np.sum(self._weights()**2,axis=0)
+
+    return out
+
+  def quad_trace(self,B):
+    ''' 
+    Returns tr(M.dot(B)), where *M* is the upper left block of the
+    inverse of the partitioned matrix and *B* is a symmetric matrix,
+    which can be sparse
+    '''
+    out = self.Afactor.inverse_trace(B)
+    if self.H_factor is not None:
+      # tr(W.T.dot(W).dot(B)) = tr(W.dot(B).dot(W.T))
+      W = self._weights()
+      out -= np.sum(W.T*B.dot(W.T))
+
+    return out
+
+  def log_det_H(self):
+    ''' 
+    Returns the log determinant of P.T.dot(inv(A)).dot(P)
+    '''
+    if self.H_factor is None:
+      return 0.0
+
+    return 2*np.sum(np.log(np.diag(self.H_factor[0])))
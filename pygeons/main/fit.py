@@ -9,39 +9,77 @@ from pygeons.main.gptools import (composite,
                                   station_sigma_and_p)
 from pygeons.main import gpnetwork
 from pygeons.main import gpstation
+from pygeons.main.kron import kronecker_solver
+from pygeons.main.statespace import statespace_solver
+from pygeons.main.factor import (FactorizationContext,
+                                 PartitionedSolver)
+from pygeons.main.probe import (hutchinson_diagonal,
+                                log_convergence)
 from rbf.gauss import (_as_sparse_or_array,
-                       _as_covariance,
-                       _PartitionedPosDefSolver)
+                       _as_covariance)
 logger = logging.getLogger(__name__)
 
 
-def _fit(d,s,mu,sigma,p):
+def _fit(d,s,mu,sigma,p,factorization,probes=None,seed=0):
   ''' 
   conditions the discrete Gaussian process described by *mu*, *sigma*,
   and *p* with the observations *d* which have uncertainty *s*.
   Returns the mean and standard deviation of the posterior at the
-  observation points.  
+  observation points. *d* can have multiple columns of data which
+  share the uncertainties *s*. The covariance matrix is factored with
+  the *FactorizationContext*, *factorization*. If *probes* is given
+  then the posterior variances are estimated with that many probe
+  vectors, generated with the random seed *seed*, rather than
+  computed exactly.
   '''  
   n,m = p.shape
+  mu = mu.reshape(mu.shape + (1,)*(d.ndim - 1))
   # *A* is the Gaussian process covariance with the noise
   # covariance added
   A = _as_sparse_or_array(sigma + _as_covariance(s))
-  Ksolver = _PartitionedPosDefSolver(A,p)
+  Ksolver = PartitionedSolver(factorization.factor(A),p)
   # compute mean of the posterior 
-  vec1,vec2 = Ksolver.solve(d - mu,np.zeros(m)) 
+  vec1,vec2 = Ksolver.solve(d - mu,np.zeros((m,) + d.shape[1:])) 
   u = mu + sigma.dot(vec1) + p.dot(vec2)   
-  # compute std. dev. of the posterior
-  if sp.issparse(sigma):
-    sigma = sigma.A
+  # compute std. dev. of the posterior. Since *sigma* is *A* minus
+  # the noise covariance, the posterior variance is diag(S) -
+  # diag(S).dot(M).dot(diag(S)), where S is the noise covariance and M
+  # is the upper left block of the inverse of the partitioned
+  # covariance matrix. Only the diagonals of *M* are computed.
+  if probes is None:
+    var = s**2 - s**4*Ksolver.quad_diag()
+
+  else:
+    # M.dot(V) is the first output of *Ksolver.solve*, and the probe
+    # vectors in a block are solved together with the same
+    # factorization
+    matvec = lambda V: Ksolver.solve(V,np.zeros((m,V.shape[1])))[0]
+    quad,quad_se = hutchinson_diagonal(matvec,n,probes,seed)
+    var = s**2 - s**4*quad
+    log_convergence(var,s**4*quad_se,probes)
 
-  mat1,mat2 = Ksolver.solve(sigma.T,p.T)
   del A,Ksolver
-  #  # just compute the diagonal components of the covariance matrix
-  #  # note that A.dot(B).diagonal() == np.sum(A*B.T,axis=1)
-  su = np.sqrt(sigma.diagonal() - 
-               np.sum(sigma*mat1.T,axis=1) -
-               np.sum(p*mat2.T,axis=1))
-                 
+  var[var < 0.0] = 0.0
+  su = np.sqrt(var)
+  return u,su
+
+
+def _fit_kronecker(d,s,Ksolver):
+  ''' 
+  Same as *_fit* but uses a *PartitionedKroneckerSolver*, which
+  describes the covariance of the Gaussian process with the noise
+  covariance added. 
+  '''
+  m = Ksolver.P.shape[1]
+  vec1,_ = Ksolver.solve(d,np.zeros((m,) + d.shape[1:]))
+  # the posterior mean is the observations minus the estimated noise
+  u = d - (s**2).reshape(s.shape + (1,)*(d.ndim - 1))*vec1
+  # the posterior variance is diag(S) - diag(S).dot(M).dot(diag(S)),
+  # where S is the noise covariance and M is the upper left block of
+  # the inverse of the partitioned covariance matrix
+  var = s**2 - s**4*Ksolver.quad_diag()
+  var[var < 0.0] = 0.0
+  su = np.sqrt(var)
   return u,su
 
 
@@ -49,11 +87,34 @@ def fit(t,x,d,sd,
         network_model,
         network_params,
         station_model,
-        station_params):
+        station_params,
+        factorization=None,
+        probes=None,
+        seed=0):
   ''' 
   Fit network and station processes to the observations, not
   distinguishing between signal and noise.
+  
+  *d* can be a (Nt,Nx) array or a (Nt,Nx,K) array containing *K*
+  datasets which share the uncertainties *sd*, in which case the
+  covariance matrix is only factored once. The posterior mean has
+  the same shape as *d* and the posterior standard deviation has
+  shape (Nt,Nx).
+
+  *factorization* is a *FactorizationContext* used to factor the
+  sparse covariance matrix, which can be shared between calls so that
+  the sparsity pattern is only analyzed once.
+
+  If *probes* is given then the posterior standard deviations are
+  estimated with that many Rademacher probe vectors (see
+  *pygeons.main.probe*), which is cheaper than computing them exactly
+  for large networks. This is only used when the covariance matrix
+  is factored directly. *seed* seeds the random number generator for
+  the probe vectors.
   '''
+  if factorization is None:
+    factorization = FactorizationContext()
+
   t = np.asarray(t,dtype=float)
   x = np.asarray(x,dtype=float)
   d = np.array(d,dtype=float)
@@ -72,7 +133,27 @@ def fit(t,x,d,sd,
 
   # mask indicates missing data
   mask = np.isinf(sd)
+  Ssolver = statespace_solver(network_model,network_params,
+                              station_model,station_params,
+                              net_gp,sta_gp,t,x,sd)
+  if Ssolver is not None:
+    # the processes are Markov in time and can be conditioned with a
+    # Kalman filter
+    u,su = Ssolver.fit(d)
+    u[mask] = np.nan
+    su[mask] = np.inf
+    return u,su
+
+  Ksolver = kronecker_solver(net_gp,sta_gp,t,x,sd)
   z,d,sd = z[~mask.ravel()],d[~mask],sd[~mask]
+  if Ksolver is not None:
+    # the covariance has Kronecker structure which can be exploited
+    uf,suf = _fit_kronecker(d,sd,Ksolver)
+    u = np.full(mask.shape + uf.shape[1:],np.nan)
+    u[~mask] = uf
+    su = np.full((t.shape[0],x.shape[0]),np.inf)
+    su[~mask] = suf
+    return u,su
 
   # Build covariance and basis vectors for the combined process. Do
   # not evaluated at masked points
@@ -82,12 +163,13 @@ def fit(t,x,d,sd,
   # combine station gp with the network gp
   mu = np.zeros(z.shape[0])
   sigma = _as_sparse_or_array(sta_sigma + net_sigma)
-  p = np.hstack((sta_p,net_p))
+  # keep the station basis vectors sparse
+  p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
   del sta_sigma,net_sigma,sta_p,net_p
   # best fit combination of signal and noise to the observations
-  uf,suf = _fit(d,sd,mu,sigma,p)
+  uf,suf = _fit(d,sd,mu,sigma,p,factorization,probes,seed)
   # fold back into 2d arrays
-  u = np.full((t.shape[0],x.shape[0]),np.nan)
+  u = np.full(mask.shape + uf.shape[1:],np.nan)
   u[~mask] = uf
   su = np.full((t.shape[0],x.shape[0]),np.inf)
   su[~mask] = suf
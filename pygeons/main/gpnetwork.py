@@ -4,7 +4,13 @@ module of network Gaussian process constructors.
 import rbf.basis
 import rbf.poly
 from rbf import gauss
-from pygeons.main.gptools import set_units,kernel_product
+from pygeons.main.gptools import (set_units,
+                                  kernel_product,
+                                  gpcompact,
+                                  AMPLITUDE,
+                                  TIME_SCALE,
+                                  LENGTH_SCALE,
+                                  FREQUENCY)
 from pygeons.main import gpstation
 
 # 2D GaussianProcess constructors
@@ -48,12 +54,13 @@ def spwen32(sigma,cls):
   ''' 
   Sparse Wendland space covariance function 
   '''
-  return gauss.gpiso(rbf.basis.spwen32,(0.0,sigma**2,cls),dim=2)
+  return gpcompact(rbf.basis.spwen32,(0.0,sigma**2,cls),dim=2)
 
 
 # 3D GaussianProcess constructors
 #####################################################################
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def se_se(sigma,cts,cls):
   ''' 
   Squared exponential for temporal and spatial covariance.
@@ -69,7 +76,8 @@ def se_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def exp_se(sigma,cts,cls):
   ''' 
   Exponetial for temporal covariance. Squared exponential for spatial
@@ -86,7 +94,8 @@ def exp_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def wen11_se(sigma,cts,cls):
   ''' 
   1-D C2 Wendland function for temporal covariance. Squared
@@ -103,7 +112,8 @@ def wen11_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def wen12_se(sigma,cts,cls):
   ''' 
   1-D C4 Wendland function for temporal covariance. Squared
@@ -120,7 +130,8 @@ def wen12_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def spwen11_se(sigma,cts,cls):
   ''' 
   1-D C2 Wendland function for temporal covariance. Squared
@@ -137,7 +148,8 @@ def spwen11_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def spwen12_se(sigma,cts,cls):
   ''' 
   1-D C4 Wendland function for temporal covariance. Squared
@@ -154,7 +166,46 @@ def spwen12_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm/yr^0.5','1/yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
+def spwen11_spwen32(sigma,cts,cls):
+  ''' 
+  1-D C2 Wendland function for temporal covariance. 3-D C4 Wendland
+  function for spatial covariance. The covariance is compactly
+  supported in both time and space.
+  
+  Parameters
+  ----------
+  sigma [mm] : Standard deviation of displacements
+  cts [yr] : Characteristic time-scale
+  cls [km] : Characteristic length-scale
+  '''
+  tgp = gpstation.spwen11(sigma,cts,convert=False)
+  sgp = spwen32(1.0,cls)
+  return kernel_product(tgp,sgp)
+
+
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
+def spwen12_spwen32(sigma,cts,cls):
+  ''' 
+  1-D C4 Wendland function for temporal covariance. 3-D C4 Wendland
+  function for spatial covariance. The covariance is compactly
+  supported in both time and space.
+  
+  Parameters
+  ----------
+  sigma [mm] : Standard deviation of displacements
+  cts [yr] : Characteristic time-scale
+  cls [km] : Characteristic length-scale
+  '''
+  tgp = gpstation.spwen12(sigma,cts,convert=False)
+  sgp = spwen32(1.0,cls)
+  return kernel_product(tgp,sgp)
+
+
+@set_units(['mm/yr^0.5','1/yr','km'],
+           [AMPLITUDE,FREQUENCY,LENGTH_SCALE])
 def fogm_se(sigma,fc,cls):
   ''' 
   First-order Gauss-Markov for temporal covariance. Squared
@@ -171,7 +222,8 @@ def fogm_se(sigma,fc,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm/yr^0.5','mjd','km'])
+@set_units(['mm/yr^0.5','mjd','km'],
+           [AMPLITUDE,None,LENGTH_SCALE])
 def bm_se(sigma,t0,cls):
   ''' 
   Brownian motion for temporal covariance. Squared exponential for
@@ -188,7 +240,8 @@ def bm_se(sigma,t0,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm/yr^1.5','mjd','km'])
+@set_units(['mm/yr^1.5','mjd','km'],
+           [AMPLITUDE,None,LENGTH_SCALE])
 def ibm_se(sigma,t0,cls):
   ''' 
   Integrated Brownian motion for temporal covariance. Squared
@@ -205,7 +258,8 @@ def ibm_se(sigma,t0,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def mat32_se(sigma,cts,cls):
   ''' 
   Matern (nu=3/2) function for temporal covariance. Squared
@@ -222,7 +276,8 @@ def mat32_se(sigma,cts,cls):
   return kernel_product(tgp,sgp)
 
 
-@set_units(['mm','yr','km'])
+@set_units(['mm','yr','km'],
+           [AMPLITUDE,TIME_SCALE,LENGTH_SCALE])
 def mat52_se(sigma,cts,cls):
   ''' 
   Matern (nu=5/2) function for temporal covariance. Squared
@@ -249,4 +304,6 @@ CONSTRUCTORS = {'bm-se':bm_se,
                 'wen11-se':wen11_se,
                 'wen12-se':wen12_se,
                 'spwen11-se':spwen11_se,
-                'spwen12-se':spwen12_se}
+                'spwen12-se':spwen12_se,
+                'spwen11-spwen32':spwen11_spwen32,
+                'spwen12-spwen32':spwen12_spwen32}
@@ -5,7 +5,11 @@ import numpy as np
 import rbf.basis
 import rbf.poly
 from rbf import gauss
-from pygeons.main.gptools import set_units
+from pygeons.main.gptools import (set_units,
+                                  gpcompact,
+                                  AMPLITUDE,
+                                  TIME_SCALE,
+                                  FREQUENCY)
                                
 
 @set_units([])
@@ -88,7 +92,7 @@ def step(t0):
   return gauss.gpbfci(basis,dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def mat32(sigma,cts):
   ''' 
   Matern covariance function with nu=3/2
@@ -101,7 +105,7 @@ def mat32(sigma,cts):
   return gauss.gpiso(rbf.basis.mat32,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def mat52(sigma,cts):
   ''' 
   Matern covariance function with nu=5/2
@@ -114,7 +118,7 @@ def mat52(sigma,cts):
   return gauss.gpiso(rbf.basis.mat52,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def wen11(sigma,cts):
   ''' 
   Wendland 1-D C2 covariance function. 
@@ -127,7 +131,7 @@ def wen11(sigma,cts):
   return gauss.gpiso(rbf.basis.wen11,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def wen12(sigma,cts):
   ''' 
   Wendland 1-D C4 covariance function. 
@@ -140,7 +144,7 @@ def wen12(sigma,cts):
   return gauss.gpiso(rbf.basis.wen12,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def wen30(sigma,cts):
   ''' 
   Wendland 3-D C0 covariance function. 
@@ -153,7 +157,7 @@ def wen30(sigma,cts):
   return gauss.gpiso(rbf.basis.wen30,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def spwen11(sigma,cts):
   ''' 
   Wendland 1-D C2 covariance function. 
@@ -163,10 +167,10 @@ def spwen11(sigma,cts):
   sigma [mm] : Standard deviation of displacements
   cts [yr] : Characteristic time-scale
   '''
-  return gauss.gpiso(rbf.basis.spwen11,(0.0,sigma**2,cts),dim=1)
+  return gpcompact(rbf.basis.spwen11,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def spwen12(sigma,cts):
   ''' 
   Wendland 1-D C4 covariance function. 
@@ -176,10 +180,10 @@ def spwen12(sigma,cts):
   sigma [mm] : Standard deviation of displacements
   cts [yr] : Characteristic time-scale
   '''
-  return gauss.gpiso(rbf.basis.spwen12,(0.0,sigma**2,cts),dim=1)
+  return gpcompact(rbf.basis.spwen12,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def spwen30(sigma,cts):
   ''' 
   Wendland 3-D C0 covariance function. 
@@ -189,10 +193,10 @@ def spwen30(sigma,cts):
   sigma [mm] : Standard deviation of displacements
   cts [yr] : Characteristic time-scale
   '''
-  return gauss.gpiso(rbf.basis.spwen30,(0.0,sigma**2,cts),dim=1)
+  return gpcompact(rbf.basis.spwen30,(0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def se(sigma,cts):
   ''' 
   Squared exponential covariance function
@@ -207,7 +211,7 @@ def se(sigma,cts):
   return gauss.gpse((0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm','yr'])
+@set_units(['mm','yr'],[AMPLITUDE,TIME_SCALE])
 def exp(sigma,cts):
   ''' 
   Exponential covariance function
@@ -222,7 +226,7 @@ def exp(sigma,cts):
   return gauss.gpexp((0.0,sigma**2,cts),dim=1)
 
 
-@set_units(['mm/yr^0.5','yr^-1'])
+@set_units(['mm/yr^0.5','yr^-1'],[AMPLITUDE,FREQUENCY])
 def fogm(sigma,w):
   ''' 
   First-order Gauss Markov process
@@ -239,7 +243,7 @@ def fogm(sigma,w):
   return gauss.gpexp((0.0,coeff,cts),dim=1)
 
 
-@set_units(['mm/yr^0.5','mjd'])
+@set_units(['mm/yr^0.5','mjd'],[AMPLITUDE,None])
 def bm(sigma,t0):
   ''' 
   Brownian motion 
@@ -265,7 +269,7 @@ def bm(sigma,t0):
   return gauss.GaussianProcess(mean,cov,dim=1)  
 
 
-@set_units(['mm/yr^1.5','mjd'])
+@set_units(['mm/yr^1.5','mjd'],[AMPLITUDE,None])
 def ibm(sigma,t0):
   ''' 
   Integrated Brownian motion 
@@ -3,130 +3,342 @@ Tools for creating Gaussian processes.
 '''
 import numpy as np
 import scipy.sparse as sp
+from scipy.spatial import cKDTree
 from rbf.gauss import (GaussianProcess,
                        _get_arg_count,
                        _zero_mean,
                        _zero_covariance,
                        _empty_basis)
 from pygeons.units import unit_conversion as conv
+from pygeons.main.toeplitz import toeplitz_column,toeplitz_coo
 #from pygeons.main.cbasis import add_diffs_to_caches
 import logging
 logger = logging.getLogger(__name__)
 
 
-def station_sigma_and_p(gp,time,mask):
+def station_basis(p_i,mask):
+  ''' 
+  Returns the orthonormal basis vectors for a station process
+  evaluated at the unmasked data. The basis vectors for each station
+  are orthonormalized independently, and columns which are linearly
+  dependent are removed. This is equivalent to orthonormalizing the
+  basis vectors for the whole network, since the basis vectors for
+  different stations do not overlap.
+
+  Parameters
+  ----------
+  p_i : (Nt,Np) array
+    Basis vectors for a single station evaluated at all times
+
+  mask : (Nt,Nx) bool array
+    Indicates missing data
+
+  Returns
+  -------
+  (Nu,M) csc sparse matrix
+  '''
+  Nt,Nx = mask.shape
+  Np = p_i.shape[1]
+  Nu = np.sum(~mask)
+  # index of each unmasked datum in the flattened output
+  idx_map = np.cumsum(~mask.ravel()).reshape((Nt,Nx)) - 1
+  data = []
+  rows = []
+  counts = []
+  removed = 0
+  for i in range(Nx):
+    tidx, = np.nonzero(~mask[:,i])
+    if (tidx.size == 0) | (Np == 0):
+      continue
+
+    u,s,_ = np.linalg.svd(p_i[tidx],full_matrices=False)
+    keep = s > 1e-12*s.max()
+    removed += Np - np.sum(keep)
+    # the columns of *u* are stored contiguously in CSC format
+    data += [u[:,keep].T.ravel()]
+    rows += [np.tile(idx_map[tidx,i],np.sum(keep))]
+    counts += [np.full(np.sum(keep),tidx.size,dtype=int)]
+
+  if len(counts) == 0:
+    return sp.csc_matrix((Nu,0),dtype=float)
+
+  counts = np.hstack(counts)
+  indptr = np.zeros(counts.size + 1,dtype=int)
+  np.cumsum(counts,out=indptr[1:])
+  p = sp.csc_matrix((np.hstack(data),np.hstack(rows),indptr),
+                    (Nu,counts.size),dtype=float)
+  logger.debug('Removed %s singular values from the station basis '
+               'vectors' % removed)
+  return p
+
+
+class StationStructure(object):
+  ''' 
+  Parts of the station covariance matrix and basis vectors which do
+  not depend on the hyperparameters. This is used by
+  *station_sigma_and_p* and can be reused when the covariance matrix
+  is built for many different hyperparameters, as in *reml*.
+
+  The structure records where each non-zero of the single station
+  covariance matrix goes in the covariance matrix for the unmasked
+  data, and the orthonormalized basis vectors. These are recomputed
+  only when the sparsity pattern or the basis functions change. A
+  few of the most recent patterns and bases are kept, so that the
+  covariance matrix and its derivatives can be built alternately.
+
+  Parameters
+  ----------
+  time : (Nt,1) array
+    Observation times
+
+  mask : (Nt,Nx) bool array
+    Indicates missing data
+
+  size : int, optional
+    Number of sparsity patterns and bases to keep
+
+  '''
+  def __init__(self,time,mask,size=4):
+    self.time = time
+    self.mask = mask
+    self.size = size
+    Nt,Nx = mask.shape
+    Nu = np.sum(~mask)
+    # the unmasked data are ordered by time and then by station. *tu*
+    # and *xu* are the time and station indices for each unmasked
+    # datum, and *idx_map* maps time and station indices to the index
+    # of the unmasked datum, or -1 if the datum is masked
+    tu,xu = np.nonzero(~mask)
+    if Nu < np.iinfo(np.int32).max:
+      self.idx_dtype = np.int32
+    else:
+      self.idx_dtype = np.int64
+
+    self.idx_map = np.full((Nt,Nx),-1,dtype=self.idx_dtype)
+    self.idx_map[tu,xu] = np.arange(Nu,dtype=self.idx_dtype)
+    self.Nt,self.Nx,self.Nu = Nt,Nx,Nu
+    # lists of (key,value) pairs with the most recent last
+    self._patterns = []
+    self._bases = []
+
+  def _lookup(self,cache,match,build):
+    for i,(key,value) in enumerate(cache):
+      if match(key):
+        # move the entry to the end
+        cache.append(cache.pop(i))
+        return value
+
+    key,value = build()
+    cache.append((key,value))
+    if len(cache) > self.size:
+      cache.pop(0)
+
+    return value
+
+  def _build_pattern(self,row_i,col_i):
+    ''' 
+    Returns the indices of the non-zeros in the single station
+    covariance matrix which are gathered for the output, and the
+    locations of the output non-zeros
+    '''
+    Nu = self.Nu
+    # Each non-zero in sigma_i is repeated for every station. Gathering
+    # entire rows of *idx_map* gives the output rows and columns for
+    # all stations at once, without looping over stations
+    rows = self.idx_map[row_i]
+    cols = self.idx_map[col_i]
+    keep = (rows != -1) & (cols != -1)
+    rows = rows[keep]
+    cols = cols[keep]
+    src = np.nonzero(keep)[0].astype(self.idx_dtype)
+    del keep
+    if src.size > 0.5*Nu**2:
+      # if the output matrix has more than 50% non-zeros then make it
+      # dense
+      return ('dense',src,rows,cols)
+
+    # otherwise make it csc sparse. The non-zeros are sorted by column
+    # and then by row so that the csc matrix can be formed without
+    # any conversions
+    order = np.lexsort((rows,cols))
+    indptr = np.zeros(Nu + 1,dtype=self.idx_dtype)
+    np.cumsum(np.bincount(cols,minlength=Nu),out=indptr[1:])
+    return ('sparse',src[order],rows[order],indptr)
+
+  def sigma(self,sigma_i):
+    ''' 
+    Returns the covariance matrix for the unmasked data, where
+    *sigma_i* is the (Nt,Nt) covariance matrix for a single station
+    '''
+    sigma_i = sp.coo_matrix(sigma_i)
+    row_i,col_i = sigma_i.row,sigma_i.col
+    def match(key):
+      return (np.array_equal(key[0],row_i) & 
+              np.array_equal(key[1],col_i))
+
+    def build():
+      return (row_i,col_i),self._build_pattern(row_i,col_i)
+
+    kind,src,a,b = self._lookup(self._patterns,match,build)
+    data = sigma_i.data[src]
+    Nu = self.Nu
+    if kind == 'dense':
+      sigma = np.zeros((Nu,Nu))
+      sigma[a,b] = data
+      logger.debug('Station covariance matrix is dense')
+
+    else:
+      sigma = sp.csc_matrix((data,a,b),(Nu,Nu))
+      density = (100.0*sigma.nnz)/max(Nu**2,1)
+      logger.debug('Station covariance matrix is sparse with %.3f%% '
+                   'non-zeros' % density)
+
+    return sigma
+
+  def basis(self,p_i):
+    ''' 
+    Returns the orthonormal basis vectors for the unmasked data, where
+    *p_i* are the (Nt,Np) basis vectors for a single station (see
+    *station_basis*)
+    '''
+    def match(key):
+      return (key.shape == p_i.shape) & np.array_equal(key,p_i)
+
+    def build():
+      return np.copy(p_i),station_basis(p_i,self.mask)
+
+    return self._lookup(self._bases,match,build)
+
+
+def station_sigma(gp,time,mask,structure=None):
+  ''' 
+  Build the sparse covariance matrix describing noise that is
+  uncorrelated between stations. This is the same as the covariance
+  matrix returned by *station_sigma_and_p*, but the basis vectors are
+  not built, which avoids the work in *StationStructure.basis* when
+  only the covariance matrix changes.
+  '''
+  if structure is None:
+    structure = StationStructure(time,mask)
+
+  diff = np.array([0])             
+  # if the covariance function is stationary and the times are
+  # uniformly spaced then *sigma_i* is a Toeplitz matrix, and only its
+  # first column needs to be evaluated. The expanded matrix still has
+  # every non-zero entry
+  col = toeplitz_column(gp,time)
+  if col is not None:
+    logger.debug('Evaluated only the first column of the Toeplitz '
+                 'station covariance matrix')
+    sigma_i = toeplitz_coo(col)
+  else:
+    sigma_i = gp._covariance(time,time,diff,diff)
+
+  return structure.sigma(sigma_i)
+
+
+def station_sigma_and_p(gp,time,mask,structure=None):
   ''' 
   Build the sparse covariance matrix and basis vectors describing
   noise that is uncorrelated between stations. The covariance and
-  basis functions will only be evauluated at unmasked data.
+  basis functions will only be evauluated at unmasked data. The basis
+  vectors are returned as a sparse matrix (see *station_basis*).
+  *structure* is a *StationStructure* for *time* and *mask*, which
+  can be given to reuse the work that does not depend on *gp*.
   '''
   logger.debug('Building station covariance matrix and basis '
                'vectors ...')
-  diff = np.array([0])             
-  sigma_i = gp._covariance(time,time,diff,diff)
-  p_i = gp._basis(time,diff)
-
-  Nt,Np = p_i.shape # number of times and basis functions
-  _,Nx = mask.shape # number of stations
-  Nu = np.sum(~mask) # number of unmasked data
-
-  # break sigma_i into data,rows,cols
-  if sp.issparse(sigma_i):
-    sigma_i = sigma_i.tocoo()
-    data_i = sigma_i.data
-    rows_i = sigma_i.row
-    cols_i = sigma_i.col
-  
-  else:
-    # the matrix is dense
-    data_i = sigma_i.ravel()
-    rows_i,cols_i = np.mgrid[:Nt,:Nt].astype(np.int32)
-    rows_i = rows_i.ravel()
-    cols_i = cols_i.ravel()
-    
-  # do the same for p_i, which is always dense
-  p_data_i = p_i.ravel()   
-  p_rows_i,p_cols_i = np.mgrid[:Nt,:Np].astype(np.int32)
-  p_rows_i = p_rows_i.ravel()
-  p_cols_i = p_cols_i.ravel()
-  
-  # collect the covariance data dynamically using data, row, col
-  # format
-  data = [] # container for non-zero elements of the cov matrix
-  rows = [] # container for row numbers for each non-zero 
-  cols = [] # container for column numbers for each non-zero 
-  p_data = [] # data for elements of basis vector matrix
-  p_rows = [] 
-  p_cols = [] 
-  for i in range(Nx):
-    # mask_i indicates the elements of data_i that correspond to a
-    # masked datum. Dont include them in the output array
-    mask_i = mask[rows_i,i] | mask[cols_i,i]
-    data += [data_i[~mask_i]]
-    rows += [i + rows_i[~mask_i]*Nx]
-    cols += [i + cols_i[~mask_i]*Nx]
-    # make basis vector data
-    mask_i = mask[p_rows_i,i]
-    p_data += [p_data_i[~mask_i]]
-    p_rows += [i + p_rows_i[~mask_i]*Nx]
-    p_cols += [i*Np + p_cols_i[~mask_i]]
-
-  data = np.hstack(data)
-  rows = np.hstack(rows)
-  cols = np.hstack(cols)
-  p_data = np.hstack(p_data)
-  p_rows = np.hstack(p_rows)
-  p_cols = np.hstack(p_cols)
-  # map rows and cols to the rows and cols of the array after the
-  # masked data have been removed
-  idx_map = np.cumsum(~mask.ravel()) - 1
-  rows = idx_map[rows]
-  cols = idx_map[cols]
-  p_rows = idx_map[p_rows]
-  
-  # build final covariance matrix array
-  if data.size > 0.5*Nu**2:
-    # if the output matrix has more than 50% non-zeros then make the
-    # it dense
-    sigma = np.zeros((Nu,Nu))
-    sigma[rows,cols] = data
-    logger.debug('Station covariance matrix is dense')
-  
-  else:
-    # otherwise make it csc sparse    
-    sigma = sp.csc_matrix((data,(rows,cols)),(Nu,Nu),dtype=float)
-    density = (100.0*sigma.nnz)/np.prod(sigma.shape)
-    logger.debug('Station covariance matrix is sparse with %.3f%% '
-                 'non-zeros' % density)
-
-  # build final basis vector array
-  p = np.zeros((Nu,Nx*Np))
-  p[p_rows,p_cols] = p_data
-  if p.size != 0:
-    # remove singluar values from p
-    u,s,_ = np.linalg.svd(p,full_matrices=False)
-    keep = s > 1e-12*s.max()
-    p = u[:,keep]
-    logger.debug('Removed %s singular values from the station basis '
-                 'vectors' % np.sum(~keep))
+  if structure is None:
+    structure = StationStructure(time,mask)
 
+  sigma = station_sigma(gp,time,mask,structure)
+  p = structure.basis(gp._basis(time,np.array([0])))
   logger.debug('Done')
   return sigma,p
 
 
+class _ArrayBuffer(object):
+  ''' 
+  One-dimensional array which grows geometrically as it is extended
+  '''
+  def __init__(self,dtype,capacity=1024):
+    self.array = np.empty(capacity,dtype=dtype)
+    self.size = 0
+
+  def extend(self,x):
+    new_size = self.size + len(x)
+    if new_size > len(self.array):
+      new_array = np.empty(max(new_size,2*len(self.array)),
+                           dtype=self.array.dtype)
+      new_array[:self.size] = self.array[:self.size]
+      self.array = new_array
+
+    self.array[self.size:new_size] = x
+    self.size = new_size
+
+  def values(self):
+    return self.array[:self.size]
+
+
+class _CSRBuffer(object):
+  ''' 
+  Sparse matrix which is built by appending blocks of rows
+  '''
+  def __init__(self,shape):
+    self.shape = shape
+    if shape[1] < np.iinfo(np.int32).max:
+      self.idx_dtype = np.int32
+    else:
+      self.idx_dtype = np.int64
+
+    self.data = _ArrayBuffer(float)
+    self.indices = _ArrayBuffer(self.idx_dtype)
+    self.counts = []
+
+  def append(self,block,col_offset=0):
+    ''' 
+    Appends the sparse matrix *block*, whose first column is at
+    *col_offset*
+    '''
+    block = sp.csr_matrix(block)
+    self.data.extend(block.data)
+    self.indices.extend(col_offset + block.indices)
+    self.counts += [np.diff(block.indptr)]
+
+  def tocsr(self):
+    indptr = np.zeros(self.shape[0] + 1,dtype=self.idx_dtype)
+    if len(self.counts) > 0:
+      np.cumsum(np.hstack(self.counts),out=indptr[1:])
+
+    return sp.csr_matrix((self.data.values(),self.indices.values(),indptr),
+                         self.shape)
+    
+
 def chunkify_covariance(cov_in,chunk_size):
   ''' 
   Wraps covariance functions so that the covariance matrix is built in
   chunks rather than all at once. This is more memory efficient if the
   covariance function generates multiple intermediary arrays. 
+
+  If *x1* is *x2* and *diff1* is equal to *diff2*, then the covariance
+  matrix is symmetric and only the upper triangle is evaluated, along
+  with the square blocks on the diagonal. The rest of the lower
+  triangle is then filled in by mirroring the upper triangle.
+
+  Whether the output is dense or sparse is decided from the number of
+  non-zeros in the first chunk. Dense chunks are then written directly
+  into the output array, and sparse chunks are appended to a CSR
+  buffer.
   '''
   def cov_out(x1,x2,diff1,diff2):
     N1,N2 = x1.shape[0],x2.shape[0]
-    # Collect the data in data,rows,cols format. Then covert to the
-    # proper type at the end
-    data = []
-    rows = []
-    cols = []
+    symmetric = (x1 is x2) & np.array_equal(diff1,diff2)
+    # The output matrix. This is created after evaluating the first
+    # chunk
+    out = None
+    # If the output is sparse and symmetric, then *mirror* contains the
+    # elements of the upper triangle which need to be mirrored
+    mirror = None
     # count is the total number of rows added to the output covariance
     # matrix thus far
     count = 0 
@@ -139,39 +351,81 @@ def chunkify_covariance(cov_in,chunk_size):
           'complete' % (chunk_size,(100.0*count)/N1))
 
       start,stop = count,min(count+chunk_size,N1)
-      cov_chunk = cov_in(x1[start:stop],x2,diff1,diff2) 
-      if sp.issparse(cov_chunk):
-        # if sparse convert to coo and get the data
-        cov_chunk = cov_chunk.tocoo()
-        data += [cov_chunk.data]
-        rows += [start + cov_chunk.row]
-        cols += [cov_chunk.col]
+      if symmetric:
+        # only evaluate the columns which are in the upper triangle.
+        # This includes the square block on the diagonal
+        offset = start
+      else:
+        offset = 0
+
+      cov_chunk = cov_in(x1[start:stop],x2[offset:],diff1,diff2) 
+      if out is None:
+        # Decide whether to make the output array sparse or dense
+        # based on the number of non-zeros in the first chunk. I could
+        # have alternatively had the output mimic the input covariance
+        # function.
+        if sp.issparse(cov_chunk):
+          nnz = cov_chunk.nnz
+        else:
+          nnz = np.prod(cov_chunk.shape)
+
+        if nnz > (0.5*np.prod(cov_chunk.shape)):
+          # if the matrix has more than 50% non-zeros then make the
+          # output matrix dense
+          out = np.zeros((N1,N2))
+        else:
+          # otherwise make it sparse
+          out = _CSRBuffer((N1,N2))
+          if symmetric:
+            mirror = _CSRBuffer((N1,N2))
+            
+      # the chunk columns to the right of the diagonal block get
+      # mirrored if the matrix is symmetric
+      n = stop - start
+      if isinstance(out,np.ndarray):
+        if sp.issparse(cov_chunk):
+          cov_chunk = cov_chunk.tocoo()
+          r = start + cov_chunk.row
+          c = offset + cov_chunk.col
+          out[r,c] = cov_chunk.data
+          if symmetric:
+            right = cov_chunk.col >= n
+            out[c[right],r[right]] = cov_chunk.data[right]
+
+        else:
+          out[start:stop,offset:] = cov_chunk
+          if symmetric:
+            out[stop:,start:stop] = cov_chunk[:,n:].T
 
       else:
-        # if dense unravel cov_chunk
-        r,c = np.mgrid[start:stop,:N2].astype(np.int32)
-        data += [cov_chunk.ravel()]
-        rows += [r.ravel()]
-        cols += [c.ravel()]
-        
+        cov_chunk = sp.csr_matrix(cov_chunk)
+        out.append(cov_chunk,offset)
+        if symmetric:
+          # zero out the diagonal block so that only the elements to
+          # the right of it are mirrored
+          right = cov_chunk.copy()
+          right.data[right.indices < n] = 0.0
+          right.eliminate_zeros()
+          mirror.append(right,offset)
+          del right
+
+      del cov_chunk
       count = min(count+chunk_size,N1)
       
-    data = np.hstack(data)
-    rows = np.hstack(rows)
-    cols = np.hstack(cols)
-    # Decide whether to make the output array sparse or dense based on
-    # the number of non-zeros. I could have alternatively had the
-    # output mimic the input covariance function.
-    if data.size > (0.5*N1*N2):
-      # if the matrix has more than 50% non-zeros then make the output
-      # matrix dense
-      out = np.zeros((N1,N2))
-      out[rows,cols] = data
-  
-    else:
-      # otherwise make it csc sparse    
-      out = sp.csc_matrix((data,(rows,cols)),(N1,N2),dtype=float)
-    
+    if out is None:
+      # there are no rows
+      out = _CSRBuffer((N1,N2))
+
+    if not isinstance(out,np.ndarray):
+      out = out.tocsr()
+      if symmetric:
+        out = out + mirror.tocsr().T
+        # the transpose of a symmetric CSR matrix is the same matrix
+        # in CSC format, which does not require a copy
+        out = out.T
+      else:
+        out = out.tocsc()
+        
     if N1 > chunk_size:
       logger.debug(
         'Building covariance matrix (chunk size = %s) : 100.0%% '
@@ -182,14 +436,38 @@ def chunkify_covariance(cov_in,chunk_size):
   return cov_out      
 
  
-def set_units(units):
+# Descriptions of how a covariance function depends on a
+# hyperparameter. Each description is a tuple *(a,b,dims)* such that
+# the derivative of the covariance function with respect to the log
+# of the hyperparameter is
+#
+#   a*C(x,x') + b*sum_{i in dims} (x_i - x'_i)*dC(x,x')/dx_i
+#
+# The time is the first dimension and the spatial coordinates are the
+# second and third dimensions.
+AMPLITUDE = (2.0,0.0,())
+TIME_SCALE = (0.0,-1.0,(0,))
+LENGTH_SCALE = (0.0,-1.0,(1,2))
+FREQUENCY = (-1.0,1.0,(0,))
+
+
+def set_units(units,derivatives=None):
   ''' 
   Wrapper for Gaussian process constructors which sets the
   hyperparameter units. When a wrapped constructor is called, the
   hyperparameters are converted to be in terms of *m* and *day*. The
   constructor is also given the key word argument *convert*, which can
   be set to False if no conversion is desired.
+
+  *derivatives* describes how the covariance function depends on
+  each hyperparameter (e.g., *AMPLITUDE* or *TIME_SCALE*), which is
+  used to compute the derivatives of the covariance function. An
+  entry should be None if the derivative cannot be computed this
+  way.
   '''
+  if derivatives is None:
+    derivatives = [None for u in units]
+
   def decorator(fin):
     def fout(*args,**kwargs):
       convert = kwargs.pop('convert',True)
@@ -199,6 +477,7 @@ def set_units(units):
       return fin(*args)
 
     fout.units = units
+    fout.derivatives = derivatives
     fout.nargs = _get_arg_count(fin)
     fout.__doc__ = fin.__doc__
     fout.__name__ = fin.__name__
@@ -206,22 +485,144 @@ def set_units(units):
       raise ValueError(
         'the number of arguments must be equal to the number of unit '
         'specifications') 
+
+    if fout.nargs != len(fout.derivatives):
+      raise ValueError(
+        'the number of arguments must be equal to the number of '
+        'derivative specifications') 
     
     return fout  
 
   return decorator  
 
 
+def _unique_times(x):
+  ''' 
+  Returns the unique times in the first column of *x* as a (Nt,1)
+  array and the indices which map the unique times back to *x*
+  '''
+  u,inv = np.unique(x[:,0],return_inverse=True)
+  return u[:,None],inv
+
+
+def _unique_positions(x):
+  ''' 
+  Returns the unique positions in the last two columns of *x* as a
+  (Nx,2) array and the indices which map the unique positions back to
+  *x*
+  '''
+  # represent the positions as complex numbers so that they can be
+  # sorted lexicographically in one pass
+  u,inv = np.unique(x[:,1] + 1j*x[:,2],return_inverse=True)
+  return np.array([u.real,u.imag]).T,inv
+
+
+def _row_offset(x,base):
+  ''' 
+  If *x* is a slice of rows of the array *base*, then this returns the
+  index of the first row of *x* in *base*. Otherwise, this returns
+  None.
+  '''
+  if base is None:
+    return None
+
+  if x is base:
+    return 0
+
+  # find the arrays which own the memory
+  x_owner = x if x.base is None else x.base
+  base_owner = base if base.base is None else base.base
+  if ((x_owner is not base_owner) |
+      (x.strides != base.strides) |
+      (x.shape[1:] != base.shape[1:]) |
+      (base.strides[0] <= 0)):
+    return None
+
+  # number of bytes between the first elements of *x* and *base*
+  delta = (x.__array_interface__['data'][0] - 
+           base.__array_interface__['data'][0])
+  start,remainder = divmod(delta,base.strides[0])
+  if ((remainder != 0) | (start < 0) | 
+      (start + x.shape[0] > base.shape[0])):
+    return None
+
+  return start
+
+
+def _gather_product(cov1,idx1,cov2,idx2):
+  ''' 
+  Returns the product of two covariance matrices which were evaluated
+  at unique times and unique positions. Element (i,j) of the output
+  is cov1[idx1[0][i],idx1[1][j]]*cov2[idx2[0][i],idx2[1][j]].
+  '''
+  if (not sp.issparse(cov1)) & (not sp.issparse(cov2)):
+    # both are dense. The output will be a dense array
+    return (cov1[np.ix_(idx1[0],idx1[1])]*
+            cov2[np.ix_(idx2[0],idx2[1])])
+
+  # At least one is sparse. The output will be a sparse array. Expand
+  # the sparse matrix to the output points, and then gather the
+  # elements of the other matrix at the non-zeros. If both are sparse
+  # then the smaller one is made dense for the gather. The sparsity
+  # pattern of the output is the intersection of the stored patterns
+  # of both matrices, which only depends on the points and not on the
+  # values of the covariances
+  if (not sp.issparse(cov1)) | (sp.issparse(cov2) & 
+                                (np.prod(cov1.shape) < np.prod(cov2.shape))):
+    cov1,idx1,cov2,idx2 = cov2,idx2,cov1,idx1
+
+  N1,N2 = len(idx1[0]),len(idx1[1])
+  # selection matrices which map the unique points to the output
+  # points
+  S1 = sp.csr_matrix((np.ones(N1),(np.arange(N1),idx1[0])),
+                     (N1,cov1.shape[0]))
+  S2 = sp.csc_matrix((np.ones(N2),(idx1[1],np.arange(N2))),
+                     (cov1.shape[1],N2))
+  # Expand the indices of the stored elements of *cov1*, rather than
+  # their values, so that stored zeros are not dropped. Each output
+  # element comes from at most one stored element, so the indices are
+  # exact
+  cov1 = sp.csr_matrix(cov1)
+  cov1.sum_duplicates()
+  ids = sp.csr_matrix((np.arange(1,cov1.nnz + 1,dtype=float),
+                       cov1.indices,cov1.indptr),cov1.shape)
+  ids = S1.dot(ids).dot(S2).tocoo()
+  data = cov1.data[ids.data.astype(int) - 1]
+  row,col = ids.row,ids.col
+  if sp.issparse(cov2):
+    # only keep the elements that are also stored in *cov2*
+    cov2 = sp.coo_matrix(cov2)
+    stored = np.zeros(cov2.shape,dtype=bool)
+    stored[cov2.row,cov2.col] = True
+    keep = stored[idx2[0][row],idx2[1][col]]
+    data,row,col = data[keep],row[keep],col[keep]
+    cov2 = cov2.toarray()
+
+  data = data*cov2[idx2[0][row],idx2[1][col]]
+  out = sp.csc_matrix((data,(row,col)),(N1,N2),dtype=float)
+  return out
+
+
 def kernel_product(gp1,gp2):
   ''' 
   Returns a GaussianProcess with zero mean and covariance that is the
   product of the two inputs. The first GP must be 1D and the second
   must be 2D.
+
+  The observation points are typically a grid of times and stations.
+  If there are few unique times and positions, then the covariance
+  functions are only evaluated at the unique times and positions, and
+  the output is formed by indexing into the resulting matrices.
   '''
+  # the unique times and positions for the most recent *x2*. When the
+  # covariance matrix is built in chunks, *x2* is the same for each
+  # chunk
+  cache = {'x2':None}
+
   def mean(x,diff):
     return np.zeros(x.shape[0])
 
-  def covariance(x1,x2,diff1,diff2):
+  def direct_covariance(x1,x2,diff1,diff2):
     cov1  = gp1._covariance(x1[:,[0]],x2[:,[0]],
                             diff1[[0]],diff2[[0]])
     cov2  = gp2._covariance(x1[:,[1,2]],x2[:,[1,2]],
@@ -243,10 +644,174 @@ def kernel_product(gp1,gp2):
         out = cov2.multiply(cov1).tocsc()
              
     return out
+
+  def covariance(x1,x2,diff1,diff2):
+    N1,N2 = x1.shape[0],x2.shape[0]
+    if (N1 == 0) | (N2 == 0):
+      return direct_covariance(x1,x2,diff1,diff2)
+
+    # *x2* may be a slice of the cached *x2* when only the upper
+    # triangle of a symmetric matrix is being built
+    offset = _row_offset(x2,cache['x2'])
+    if offset is None:
+      cache['x2'] = x2
+      cache['t2'] = _unique_times(x2)
+      cache['p2'] = _unique_positions(x2)
+      offset = 0
+
+    t1,tidx1 = _unique_times(x1)
+    p1,pidx1 = _unique_positions(x1)
+    t2,tidx2 = cache['t2']
+    p2,pidx2 = cache['p2']
+    tidx2 = tidx2[offset:offset+N2]
+    pidx2 = pidx2[offset:offset+N2]
+    if (len(t1)*len(t2) + len(p1)*len(p2)) >= N1*N2:
+      # there are not enough repeated times or positions for this to
+      # be worthwhile
+      return direct_covariance(x1,x2,diff1,diff2)
+
+    cov1 = gp1._covariance(t1,t2,diff1[[0]],diff2[[0]])
+    cov2 = gp2._covariance(p1,p2,diff1[[1,2]],diff2[[1,2]])
+    return _gather_product(cov1,(tidx1,tidx2),cov2,(pidx1,pidx2))
+
+  out = GaussianProcess(mean,covariance,dim=3)
+  # keep track of the factors so that solvers can exploit the
+  # Kronecker structure of the covariance matrix
+  out._factors = (gp1,gp2)
+  return out
+
   
-  return GaussianProcess(mean,covariance,dim=3)  
+def _neighbor_pairs(x1,x2,radius):
+  ''' 
+  Returns the indices of all pairs of points in *x1* and *x2* which
+  are closer than *radius*. A sorted sweep is used for one-dimensional
+  points, and a KD-tree is used otherwise.
+  '''
+  if x1.shape[1] == 1:
+    order = np.argsort(x2[:,0],kind='mergesort')
+    xs = x2[order,0]
+    lo = np.searchsorted(xs,x1[:,0] - radius,side='right')
+    hi = np.searchsorted(xs,x1[:,0] + radius,side='left')
+    counts = hi - lo
+    rows = np.repeat(np.arange(x1.shape[0]),counts)
+    # position of each pair in the sorted *x2*
+    pos = (np.arange(np.sum(counts)) - 
+           np.repeat(np.cumsum(counts) - counts - lo,counts))
+    cols = order[pos]
+
+  else:
+    pairs = cKDTree(x1).sparse_distance_matrix(cKDTree(x2),radius,
+                                               output_type='ndarray')
+    rows = pairs['i']
+    cols = pairs['j']
+
+  return rows,cols
+
+
+def gpcompact(phi,params,dim,support=1.0,chunk_size=100000):
+  ''' 
+  Returns an isotropic GaussianProcess with a compactly supported
+  covariance function. This is the same as *rbf.gauss.gpiso*, except
+  that the covariance function is only evaluated for pairs of points
+  which are within the support, and the output is always sparse. The
+  cost of building the covariance matrix then scales with the number
+  of non-zeros rather than the number of pairs of points.
+
+  Parameters
+  ----------
+  phi : RBF instance
+    Compactly supported radial basis function (e.g.,
+    *rbf.basis.spwen12*)
+
+  params : 3-tuple
+    Mean, variance, and shape parameter of the GaussianProcess
+
+  dim : int
+    Spatial dimensions of the GaussianProcess
+
+  support : float, optional
+    Support of *phi* divided by the shape parameter. This is 1.0 for
+    the Wendland functions.
+
+  chunk_size : int, optional
+    Maximum number of pairs to evaluate at once
+
+  '''
+  a,b,c = params
+  def mean(x,diff):
+    if sum(diff) == 0:
+      out = np.full(x.shape[0],a,dtype=float)
+    else:
+      out = np.zeros(x.shape[0],dtype=float)
+      
+    return out
+
+  def covariance(x1,x2,diff1,diff2):
+    rows,cols = _neighbor_pairs(x1,x2,support*c)
+    diff = diff1 + diff2
+    coeff = b*(-1)**sum(diff2)
+    origin = np.zeros((1,dim))
+    data = np.empty(len(rows),dtype=float)
+    for start in range(0,len(rows),chunk_size):
+      stop = min(start + chunk_size,len(rows))
+      # evaluate *phi* at the differences between the pairs of points
+      dx = x1[rows[start:stop]] - x2[cols[start:stop]]
+      vals = phi(dx,origin,eps=c,diff=diff)
+      if sp.issparse(vals):
+        vals = vals.toarray()
+      
+      data[start:stop] = coeff*vals[:,0]
+        
+    out = sp.csc_matrix((data,(rows,cols)),(x1.shape[0],x2.shape[0]))
+    return out
+
+  return GaussianProcess(mean,covariance,dim=dim)
 
   
+def log_derivative(gp,derivative):
+  ''' 
+  Returns a *GaussianProcess* whose covariance function is the
+  derivative of the covariance function of *gp* with respect to the
+  log of a hyperparameter. *derivative* describes how the covariance
+  function depends on the hyperparameter (e.g., *AMPLITUDE*). The
+  returned *GaussianProcess* has no basis functions and its covariance
+  function cannot be differentiated.
+  '''
+  a,b,dims = derivative
+  def mean(x,diff):
+    return np.zeros(x.shape[0],dtype=float)
+
+  def covariance(x1,x2,diff1,diff2):
+    if any(diff1) | any(diff2):
+      raise ValueError(
+        'The derivative of the covariance function cannot be '
+        'differentiated')
+
+    diff = np.zeros(x1.shape[1],dtype=int)
+    out = a*gp._covariance(x1,x2,diff,diff)
+    for i in dims:
+      diff_i = np.copy(diff)
+      diff_i[i] = 1
+      dK = gp._covariance(x1,x2,diff_i,diff)
+      # the derivative may not be defined where the points coincide,
+      # but it is multiplied by zero there
+      with np.errstate(invalid='ignore'):
+        if sp.issparse(dK):
+          dK = dK.tocoo()
+          lag = x1[dK.row,i] - x2[dK.col,i]
+          data = np.where(lag == 0.0,0.0,lag*dK.data)
+          term = sp.csc_matrix((data,(dK.row,dK.col)),dK.shape)
+        else:
+          lag = x1[:,i][:,None] - x2[:,i][None,:]
+          term = np.where(lag == 0.0,0.0,lag*dK)
+
+      out = out + b*term
+
+    return out
+
+  return GaussianProcess(mean,covariance,dim=gp.dim)
+
+
 def null():
   '''   
   returns a GaussianProcess with zero mean and covariance and not
@@ -275,6 +840,45 @@ def composite_units(components,constructors):
   return units  
 
 
+def composite_derivatives(components,constructors):
+  ''' 
+  returns the descriptions of how the composite Gaussian process
+  depends on each hyperparameter (see *set_units*)
+  '''
+  components = list(components)
+  try:
+    cs = [constructors[m] for m in components]
+  except KeyError as err:
+    raise ValueError(
+      '"%s" is not a valid Gaussian process. Use Gaussian processes '
+      'from the following list:\n%s' % 
+      (err.args[0],', '.join(['"%s"' % i for i in constructors.keys()])))
+
+  derivatives = []
+  for ci in cs:
+    derivatives += ci.derivatives
+
+  return derivatives
+
+
+def composite_scales(components,args,constructors):
+  ''' 
+  returns the time scale and length scale hyperparameters of the
+  composite Gaussian process as two lists. The time scales are in days
+  and the length scales are in meters
+  '''
+  units = composite_units(components,constructors)
+  derivatives = composite_derivatives(components,constructors)
+  time_scales,length_scales = [],[]
+  for a,u,da in zip(args,units,derivatives):
+    if da == TIME_SCALE:
+      time_scales += [a*conv(u,time='day',space='m')]
+    elif da == LENGTH_SCALE:
+      length_scales += [a*conv(u,time='day',space='m')]
+
+  return time_scales,length_scales
+
+
 def composite(components,args,constructors):
   ''' 
   Returns a composite Gaussian process. The components are specified
@@ -307,11 +911,15 @@ def composite(components,args,constructors):
       '%s parameters were specified for the model "%s", but it '
       'requires %s parameters.\n' %(len(args),' '.join(components),nargs))
   
+  gps = [ci(*(args.pop(0) for i in range(ci.nargs))) for ci in cs]
   gp = null()
-  for ci in cs:
-    gp += ci(*(args.pop(0) for i in range(ci.nargs)))
+  for gpi in gps:
+    gp += gpi
   
   gp._covariance = chunkify_covariance(gp._covariance,1000)
+  # keep track of the components so that solvers can exploit their
+  # structure
+  gp._components = gps
   return gp
   
 
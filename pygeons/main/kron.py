@@ -0,0 +1,751 @@
+''' 
+Module for solving systems of equations involving covariance matrices
+with Kronecker structure.
+
+When data are on a complete (or nearly complete) grid of times and
+stations, the covariance matrix of the network process is the
+Kronecker product of a temporal and a spatial covariance matrix. The
+station process and the observation noise can then be absorbed into
+a generalized eigendecomposition so that the full covariance matrix
+never needs to be formed. Deviations from this structure (missing
+data and observation noise which differs between stations) are
+handled with a low rank correction.
+
+When there is no network process, the covariance matrix is block
+diagonal with one block per station, and stations with the same
+missing data pattern and constant noise variances share a
+factorization.
+'''
+import numpy as np
+import scipy.sparse as sp
+import logging
+from scipy.linalg import (cholesky,
+                          cho_factor,
+                          cho_solve,
+                          solve_triangular,
+                          eigh)
+from pygeons.main.gptools import station_basis
+logger = logging.getLogger(__name__)
+
+# An eigendecomposition costs about as much as this many Cholesky
+# factorizations. The *StationBlockSolver* shares an eigendecomposition
+# between stations when it replaces more Cholesky factorizations than
+# this
+_EIG_COST = 20
+
+
+def _kron_dot(A,B,x):
+  ''' 
+  Returns kron(A,B).dot(x). The rows of *x* are ordered such that the
+  index for *B* varies the fastest, which is consistent with
+  flattening a (time, station) array. *x* can be one or
+  two-dimensional.
+  '''
+  Ma,Na = A.shape
+  Mb,Nb = B.shape
+  X = x.reshape((Na,Nb,-1))
+  out = np.tensordot(A,X,axes=(1,0)) # (Ma,Nb,k)
+  out = np.tensordot(out,B,axes=(1,1)) # (Ma,k,Mb)
+  out = out.transpose((0,2,1))
+  return out.reshape((Ma*Mb,) + x.shape[1:])
+
+
+def _as_dense(A):
+  '''convert *A* to a dense array if it is sparse'''
+  if sp.issparse(A):
+    return A.toarray()
+  else:
+    return np.asarray(A)
+
+
+def kronecker_factors(gp):
+  ''' 
+  Returns the temporal and spatial *GaussianProcess* factors of a
+  network *GaussianProcess* if it consists of a single kernel product.
+  Otherwise, returns None.
+  '''
+  components = getattr(gp,'_components',None)
+  if components is None:
+    return None
+
+  if len(components) != 1:
+    return None
+
+  return getattr(components[0],'_factors',None)
+
+
+class KroneckerSolver(object):
+  ''' 
+  Solves systems of equations involving the covariance matrix
+
+    C = kron(Kt,Kx) + kron(St,I) + D
+
+  restricted to the unmasked data. *Kt* and *Kx* are the temporal and
+  spatial covariance matrices for the network process, *St* is the
+  temporal covariance matrix for the station process, and *D* is a
+  diagonal matrix of observation noise variances.
+
+  The observation noise is split into a baseline component, which is
+  the smallest variance for each day, and an excess component. The
+  baseline component is absorbed into *St* and the generalized
+  eigendecomposition of *Kt* and *St* is combined with the
+  eigendecomposition of *Kx* to diagonalize the covariance matrix.
+  The excess noise and the missing data (which have infinite excess
+  noise) are then accounted for with the Woodbury identity.
+
+  Parameters
+  ----------
+  Kt : (Nt,Nt) array or sparse matrix
+
+  Kx : (Nx,Nx) array or sparse matrix
+
+  St : (Nt,Nt) array or sparse matrix
+
+  sd : (Nt,Nx) array
+    Standard deviation of the observation noise. Missing data should
+    have an infinite standard deviation.
+
+  chunk_size : int, optional
+    Number of columns processed at once when evaluating the low rank
+    correction.
+
+  '''
+  def __init__(self,Kt,Kx,St,sd,chunk_size=100):
+    logger.debug('Building Kronecker solver ...')
+    Kt = _as_dense(Kt)
+    Kx = _as_dense(Kx)
+    St = _as_dense(St)
+    var = np.asarray(sd,dtype=float)**2
+    Nt,Nx = var.shape
+    mask = np.isinf(var)
+    if np.all(mask):
+      raise ValueError('There are no unmasked data')
+
+    # the baseline noise is the smallest variance for each day. Days
+    # without any data are given the median baseline variance. This
+    # choice does not affect the solution.
+    base = np.min(var,axis=1)
+    empty = np.isinf(base)
+    base[empty] = np.median(base[~empty])
+    excess = var - base[:,None]
+    # indices of the data that need a correction
+    corr = mask | (excess > 1e-10*base[:,None])
+    self.idx, = np.nonzero(corr.ravel())
+    excess = excess.ravel()[self.idx]
+    # inverse of the excess variance, which is zero for missing data
+    self.excess_inv = 1.0/excess
+    # log determinant of the excess noise that is not infinite
+    excess_logdet = np.sum(np.log(excess[~np.isinf(excess)]))
+    # generalized eigendecomposition of Kt and St + diag(base)
+    L = cholesky(St + np.diag(base),lower=True)
+    M = solve_triangular(L,Kt,lower=True)
+    M = solve_triangular(L,M.T,lower=True)
+    gam,Q = eigh(M)
+    gam[gam < 0.0] = 0.0
+    # Vt satisfies Vt.T.dot(St + diag(base)).dot(Vt) = I and
+    # Vt.T.dot(Kt).dot(Vt) = diag(gam)
+    self.Vt = solve_triangular(L,Q,lower=True,trans='T')
+    lam,self.U = eigh(Kx)
+    lam[lam < 0.0] = 0.0
+    self.G = 1.0 + gam[:,None]*lam[None,:]
+    self.mask = mask
+    self.chunk_size = chunk_size
+    self.Nt,self.Nx = Nt,Nx
+    logdet = (2*Nx*np.sum(np.log(np.diag(L))) +
+              np.sum(np.log(self.G)))
+    # build the capacitance matrix for the low rank correction
+    h = self.idx.shape[0]
+    if h > 0:
+      logger.debug('Correcting for %s missing or heteroscedastic data' % h)
+      cap = np.zeros((h,h))
+      for start in range(0,h,chunk_size):
+        stop = min(start+chunk_size,h)
+        cols = np.zeros((Nt*Nx,stop-start))
+        cols[self.idx[start:stop],np.arange(stop-start)] = 1.0
+        cap[:,start:stop] = self._base_solve(cols)[self.idx]
+
+      cap[range(h),range(h)] += self.excess_inv
+      self.cap_chol = cholesky(cap,lower=True)
+      logdet += (excess_logdet +
+                 2*np.sum(np.log(np.diag(self.cap_chol))))
+
+    else:
+      self.cap_chol = np.zeros((0,0))
+
+    self._log_det = logdet
+    logger.debug('Done')
+
+  def _base_solve(self,b):
+    ''' 
+    Solves the system of equations for the covariance matrix with only
+    the baseline noise. *b* is defined at all Nt*Nx points.
+    '''
+    out = _kron_dot(self.Vt.T,self.U.T,b)
+    out = out.reshape((self.Nt,self.Nx,-1))/self.G[:,:,None]
+    out = out.reshape(b.shape)
+    out = _kron_dot(self.Vt,self.U,out)
+    return out
+
+  def _full_solve(self,b):
+    ''' 
+    Solves the system of equations where *b* is defined at all Nt*Nx
+    points. The output is zero at the masked points.
+    '''
+    out = self._base_solve(b)
+    if self.idx.shape[0] == 0:
+      return out
+
+    c = solve_triangular(self.cap_chol,out[self.idx],lower=True)
+    c = solve_triangular(self.cap_chol,c,lower=True,trans='T')
+    cols = np.zeros((self.Nt*self.Nx,) + b.shape[1:])
+    cols[self.idx] = c
+    out -= self._base_solve(cols)
+    return out
+
+  def expand(self,b):
+    ''' 
+    Expands *b*, which is defined at the unmasked points, to all Nt*Nx
+    points. The masked points are set to zero.
+    '''
+    out = np.zeros((self.Nt*self.Nx,) + b.shape[1:])
+    out[~self.mask.ravel()] = b
+    return out
+
+  def solve(self,b,expand=False):
+    ''' 
+    Solves the system of equations for the unmasked data. If *expand*
+    is True then the solution is returned at all Nt*Nx points, where
+    the masked points are zero.
+    '''
+    out = self._full_solve(self.expand(_as_dense(b)))
+    if expand:
+      return out
+    else:
+      return out[~self.mask.ravel()]
+
+  def log_det(self):
+    ''' 
+    Returns the log determinant of the covariance matrix for the
+    unmasked data
+    '''
+    return self._log_det
+
+  def quad_diag(self,A=None,B=None):
+    ''' 
+    Returns the diagonal of K.dot(inv(C)).dot(K.T), where K =
+    kron(A,B) and the columns of *K* for the masked data are ignored.
+    If *A* and *B* are not given then this returns the diagonals of
+    inv(C) at the unmasked data.
+    '''
+    if (A is None) & (B is None):
+      A = np.eye(self.Nt)
+      B = np.eye(self.Nx)
+      identity = True
+    else:
+      identity = False
+
+    AV = A.dot(self.Vt)
+    BU = B.dot(self.U)
+    out = (AV**2).dot(1.0/self.G).dot((BU**2).T).ravel()
+    # subtract the low rank correction in chunks
+    h = self.idx.shape[0]
+    for start in range(0,h,self.chunk_size):
+      stop = min(start+self.chunk_size,h)
+      cols = np.zeros((h,stop-start))
+      cols[range(start,stop),range(stop-start)] = 1.0
+      cols = solve_triangular(self.cap_chol,cols,lower=True,trans='T')
+      full_cols = np.zeros((self.Nt*self.Nx,stop-start))
+      full_cols[self.idx] = cols
+      full_cols = self._base_solve(full_cols)
+      if not identity:
+        full_cols = _kron_dot(A,B,full_cols)
+
+      out -= np.sum(full_cols**2,axis=1)
+
+    if identity:
+      out = out[~self.mask.ravel()]
+
+    return out
+
+
+class StationBlockSolver(object):
+  ''' 
+  Solves systems of equations involving the covariance matrix
+
+    C = kron(St,I) + D
+
+  restricted to the unmasked data, where *St* is the temporal
+  covariance matrix for the station process and *D* is a diagonal
+  matrix of observation noise variances. This is the covariance
+  matrix when there is no network process.
+
+  *C* is block diagonal with one block for each station, which is
+  *St* restricted to the station's unmasked data plus the station's
+  noise variances. The stations are grouped by their missing data
+  pattern. If there are many stations in a group whose unmasked data
+  have a constant noise variance, then they share an
+  eigendecomposition of the restricted *St*, which gives the inverse
+  for any constant variance. Stations in a group with the same
+  constant variance share a Cholesky factorization. Every other
+  station is factored separately.
+
+  This has the same interface as *KroneckerSolver*, except that
+  *quad_diag* can only return the diagonals of inv(C).
+
+  Parameters
+  ----------
+  St : (Nt,Nt) array or sparse matrix
+
+  sd : (Nt,Nx) array
+    Standard deviation of the observation noise. Missing data should
+    have an infinite standard deviation.
+
+  chunk_size : int, optional
+    Number of columns processed at once by
+    *PartitionedKroneckerSolver.quad_diag*.
+
+  '''
+  def __init__(self,St,sd,chunk_size=100):
+    logger.debug('Building station block solver ...')
+    St = _as_dense(St)
+    var = np.asarray(sd,dtype=float)**2
+    Nt,Nx = var.shape
+    mask = np.isinf(var)
+    if np.all(mask):
+      raise ValueError('There are no unmasked data')
+
+    Nu = np.sum(~mask)
+    idx_map = np.full((Nt,Nx),-1,dtype=int)
+    idx_map[~mask] = np.arange(Nu)
+    # group the stations by their missing data pattern
+    groups = {}
+    keys = []
+    for j in range(Nx):
+      if np.all(mask[:,j]):
+        continue
+
+      key = mask[:,j].tobytes()
+      if key not in groups:
+        groups[key] = []
+        keys.append(key)
+
+      groups[key].append(j)
+
+    # Cholesky factorizations and the indices of the unmasked data for
+    # the stations which share them
+    self.blocks = []
+    # eigenvectors, the shifted eigenvalues for each station, and the
+    # indices of the unmasked data for the stations which share them
+    self.eig_blocks = []
+    self._log_det = 0.0
+    for key in keys:
+      stations = groups[key]
+      tidx, = np.nonzero(~mask[:,stations[0]])
+      S = St[np.ix_(tidx,tidx)]
+      v = var[np.ix_(tidx,stations)]
+      didx = idx_map[np.ix_(tidx,stations)]
+      # stations whose unmasked data have a constant noise variance
+      const = np.all(v == v[[0]],axis=0)
+      levels = np.unique(v[0,const])
+      if len(levels) > _EIG_COST:
+        self._add_eig_block(S,v[0,const],didx[:,const])
+      else:
+        for level in levels:
+          cols = const & (v[0] == level)
+          self._add_block(S,v[:,cols][:,0],didx[:,cols])
+
+      for k in np.nonzero(~const)[0]:
+        self._add_block(S,v[:,k],didx[:,[k]])
+
+    logger.debug('Factored %s blocks and computed %s '
+                 'eigendecompositions for %s stations' %
+                 (len(self.blocks),len(self.eig_blocks),
+                  sum(len(groups[k]) for k in keys)))
+    self.mask = mask
+    self.chunk_size = chunk_size
+    self.Nt,self.Nx,self.Nu = Nt,Nx,Nu
+    logger.debug('Done')
+
+  def _add_block(self,S,v,didx):
+    ''' 
+    Factors *S* plus the noise variances *v* for the stations whose
+    data are at the columns of *didx*
+    '''
+    factor = cho_factor(S + np.diag(v),lower=True)
+    self._log_det += 2*didx.shape[1]*np.sum(np.log(np.diag(factor[0])))
+    self.blocks.append((factor,didx))
+
+  def _add_eig_block(self,S,v,didx):
+    ''' 
+    Computes the eigendecomposition of *S*, which is shared by the
+    stations whose data are at the columns of *didx* and have the
+    constant noise variances *v*
+    '''
+    lam,Q = eigh(S)
+    # eigenvalues of the block for each station
+    shifted = lam[:,None] + v[None,:]
+    if np.any(shifted <= 0.0):
+      raise np.linalg.LinAlgError(
+        'The station covariance matrix is not positive definite')
+
+    self._log_det += np.sum(np.log(shifted))
+    self.eig_blocks.append((Q,shifted,didx))
+
+  def expand(self,b):
+    ''' 
+    Expands *b*, which is defined at the unmasked points, to all Nt*Nx
+    points. The masked points are set to zero.
+    '''
+    out = np.zeros((self.Nt*self.Nx,) + b.shape[1:])
+    out[~self.mask.ravel()] = b
+    return out
+
+  def _dense_solve(self,b):
+    out = np.empty(b.shape)
+    for factor,didx in self.blocks:
+      n,s = didx.shape
+      # solve for all stations in the group at once
+      rhs = b[didx].reshape((n,-1))
+      out[didx] = cho_solve(factor,rhs).reshape((n,s) + b.shape[1:])
+
+    for Q,shifted,didx in self.eig_blocks:
+      n,s = didx.shape
+      rhs = b[didx].reshape((n,-1))
+      coeff = Q.T.dot(rhs).reshape((n,s) + b.shape[1:])
+      coeff /= shifted.reshape((n,s) + (1,)*(b.ndim - 1))
+      out[didx] = Q.dot(coeff.reshape((n,-1))).reshape((n,s) + b.shape[1:])
+
+    return out
+
+  def _sparse_solve(self,b):
+    # only solve for the columns of *b* which are non-zero for each
+    # station, which is efficient for the station basis vectors
+    b = sp.csr_matrix(b)
+    out = np.zeros(b.shape)
+    for factor,didx in self.blocks:
+      for k in range(didx.shape[1]):
+        rows = didx[:,k]
+        sub = b[rows]
+        cols = np.unique(sub.indices)
+        if cols.shape[0] == 0:
+          continue
+
+        out[np.ix_(rows,cols)] = cho_solve(factor,sub[:,cols].toarray())
+
+    for Q,shifted,didx in self.eig_blocks:
+      for k in range(didx.shape[1]):
+        rows = didx[:,k]
+        sub = b[rows]
+        cols = np.unique(sub.indices)
+        if cols.shape[0] == 0:
+          continue
+
+        coeff = Q.T.dot(sub[:,cols].toarray())/shifted[:,[k]]
+        out[np.ix_(rows,cols)] = Q.dot(coeff)
+
+    return out
+
+  def solve(self,b,expand=False):
+    ''' 
+    Solves the system of equations for the unmasked data. *b* can be
+    an array or a sparse matrix. If *expand* is True then the solution
+    is returned at all Nt*Nx points, where the masked points are zero.
+    '''
+    if sp.issparse(b):
+      out = self._sparse_solve(b)
+    else:
+      out = self._dense_solve(np.asarray(b,dtype=float))
+
+    if expand:
+      return self.expand(out)
+    else:
+      return out
+
+  def log_det(self):
+    ''' 
+    Returns the log determinant of the covariance matrix for the
+    unmasked data
+    '''
+    return self._log_det
+
+  def quad_diag(self,A=None,B=None):
+    ''' 
+    Returns the diagonals of inv(C) at the unmasked data. *A* and *B*
+    must be None.
+    '''
+    if (A is not None) | (B is not None):
+      raise ValueError(
+        'The station block solver can only compute the diagonals of '
+        'the inverse covariance matrix')
+
+    out = np.empty(self.Nu)
+    for factor,didx in self.blocks:
+      n = didx.shape[0]
+      Linv = solve_triangular(np.tril(factor[0]),np.eye(n),lower=True)
+      out[didx] = np.sum(Linv**2,axis=0)[:,None]
+
+    for Q,shifted,didx in self.eig_blocks:
+      out[didx] = (Q**2).dot(1.0/shifted)
+
+    return out
+
+
+class PartitionedKroneckerSolver(object):
+  ''' 
+  Solves the system of equations
+
+    | C   P | | x |   | a |
+    | P.T 0 | | y | = | b |
+
+  where *C* is described by a *KroneckerSolver* or a
+  *StationBlockSolver*. This has the same interface as
+  *rbf.gauss._PartitionedPosDefSolver*.
+
+  Parameters
+  ----------
+  Csolver : KroneckerSolver or StationBlockSolver
+
+  P : (Nu,M) array or sparse matrix
+
+  '''
+  def __init__(self,Csolver,P):
+    self.Csolver = Csolver
+    self.P = P
+    if P.shape[1] == 0:
+      # there are no basis vectors, so the partitioned system is just C
+      self.CiP = np.zeros(P.shape)
+      self.H_factor = None
+      self.H_chol = None
+      return
+
+    # inv(C).dot(P)
+    self.CiP = Csolver.solve(P)
+    H = P.T.dot(self.CiP)
+    self.H_factor = cho_factor(H,lower=True)
+    self.H_chol = np.tril(self.H_factor[0])
+
+  def solve(self,a,b):
+    ''' 
+    Returns *x* and *y* for the given *a* and *b*
+    '''
+    Cia = self.Csolver.solve(a)
+    if self.H_factor is None:
+      return Cia,np.zeros((0,) + Cia.shape[1:])
+
+    y = cho_solve(self.H_factor,self.P.T.dot(Cia) - b)
+    x = Cia - self.CiP.dot(y)
+    return x,y
+
+  def quad_diag(self,A=None,B=None):
+    ''' 
+    Returns the diagonal of K.dot(M).dot(K.T), where K = kron(A,B)
+    and *M* is the upper left block of the inverse of the partitioned
+    matrix. If *A* and *B* are not given then this returns the
+    diagonals of *M* at the unmasked data.
+    '''
+    out = self.Csolver.quad_diag(A,B)
+    if self.H_factor is None:
+      return out
+
+    # inv(C).dot(P).dot(inv(L_H).T) where L_H is the Cholesky
+    # decomposition of P.T.dot(inv(C)).dot(P)
+    W = solve_triangular(self.H_chol,self.CiP.T,lower=True).T
+    chunk_size = self.Csolver.chunk_size
+    for start in range(0,W.shape[1],chunk_size):
+      stop = min(start+chunk_size,W.shape[1])
+      if (A is None) & (B is None):
+        KW = W[:,start:stop]
+      else:
+        KW = _kron_dot(A,B,self.Csolver.expand(W[:,start:stop]))
+
+      out -= np.sum(KW**2,axis=1)
+
+    return out
+
+  def log_det_H(self):
+    ''' 
+    Returns the log determinant of P.T.dot(inv(C)).dot(P)
+    '''
+    if self.H_chol is None:
+      return 0.0
+
+    return 2*np.sum(np.log(np.diag(self.H_chol)))
+
+
+def kronecker_likelihood(d,solver):
+  ''' 
+  Returns the restricted log likelihood of the data *d* given a
+  *PartitionedKroneckerSolver*. The basis vectors should be
+  orthonormal, so that this is consistent with *rbf.gauss.likelihood*.
+  '''
+  n,m = solver.P.shape
+  Cid = solver.Csolver.solve(d)
+  out = -0.5*(solver.Csolver.log_det() +
+              solver.log_det_H() +
+              d.dot(Cid) +
+              (n-m)*np.log(2*np.pi))
+  if solver.H_factor is not None:
+    Pd = solver.P.T.dot(Cid)
+    out += 0.5*Pd.dot(cho_solve(solver.H_factor,Pd))
+
+  return out
+
+
+def _station_basis(p_i,mask,structure):
+  ''' 
+  Returns the station basis vectors, using *structure* if it is given
+  '''
+  if structure is None:
+    return station_basis(p_i,mask)
+  else:
+    return structure.basis(p_i)
+
+
+def _station_block_covariance(sta_gp,t,sd):
+  ''' 
+  Returns the station covariance matrix if a *StationBlockSolver* can
+  be used, and None otherwise. It cannot be used if there are no
+  unmasked data or if the station covariance matrix is sparse, in
+  which case the sparse solver is more efficient.
+  '''
+  Nt,Nx = sd.shape
+  if np.all(np.isinf(sd)):
+    return None
+
+  St = sta_gp._covariance(t,t,np.array([0]),np.array([0]))
+  if sp.issparse(St):
+    if St.nnz < 0.5*Nt**2:
+      logger.debug('The station covariance matrix is sparse')
+      return None
+
+  return St
+
+
+def _station_block_solver(sta_gp,t,sd,structure=None):
+  ''' 
+  Builds a *PartitionedKroneckerSolver* with a *StationBlockSolver*.
+  Returns None if the station block solver cannot be used (see
+  *_station_block_covariance*).
+  '''
+  St = _station_block_covariance(sta_gp,t,sd)
+  if St is None:
+    return None
+
+  logger.debug('Using the station block solver')
+  mask = np.isinf(sd)
+  p_i = sta_gp._basis(t,np.array([0]))
+  Csolver = StationBlockSolver(St,sd)
+  P = _station_basis(p_i,mask,structure)
+  return PartitionedKroneckerSolver(Csolver,P)
+
+
+def kronecker_applicable(net_gp,sta_gp,t,sd,max_corrections=5000):
+  ''' 
+  Returns True if *kronecker_solver* would build a solver for these
+  processes. This does not build or factor any matrices, except for
+  the station covariance matrix when there is no network process.
+  See *kronecker_solver* for a description of the arguments.
+  '''
+  if len(getattr(net_gp,'_components',[None])) == 0:
+    return _station_block_covariance(sta_gp,t,sd) is not None
+
+  if kronecker_factors(net_gp) is None:
+    logger.debug('The network process does not have Kronecker '
+                 'structure')
+    return False
+
+  z = np.zeros((1,3))
+  if net_gp._basis(z,np.array([0,0,0])).shape[1] != 0:
+    logger.debug('The network process has basis functions')
+    return False
+
+  Nt,Nx = sd.shape
+  var = sd**2
+  mask = np.isinf(var)
+  Nu = np.sum(~mask)
+  if Nu == 0:
+    return False
+
+  # count the number of corrections that need to be made
+  h = _correction_count(sd)
+  if h > max_corrections:
+    logger.debug('There are too many missing or heteroscedastic data '
+                 '(%s) for the Kronecker solver' % h)
+    return False
+
+  # compare the approximate cost of the Kronecker solver to the cost
+  # of a dense Cholesky decomposition
+  Np = sta_gp._basis(t[:1],np.array([0])).shape[1]
+  kron_cost = (Nt**3 + Nx**3 + h**3 +
+               (h + Nx*Np)*Nt*Nx*(Nt + Nx))
+  dense_cost = Nu**3/3.0
+  if kron_cost > dense_cost:
+    logger.debug('The Kronecker solver is not expected to be faster '
+                 'than a dense solver')
+    return False
+
+  return True
+
+
+def _correction_count(sd):
+  ''' 
+  Returns the number of missing and heteroscedastic data, which are
+  handled with a low rank correction in the *KroneckerSolver*
+  '''
+  var = sd**2
+  mask = np.isinf(var)
+  base = np.min(var,axis=1)
+  base[np.isinf(base)] = 0.0
+  return np.sum(mask | ((var - base[:,None]) > 1e-10*base[:,None]))
+
+
+def kronecker_solver(net_gp,sta_gp,t,x,sd,max_corrections=5000,
+                     structure=None):
+  ''' 
+  Attempts to build a *PartitionedKroneckerSolver* for the covariance
+  matrix of the network process *net_gp*, the station process
+  *sta_gp* and the observation noise. Returns None if the network
+  process does not have Kronecker structure or if there are too many
+  missing or heteroscedastic data for the solver to be efficient (see
+  *kronecker_applicable*). If there is no network process then the
+  solver uses a *StationBlockSolver*.
+
+  Parameters
+  ----------
+  net_gp : GaussianProcess
+    Network Gaussian process built with *composite*.
+
+  sta_gp : GaussianProcess
+    Station Gaussian process built with *composite*.
+
+  t : (Nt,1) array
+
+  x : (Nx,2) array
+
+  sd : (Nt,Nx) array
+
+  max_corrections : int, optional
+    Maximum number of missing and heteroscedastic data which can be
+    handled with the low rank correction.
+
+  structure : StationStructure, optional
+    Used to reuse the station basis vectors between calls.
+
+  '''
+  if len(getattr(net_gp,'_components',[None])) == 0:
+    # the station covariance matrix is only built once
+    return _station_block_solver(sta_gp,t,sd,structure)
+
+  if not kronecker_applicable(net_gp,sta_gp,t,sd,max_corrections):
+    return None
+
+  logger.debug('Using the Kronecker solver')
+  mask = np.isinf(sd)
+  tgp,sgp = kronecker_factors(net_gp)
+  Kt = tgp._covariance(t,t,np.array([0]),np.array([0]))
+  Kx = sgp._covariance(x,x,np.array([0,0]),np.array([0,0]))
+  St = sta_gp._covariance(t,t,np.array([0]),np.array([0]))
+  p_i = sta_gp._basis(t,np.array([0]))
+  Csolver = KroneckerSolver(Kt,Kx,St,sd)
+  P = _station_basis(p_i,mask,structure)
+  return PartitionedKroneckerSolver(Csolver,P)
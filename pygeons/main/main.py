@@ -5,17 +5,27 @@ PyGeoNS executable.
 from __future__ import division
 import numpy as np
 import logging
+import itertools
+import json
+import h5py
 import subprocess as sp
+from multiprocessing.sharedctypes import RawArray
 from pygeons.main.fit import fit
 from pygeons.main.reml import reml
 from pygeons.main.strain import strain
 from pygeons.main.autoclean import autoclean
-from pygeons.main.gptools import composite_units
+from pygeons.main.prescreen import prescreen
+from pygeons.main.gptools import (composite_units,
+                                  composite_scales)
+from pygeons.main.tiling import (station_clusters,
+                                 make_tiles)
+from pygeons.main.factor import FactorizationContext
 from pygeons.main import gpnetwork
 from pygeons.main import gpstation
 from pygeons.mjd import mjd_inv,mjd
 from pygeons.basemap import make_basemap
 from pygeons.io.convert import dict_from_hdf5,hdf5_from_dict
+from pygeons.mp import parmap
 logger = logging.getLogger(__name__)
 
 
@@ -60,6 +70,306 @@ def _params_dict(b):
   return out
 
 
+def _shared_directions(dirs,data,*params):
+  ''' 
+  Groups the directions in *dirs* which have the same data
+  uncertainties and the same hyperparameters in each of the
+  dictionaries in *params*. The data for each group can be processed
+  together so that the covariance matrix is only factored once.
+  Returns a list of lists of directions.
+  '''
+  groups = []
+  for dir in dirs:
+    for group in groups:
+      ref = group[0]
+      if (np.array_equal(data[dir+'_std_dev'],data[ref+'_std_dev']) &
+          all(np.array_equal(p[dir],p[ref]) for p in params)):
+        group.append(dir)
+        break
+
+    else:
+      groups.append([dir])
+
+  for group in groups:
+    if len(group) > 1:
+      logger.info('Processing %s together because they have the same '
+                  'hyperparameters and uncertainties' % ', '.join(group))
+
+  return groups
+
+
+def _call(args):
+  '''evaluate the function *args[0]* with the keyword arguments *args[1]*'''
+  func,kwargs = args
+  return func(**kwargs)
+
+
+def _run(func,kwargs_list,workers):
+  ''' 
+  Returns a list of *func* evaluated with each dictionary of keyword
+  arguments in *kwargs_list*. If *workers* is greater than zero then
+  the evaluations are distributed between that many worker processes.
+  '''
+  workers = min(workers,len(kwargs_list))
+  if workers > 0:
+    logger.info('Distributing %s tasks between %s worker processes' %
+                (len(kwargs_list),workers))
+
+  return parmap(_call,[(func,k) for k in kwargs_list],workers=workers)
+
+
+# Data which are shared with the worker processes that evaluate the
+# REML likelihood surface. This is filled in before the worker
+# processes are forked, so that the workers inherit the data instead
+# of receiving a copy through the task queue.
+_SHARED = {}
+
+
+def _shared_array(a):
+  ''' 
+  Returns a copy of the float array *a* which is stored in shared
+  memory
+  '''
+  a = np.asarray(a,dtype=float)
+  buf = RawArray('d',max(a.size,1))
+  out = np.frombuffer(buf,dtype=float)[:a.size].reshape(a.shape)
+  out[...] = a
+  return out
+
+
+def _reml_surface_task(args):
+  ''' 
+  Evaluates *reml* for one direction and one point on the likelihood
+  surface. *args* contains the direction, the network and station
+  hyperparameters, and whether to optimize the hyperparameters. The
+  data and the other arguments are read from *_SHARED*.
+  '''
+  dir,network_params,station_params,optimize = args
+  return reml(t=_SHARED['time'],
+              x=_SHARED['xy'],
+              d=_SHARED[dir],
+              sd=_SHARED[dir+'_std_dev'],
+              network_params=network_params,
+              station_params=station_params,
+              factorization=_SHARED['factorization'],
+              optimize=optimize,
+              **_SHARED['kwargs'])
+
+
+def _reml_points(network_params,network_fix,
+                 station_params,station_fix,
+                 starts_file,grid_size,grid_width):
+  ''' 
+  Returns the points on the REML likelihood surface for each
+  direction. The points are either read from *starts_file*, which
+  contains the network hyperparameters followed by the station
+  hyperparameters on each row, or they are a log-spaced grid with
+  *grid_size* values for each free hyperparameter, spanning
+  *grid_width* orders of magnitude about the initial guess. Returns a
+  dictionary with an array of network hyperparameters and an array of
+  station hyperparameters for each direction.
+  '''
+  if starts_file is not None:
+    starts = np.loadtxt(starts_file,dtype=float,ndmin=2)
+
+  out = {}
+  for dir in ['east','north','vertical']:
+    n = len(network_params[dir])
+    params = np.hstack((network_params[dir],station_params[dir]))
+    if starts_file is not None:
+      if starts.shape[1] != len(params):
+        raise ValueError(
+          'each row of the starts file must contain %s network '
+          'hyperparameters followed by %s station hyperparameters' %
+          (n,len(params) - n))
+
+      points = starts
+
+    else:
+      fix = np.hstack((network_fix,station_fix + n))
+      scales = 10**np.linspace(-0.5*grid_width,0.5*grid_width,grid_size)
+      axes = [params[[i]] if i in fix else params[i]*scales
+              for i in range(len(params))]
+      points = np.array(list(itertools.product(*axes)),dtype=float)
+      points = points.reshape((-1,len(params)))
+
+    out[dir] = (points[:,:n],points[:,n:])
+
+  return out
+
+
+def _reml_surface(data,xy,
+                  network_model,network_params,network_fix,
+                  station_model,station_params,station_fix,
+                  starts_file,grid_size,grid_width,
+                  vecchia_neighbors,workers):
+  ''' 
+  Evaluates the REML likelihood surface for each direction. If
+  *starts_file* is given then the hyperparameters are optimized
+  starting from each point in the file. Otherwise, the likelihood is
+  evaluated on a log-spaced grid, and the hyperparameters are
+  optimized starting from the best point on the grid. The points are
+  distributed between *workers* worker processes, which share the
+  data.
+
+  Returns a dictionary describing the surface for each direction, and
+  dictionaries of the optimal network hyperparameters, station
+  hyperparameters, log likelihoods, and optimizer states.
+  '''
+  dirs = ['east','north','vertical']
+  points = _reml_points(network_params,network_fix,
+                        station_params,station_fix,
+                        starts_file,grid_size,grid_width)
+  _SHARED.clear()
+  _SHARED['time'] = _shared_array(data['time'][:,None])
+  _SHARED['xy'] = _shared_array(xy)
+  for dir in dirs:
+    _SHARED[dir] = _shared_array(data[dir])
+    _SHARED[dir+'_std_dev'] = _shared_array(data[dir+'_std_dev'])
+
+  _SHARED['kwargs'] = dict(network_model=network_model,
+                           network_fix=network_fix,
+                           station_model=station_model,
+                           station_fix=station_fix,
+                           vecchia_neighbors=vecchia_neighbors)
+  # each worker process gets its own copy of the factorization context
+  _SHARED['factorization'] = FactorizationContext()
+  # optimize from each starting point, or just evaluate the likelihood
+  # at each grid point
+  optimize = starts_file is not None
+  tasks = [(dir,net,sta,optimize)
+           for dir in dirs
+           for net,sta in zip(*points[dir])]
+  logger.info('Evaluating the likelihood surface at %s points for '
+              'each direction' % (len(tasks)//len(dirs)))
+  solns = parmap(_reml_surface_task,tasks,
+                 workers=min(workers,len(tasks)))
+  surface = {}
+  best = {}
+  for dir in dirs:
+    sub = [soln for task,soln in zip(tasks,solns) if task[0] == dir]
+    like = np.array([soln[2] for soln in sub],dtype=float)
+    surface[dir] = {'initial_network_params':points[dir][0],
+                    'initial_station_params':points[dir][1],
+                    'network_params':np.array([soln[0] for soln in sub]),
+                    'station_params':np.array([soln[1] for soln in sub]),
+                    'likelihood':like}
+    best[dir] = sub[np.argmax(np.where(np.isnan(like),-np.inf,like))]
+
+  if not optimize:
+    # optimize the hyperparameters starting from the best grid point
+    tasks = [(dir,best[dir][0],best[dir][1],True) for dir in dirs]
+    solns = parmap(_reml_surface_task,tasks,
+                   workers=min(workers,len(tasks)))
+    best = dict(zip(dirs,solns))
+
+  _SHARED.clear()
+  opt_network_params = dict((dir,best[dir][0]) for dir in dirs)
+  opt_station_params = dict((dir,best[dir][1]) for dir in dirs)
+  opt_likelihood = dict((dir,best[dir][2]) for dir in dirs)
+  opt_state = dict((dir,best[dir][3]) for dir in dirs)
+  return (surface,opt_network_params,opt_station_params,opt_likelihood,
+          opt_state)
+
+
+def _write_reml_surface(output_file,surface,
+                        network_model,network_params,network_fix,
+                        station_model,station_params,station_fix,
+                        likelihood):
+  ''' 
+  Writes the REML likelihood surface and the optimal hyperparameters
+  for each direction to an HDF5 file
+  '''
+  fout = h5py.File(output_file,'w')
+  fout.attrs['network_model'] = ' '.join(network_model)
+  fout.attrs['network_fix'] = np.asarray(network_fix,dtype=int)
+  fout.attrs['station_model'] = ' '.join(station_model)
+  fout.attrs['station_fix'] = np.asarray(station_fix,dtype=int)
+  for dir in ['east','north','vertical']:
+    group = fout.create_group(dir)
+    for k,v in surface[dir].items():
+      group[k] = v
+
+    group['optimal_network_params'] = network_params[dir]
+    group['optimal_station_params'] = station_params[dir]
+    group.attrs['optimal_likelihood'] = likelihood[dir]
+
+  fout.close()
+  return
+
+
+def _write_reml_json(output_file,input_file,
+                     network_model,network_params,network_fix,
+                     station_model,station_params,station_fix,
+                     likelihood,state):
+  ''' 
+  Writes the REML results, including the final state of the optimizer
+  for each direction, to a JSON file which can be read by
+  *_read_reml_json*
+  '''
+  def tolist(a):
+    if a is None:
+      return None
+
+    return np.asarray(a,dtype=float).tolist()
+
+  out = {'input_file':input_file,
+         'network_model':list(network_model),
+         'network_fix':np.asarray(network_fix,dtype=int).tolist(),
+         'station_model':list(station_model),
+         'station_fix':np.asarray(station_fix,dtype=int).tolist()}
+  for dir in ['east','north','vertical']:
+    out[dir] = {'network_params':tolist(network_params[dir]),
+                'station_params':tolist(station_params[dir]),
+                'likelihood':float(likelihood[dir]),
+                'simplex':tolist(state[dir].get('simplex')),
+                'hess_inv':tolist(state[dir].get('hess_inv'))}
+
+  with open(output_file,'w') as fout:
+    json.dump(out,fout,indent=2)
+
+  return
+
+
+def _read_reml_json(input_file,
+                    network_model,network_fix,
+                    station_model,station_fix):
+  ''' 
+  Reads the REML results from a JSON file written by
+  *_write_reml_json*. The Gaussian process models must be the same as
+  *network_model* and *station_model*. Returns dictionaries of the
+  network hyperparameters, the station hyperparameters, and the
+  optimizer states for each direction. The optimizer states are empty
+  if the fixed hyperparameters have changed.
+  '''
+  with open(input_file,'r') as fin:
+    prev = json.load(fin)
+
+  if ((list(prev['network_model']) != list(network_model)) |
+      (list(prev['station_model']) != list(station_model))):
+    raise ValueError(
+      'the Gaussian process models in %s are not the same as the '
+      'specified models' % input_file)
+
+  same_fix = ((list(prev['network_fix']) == list(network_fix)) &
+              (list(prev['station_fix']) == list(station_fix)))
+  if not same_fix:
+    logger.warning(
+      'The fixed hyperparameters are not the same as in %s. Only the '
+      'hyperparameters will be used for the warm start' % input_file)
+
+  network_params,station_params,state = {},{},{}
+  for dir in ['east','north','vertical']:
+    network_params[dir] = np.array(prev[dir]['network_params'],dtype=float)
+    station_params[dir] = np.array(prev[dir]['station_params'],dtype=float)
+    state[dir] = {}
+    if same_fix:
+      state[dir] = {'simplex':prev[dir]['simplex'],
+                    'hess_inv':prev[dir]['hess_inv']}
+
+  return network_params,station_params,state
+
+
 def _remove_extension(f):
   '''remove file extension if one exists'''
   if '.' not in f:
@@ -96,7 +406,9 @@ def _log_fit(input_file,
 def _log_autoclean(input_file,
                    network_model,network_params, 
                    station_model,station_params,
-                   outlier_tol,
+                   outlier_tol,outlier_method,
+                   spatial_tiles,time_window,
+                   prescreen_window,
                    output_file):
   msg  = '\n'                     
   msg += '------------- PYGEONS AUTOCLEAN RUN INFORMATION --------------\n\n'
@@ -114,6 +426,10 @@ def _log_autoclean(input_file,
   msg += '    north parameters : %s\n' % ', '.join(['%0.4e' % i for i in station_params['north']])
   msg += '    vertical parameters : %s\n' % ', '.join(['%0.4e' % i for i in station_params['vertical']])
   msg += 'outlier tolerance : %s\n' % outlier_tol  
+  msg += 'outlier detection method : %s\n' % outlier_method
+  msg += 'number of spatial tiles : %s\n' % spatial_tiles
+  msg += 'time window : %s\n' % time_window
+  msg += 'prescreen window : %s\n' % prescreen_window
   msg += 'output file : %s\n\n' % output_file  
   msg += '--------------------------------------------------------------\n'
   logger.info(msg)
@@ -223,7 +539,10 @@ def pygeons_fit(input_file,
                 network_params=(1.0,0.1,100.0),
                 station_model=('linear',),
                 station_params=(),
-                output_stem=None):
+                output_stem=None,
+                posterior_probes=None,
+                posterior_seed=0,
+                workers=0):
   ''' 
   Condition the Gaussian process to the observations and evaluate the
   posterior at the observation points.
@@ -259,32 +578,144 @@ def pygeons_fit(input_file,
            station_model,station_params,
            output_file)
   
-  for dir in ['east','north','vertical']:
-    u,su = fit(t=data['time'][:,None],
-               x=xy,      
-               d=data[dir],
-               sd=data[dir+'_std_dev'],
-               network_model=network_model,
-               network_params=network_params[dir],
-               station_model=station_model,
-               station_params=station_params[dir])
-    out[dir] = u
-    out[dir+'_std_dev'] = su
+  groups = _shared_directions(['east','north','vertical'],data,
+                              network_params,station_params)
+  # the directions share a factorization context, so that the sparsity
+  # pattern of the covariance matrix is only analyzed once when the
+  # directions are processed serially
+  factorization = FactorizationContext()
+  tasks = []
+  for dirs in groups:
+    # stack the data for each direction in the group along the last
+    # axis
+    d = np.array([data[dir] for dir in dirs]).transpose((1,2,0))
+    tasks += [dict(t=data['time'][:,None],
+                   x=xy,      
+                   d=d,
+                   sd=data[dirs[0]+'_std_dev'],
+                   network_model=network_model,
+                   network_params=network_params[dirs[0]],
+                   station_model=station_model,
+                   station_params=station_params[dirs[0]],
+                   factorization=factorization,
+                   probes=posterior_probes,
+                   seed=posterior_seed)]
+
+  solns = _run(fit,tasks,workers)
+  for dirs,(u,su) in zip(groups,solns):
+    for i,dir in enumerate(dirs):
+      out[dir] = u[:,:,i]
+      out[dir+'_std_dev'] = np.copy(su)
 
   hdf5_from_dict(output_file,out)
   logger.info('Posterior fit written to %s' % output_file)
   return
 
 
+def _halo_widths(network_model,network_params,t,x):
+  ''' 
+  Returns the widths of the time and space halos for the tiles in
+  *pygeons_autoclean*. These are twice the largest time scale and
+  length scale hyperparameters of the network model. If there are no
+  such hyperparameters then the halos span the whole dataset.
+  '''
+  time_scales,length_scales = composite_scales(
+    network_model,network_params,gpnetwork.CONSTRUCTORS)
+  if len(time_scales) > 0:
+    time_halo = 2*max(time_scales)
+  else:
+    time_halo = np.ptp(t)
+
+  if len(length_scales) > 0:
+    space_halo = 2*max(length_scales)
+  else:
+    space_halo = np.sqrt(np.sum(np.ptp(x,axis=0)**2))
+
+  return time_halo,space_halo
+
+
+def _merge_tiles(d,sd,tiles,solns):
+  ''' 
+  Returns copies of *d* and *sd* where the outliers found in the
+  interiors of the *tiles* are masked. *solns* contains the edited data
+  and uncertainties for each tile.
+  '''
+  de = np.array(d,copy=True)
+  sde = np.array(sd,copy=True)
+  for (tidx,xidx,tint,xint),(_,sde_tile) in zip(tiles,solns):
+    # outliers are the data which are masked in the edited tile and
+    # not in the original tile
+    out = np.isinf(sde_tile) & ~np.isinf(sd[np.ix_(tidx,xidx)])
+    out &= tint[:,None] & xint[None,:]
+    r,c = np.nonzero(out)
+    de[tidx[r],xidx[c]] = np.nan
+    sde[tidx[r],xidx[c]] = np.inf
+
+  return de,sde
+
+
+def _prescreen_dict(data,window,tol):
+  ''' 
+  Masks the gross outliers in the data dictionary *data* in place. The
+  east, north, and vertical components are screened together.
+  '''
+  dirs = ['east','north','vertical']
+  d = np.array([data[dir] for dir in dirs]).transpose((1,2,0))
+  sd = np.array([data[dir+'_std_dev'] for dir in dirs]).transpose((1,2,0))
+  de,sde = prescreen(data['time'],d,sd,window,tol)
+  logger.info('Masked %s gross outliers' %
+              (np.sum(np.isinf(sde)) - np.sum(np.isinf(sd))))
+  for i,dir in enumerate(dirs):
+    data[dir] = de[:,:,i]
+    data[dir+'_std_dev'] = sde[:,:,i]
+
+
+def pygeons_prescreen(input_file,
+                      prescreen_window=30.0,
+                      prescreen_tol=10.0,
+                      output_stem=None):
+  ''' 
+  Remove gross outliers with rolling robust statistics
+  '''
+  logger.info('Running pygeons prescreen ...')
+  data = dict_from_hdf5(input_file)
+  out = dict((k,np.copy(v)) for k,v in data.iteritems())
+  if output_stem is None:
+    output_stem = _remove_extension(input_file) + '.prescreen'
+
+  output_file = output_stem + '.h5'
+  _prescreen_dict(out,prescreen_window,prescreen_tol)
+  hdf5_from_dict(output_file,out)
+  logger.info('Edited data written to %s' % output_file)
+  return
+
+
 def pygeons_autoclean(input_file,
                       network_model=('spwen12-se',),
                       network_params=(1.0,0.1,100.0),
                       station_model=('linear',),
                       station_params=(),
                       output_stem=None,
-                      outlier_tol=4.0):
+                      outlier_tol=4.0,
+                      outlier_method='refit',
+                      spatial_tiles=None,
+                      time_window=None,
+                      prescreen_window=None,
+                      prescreen_tol=10.0,
+                      workers=0):
   ''' 
-  Remove outliers with a data editing algorithm
+  Remove outliers with a data editing algorithm. 
+
+  If *spatial_tiles* or *time_window* are given then the dataset is
+  split into overlapping tiles, which are cleaned independently (see
+  *pygeons.main.tiling*). The stations are split into *spatial_tiles*
+  clusters, and the times are split into windows that are
+  *time_window* days long. The halos of the tiles are determined from
+  the network hyperparameters (see *_halo_widths*).
+
+  If *prescreen_window* is given then gross outliers are removed with
+  rolling robust statistics before the data editing algorithm (see
+  *pygeons.main.prescreen*).
   '''
   logger.info('Running pygeons autoclean ...')
   data = dict_from_hdf5(input_file)
@@ -315,21 +746,76 @@ def pygeons_autoclean(input_file,
   _log_autoclean(input_file,
                  network_model,network_params,
                  station_model,station_params,
-                 outlier_tol,
+                 outlier_tol,outlier_method,
+                 spatial_tiles,time_window,
+                 prescreen_window,
                  output_file)
   
-  for dir in ['east','north','vertical']:
-    de,sde = autoclean(t=data['time'][:,None],
-                       x=xy, 
-                       d=data[dir],
-                       sd=data[dir+'_std_dev'],
+  if prescreen_window is not None:
+    # the gross outliers are masked before the more expensive data
+    # editing algorithm
+    _prescreen_dict(data,prescreen_window,prescreen_tol)
+
+  dirs = ['east','north','vertical']
+  # the directions share a factorization context, so that the sparsity
+  # pattern of the covariance matrix is only analyzed once when the
+  # directions are processed serially
+  factorization = FactorizationContext()
+  if (spatial_tiles is None) & (time_window is None):
+    tasks = [dict(t=data['time'][:,None],
+                  x=xy, 
+                  d=data[dir],
+                  sd=data[dir+'_std_dev'],
+                  network_model=network_model,
+                  network_params=network_params[dir],
+                  station_model=station_model,
+                  station_params=station_params[dir],
+                  tol=outlier_tol,
+                  factorization=factorization,
+                  method=outlier_method)
+             for dir in dirs]
+    solns = _run(autoclean,tasks,workers)
+    for dir,(de,sde) in zip(dirs,solns):
+      out[dir] = de
+      out[dir+'_std_dev'] = sde
+
+  else:
+    # clean each tile of each direction independently
+    clusters = station_clusters(xy,spatial_tiles or 1)
+    tiles,tasks = {},[]
+    for dir in dirs:
+      time_halo,space_halo = _halo_widths(network_model,
+                                          network_params[dir],
+                                          data['time'],xy)
+      tiles[dir] = []
+      for tidx,xidx,tint,xint in make_tiles(data['time'],xy,clusters,
+                                            time_window,time_halo,
+                                            space_halo):
+        sd = data[dir+'_std_dev'][np.ix_(tidx,xidx)]
+        if np.all(np.isinf(sd[np.ix_(tint,xint)])):
+          # there is no data in the interior of the tile
+          continue
+
+        tiles[dir] += [(tidx,xidx,tint,xint)]
+        tasks += [dict(t=data['time'][tidx,None],
+                       x=xy[xidx],
+                       d=data[dir][np.ix_(tidx,xidx)],
+                       sd=sd,
                        network_model=network_model,
                        network_params=network_params[dir],
                        station_model=station_model,
                        station_params=station_params[dir],
-                       tol=outlier_tol)
-    out[dir] = de
-    out[dir+'_std_dev'] = sde
+                       tol=outlier_tol,
+                       factorization=factorization,
+                       method=outlier_method)]
+
+    logger.info('Cleaning %s tiles ...' % len(tasks))
+    solns = _run(autoclean,tasks,workers)
+    for dir in dirs:
+      n = len(tiles[dir])
+      out[dir],out[dir+'_std_dev'] = _merge_tiles(
+        data[dir],data[dir+'_std_dev'],tiles[dir],solns[:n])
+      solns = solns[n:]
 
   hdf5_from_dict(output_file,out)
   logger.info('Edited data written to %s' % output_file)
@@ -343,7 +829,13 @@ def pygeons_reml(input_file,
                  station_model=('linear',),
                  station_params=(),
                  station_fix=(),
-                 output_stem=None):
+                 output_stem=None,
+                 starts_file=None,
+                 grid_size=None,
+                 grid_width=2.0,
+                 warm_start=None,
+                 vecchia_neighbors=None,
+                 workers=0):
   ''' 
   Restricted maximum likelihood estimation
   '''
@@ -355,17 +847,31 @@ def pygeons_reml(input_file,
   if data['space_exponent'] != 1:
     raise ValueError('input dataset must have units of displacement')
 
+  if (starts_file is not None) & (grid_size is not None):
+    raise ValueError('a starts file and a grid size cannot both be '
+                     'specified')
+
   # convert params to a dictionary of hyperparameters for each direction
   network_params = _params_dict(network_params)
   network_fix = np.asarray(network_fix,dtype=int)
   station_params = _params_dict(station_params)
   station_fix = np.asarray(station_fix,dtype=int)
+  state = {'east':{},'north':{},'vertical':{}}
+  if warm_start is not None:
+    # start from the optimal hyperparameters and optimizer state of a
+    # previous run
+    logger.info('Warm starting from %s' % warm_start)
+    network_params,station_params,state = _read_reml_json(
+      warm_start,
+      network_model,network_fix,
+      station_model,station_fix)
 
   # make output file name
   if output_stem is None:
     output_stem = _remove_extension(input_file) + '.reml'
 
   output_file = output_stem + '.txt'
+  json_file = output_stem + '.json'
   
   # convert geodetic positions to cartesian
   bm = make_basemap(data['longitude'],data['latitude'])
@@ -384,24 +890,52 @@ def pygeons_reml(input_file,
   with open(output_file,'a') as fout:
     fout.write(msg)
 
-  # make a dictionary storing likelihoods
-  likelihood = {}
-  for dir in ['east','north','vertical']:
-    net_opt,sta_opt,like = reml(t=data['time'][:,None],
-                                x=xy, 
-                                d=data[dir],
-                                sd=data[dir+'_std_dev'],
-                                network_model=network_model,
-                                network_params=network_params[dir],
-                                network_fix=network_fix,
-                                station_model=station_model,
-                                station_params=station_params[dir],
-                                station_fix=station_fix)
-
-    # update the parameter dict with the optimal values
-    network_params[dir] = net_opt
-    station_params[dir] = sta_opt
-    likelihood[dir] = like
+  if (starts_file is not None) | (grid_size is not None):
+    # evaluate the likelihood surface from multiple starting points or
+    # on a grid
+    surface_file = output_stem + '.h5'
+    (surface,network_params,station_params,
+     likelihood,state) = _reml_surface(
+      data,xy,
+      network_model,network_params,network_fix,
+      station_model,station_params,station_fix,
+      starts_file,grid_size,grid_width,
+      vecchia_neighbors,workers)
+    _write_reml_surface(surface_file,surface,
+                        network_model,network_params,network_fix,
+                        station_model,station_params,station_fix,
+                        likelihood)
+    logger.info('Likelihood surface written to %s' % surface_file)
+
+  else:
+    # make a dictionary storing likelihoods
+    likelihood = {}
+    dirs = ['east','north','vertical']
+    # the directions share a factorization context, so that the
+    # sparsity pattern of the covariance matrix is only analyzed once
+    # when the directions are processed serially
+    factorization = FactorizationContext()
+    tasks = [dict(t=data['time'][:,None],
+                  x=xy, 
+                  d=data[dir],
+                  sd=data[dir+'_std_dev'],
+                  network_model=network_model,
+                  network_params=network_params[dir],
+                  network_fix=network_fix,
+                  station_model=station_model,
+                  station_params=station_params[dir],
+                  station_fix=station_fix,
+                  factorization=factorization,
+                  warm_start=state[dir],
+                  vecchia_neighbors=vecchia_neighbors)
+             for dir in dirs]
+    solns = _run(reml,tasks,workers)
+    for dir,(net_opt,sta_opt,like,st) in zip(dirs,solns):
+      # update the parameter dict with the optimal values
+      network_params[dir] = net_opt
+      station_params[dir] = sta_opt
+      likelihood[dir] = like
+      state[dir] = st
 
   msg = _log_reml_results(input_file,
                           network_model,network_params,network_fix, 
@@ -411,7 +945,12 @@ def pygeons_reml(input_file,
   with open(output_file,'a') as fout:
     fout.write(msg)
     
-  logger.info('Optimal parameters written to %s' % output_file)
+  _write_reml_json(json_file,input_file,
+                   network_model,network_params,network_fix,
+                   station_model,station_params,station_fix,
+                   likelihood,state)
+  logger.info('Optimal parameters written to %s and %s' %
+              (output_file,json_file))
   return
 
 
@@ -425,7 +964,10 @@ def pygeons_strain(input_file,
                    start_date=None,stop_date=None,
                    positions=None,positions_file=None,
                    rate=True,vertical=True,covariance=False,
-                   output_stem=None):
+                   output_stem=None,
+                   posterior_probes=None,
+                   posterior_seed=0,
+                   workers=0):
   ''' 
   calculates strain
   '''
@@ -510,60 +1052,73 @@ def pygeons_strain(input_file,
               start_date,stop_date,output_id,rate,vertical,
               covariance,output_dx_file,output_dy_file)
 
-  for dir in ['east','north','vertical']:
-    if (dir == 'vertical') & (not vertical):
-      logger.debug('Not computing vertical deformation gradients')
-      # do not compute the deformation gradients for vertical. Just
-      # return zeros.
-      dx = np.zeros((output_time.shape[0],output_xy.shape[0])) 
-      sdx = np.zeros((output_time.shape[0],output_xy.shape[0])) 
-      dy = np.zeros((output_time.shape[0],output_xy.shape[0])) 
-      sdy = np.zeros((output_time.shape[0],output_xy.shape[0])) 
-      if covariance:
-        # if covariance is True then create an empty array of
-        # covariances
-        cdx = np.zeros((output_time.shape[0],output_xy.shape[0],
-                        output_time.shape[0],output_xy.shape[0]))
-        cdy = np.zeros((output_time.shape[0],output_xy.shape[0],
+  if not vertical:
+    logger.debug('Not computing vertical deformation gradients')
+    # do not compute the deformation gradients for vertical. Just
+    # return zeros.
+    dirs = ['east','north']
+    zeros = np.zeros((output_time.shape[0],output_xy.shape[0]))
+    out_dx['vertical'] = zeros
+    out_dx['vertical_std_dev'] = np.copy(zeros)
+    out_dy['vertical'] = np.copy(zeros)
+    out_dy['vertical_std_dev'] = np.copy(zeros)
+    if covariance:
+      # if covariance is True then create an empty array of
+      # covariances
+      zeros = np.zeros((output_time.shape[0],output_xy.shape[0],
                         output_time.shape[0],output_xy.shape[0]))
-        soln = (dx,sdx,cdx,dy,sdy,cdy)
-
-      else:
-        soln = (dx,sdx,dy,sdy)
-              
-    else:      
-      soln = strain(t=data['time'][:,None],
-                    x=xy,
-                    d=data[dir],
-                    sd=data[dir+'_std_dev'],
-                    network_prior_model=network_prior_model,
-                    network_prior_params=network_prior_params[dir],
-                    network_noise_model=network_noise_model,
-                    network_noise_params=network_noise_params[dir],
-                    station_noise_model=station_noise_model,
-                    station_noise_params=station_noise_params[dir],
-                    out_t=output_time[:,None],
-                    out_x=output_xy,
-                    rate=rate,
-                    covariance=covariance)
+      out_dx['vertical_covariance'] = zeros
+      out_dy['vertical_covariance'] = np.copy(zeros)
 
-    if covariance:
-      # soln contains six entries when covariance is True
-      dx,sdx,cdx,dy,sdy,cdy = soln
-      out_dx[dir] = dx
-      out_dx[dir+'_std_dev'] = sdx
-      out_dx[dir+'_covariance'] = cdx
-      out_dy[dir] = dy
-      out_dy[dir+'_std_dev'] = sdy
-      out_dy[dir+'_covariance'] = cdy
-
-    else:      
-      # soln contains four entries when covariance is False
-      dx,sdx,dy,sdy = soln
-      out_dx[dir] = dx
-      out_dx[dir+'_std_dev'] = sdx
-      out_dy[dir] = dy
-      out_dy[dir+'_std_dev'] = sdy
+  else:
+    dirs = ['east','north','vertical']
+
+  groups = _shared_directions(dirs,data,
+                              network_prior_params,
+                              network_noise_params,
+                              station_noise_params)
+  tasks = []
+  for dirs in groups:
+    # stack the data for each direction in the group along the last
+    # axis
+    d = np.array([data[dir] for dir in dirs]).transpose((1,2,0))
+    tasks += [dict(t=data['time'][:,None],
+                   x=xy,
+                   d=d,
+                   sd=data[dirs[0]+'_std_dev'],
+                   network_prior_model=network_prior_model,
+                   network_prior_params=network_prior_params[dirs[0]],
+                   network_noise_model=network_noise_model,
+                   network_noise_params=network_noise_params[dirs[0]],
+                   station_noise_model=station_noise_model,
+                   station_noise_params=station_noise_params[dirs[0]],
+                   out_t=output_time[:,None],
+                   out_x=output_xy,
+                   rate=rate,
+                   covariance=covariance,
+                   probes=posterior_probes,
+                   seed=posterior_seed)]
+
+  solns = _run(strain,tasks,workers)
+  for dirs,soln in zip(groups,solns):
+    for i,dir in enumerate(dirs):
+      if covariance:
+        # soln contains six entries when covariance is True
+        dx,sdx,cdx,dy,sdy,cdy = soln
+        out_dx[dir] = dx[:,:,i]
+        out_dx[dir+'_std_dev'] = np.copy(sdx)
+        out_dx[dir+'_covariance'] = np.copy(cdx)
+        out_dy[dir] = dy[:,:,i]
+        out_dy[dir+'_std_dev'] = np.copy(sdy)
+        out_dy[dir+'_covariance'] = np.copy(cdy)
+
+      else:      
+        # soln contains four entries when covariance is False
+        dx,sdx,dy,sdy = soln
+        out_dx[dir] = dx[:,:,i]
+        out_dx[dir+'_std_dev'] = np.copy(sdx)
+        out_dy[dir] = dy[:,:,i]
+        out_dy[dir+'_std_dev'] = np.copy(sdy)
 
   out_dx['time'] = output_time
   out_dx['longitude'] = output_lon
@@ -0,0 +1,123 @@
+''' 
+Contains a robust outlier detection algorithm which is used to remove
+gross outliers before the more expensive Gaussian process based data
+editing algorithm in *autoclean*.
+
+Each datum is compared to the median of the data in a window centered
+on it. The spread of the data in the window is estimated with the
+median absolute deviation (MAD), which is scaled by 1.4826 so that it
+is consistent with the standard deviation of normally distributed
+data. The statistics for all times, stations, and components are
+computed with vectorized operations on sliding windows of the data
+arrays.
+'''
+import numpy as np
+import logging
+import warnings
+from numpy.lib.stride_tricks import as_strided
+logger = logging.getLogger(__name__)
+
+
+def _rolling_median_mad(d,size):
+  ''' 
+  Returns the median and the MAD of the non-NaN values in windows of
+  *size* elements centered on each element of *d* along the first
+  axis. The windows are truncated at the ends of the array. The
+  statistics are NaN for windows without any data.
+  '''
+  half = size//2
+  pad = np.full((half,) + d.shape[1:],np.nan)
+  padded = np.concatenate((pad,d,pad),axis=0)
+  # view of *padded* where the last axis indexes the elements of each
+  # window
+  windows = as_strided(padded,
+                       shape=d.shape + (size,),
+                       strides=padded.strides + padded.strides[:1],
+                       writeable=False)
+  with warnings.catch_warnings():
+    # nanmedian warns about windows without any data
+    warnings.simplefilter('ignore',RuntimeWarning)
+    med = np.nanmedian(windows,axis=-1)
+    mad = np.nanmedian(np.abs(windows - med[...,None]),axis=-1)
+
+  return med,mad
+
+
+def prescreen(t,d,sd,window,tol,min_count=5,chunk_size=100):
+  ''' 
+  Returns copies of *d* and *sd* where the gross outliers are masked.
+
+  Parameters
+  ----------
+  t : (Nt,) array
+    Observation times in days, which should be regularly spaced
+
+  d : (Nt,Nx,...) array
+    Observations. Missing data are NaN. There can be trailing axes for
+    additional components, which are processed together
+
+  sd : (Nt,Nx,...) array
+    Observation uncertainties. Missing data have infinite
+    uncertainties
+
+  window : float
+    Length of the window in days
+
+  tol : float
+    A datum is an outlier if its residual with respect to the median
+    of the window exceeds *tol* times the robust standard deviation of
+    the window. The robust standard deviation is not allowed to be
+    smaller than the uncertainty of the datum
+
+  min_count : int, optional
+    Data are only tested if their window contains at least this many
+    observations
+
+  chunk_size : int, optional
+    The statistics are computed for this many times at once, which
+    limits the memory used for the sliding windows
+
+  Returns
+  -------
+  de : (Nt,Nx,...) array
+
+  sde : (Nt,Nx,...) array
+
+  '''
+  t = np.asarray(t,dtype=float)
+  de = np.array(d,dtype=float,copy=True)
+  sde = np.array(sd,dtype=float,copy=True)
+  mask = np.isinf(sde)
+  # masked data are ignored when computing the statistics
+  dm = np.where(mask,np.nan,de)
+  if t.shape[0] > 1:
+    dt = np.median(np.diff(t))
+  else:
+    dt = 1.0
+
+  # number of observations in each window, which is made odd so that
+  # the windows are centered
+  size = 2*int(round(0.5*window/dt)) + 1
+  half = size//2
+  out = np.zeros(mask.shape,dtype=bool)
+  for start in range(0,t.shape[0],chunk_size):
+    stop = min(start + chunk_size,t.shape[0])
+    # the chunk padded with the data needed for its windows
+    lo,hi = max(start - half,0),min(stop + half,t.shape[0])
+    med,mad = _rolling_median_mad(dm[lo:hi],size)
+    med,mad = med[start-lo:stop-lo],mad[start-lo:stop-lo]
+    count = np.cumsum(~mask[lo:hi],axis=0)
+    count = np.concatenate((np.zeros((1,) + count.shape[1:]),count))
+    idx = np.arange(start - lo,stop - lo)
+    count = (count[np.minimum(idx + half + 1,hi - lo)] -
+             count[np.maximum(idx - half,0)])
+    scale = np.maximum(1.4826*mad,sde[start:stop])
+    with np.errstate(invalid='ignore'):
+      res = np.abs(dm[start:stop] - med)
+      out[start:stop] = (res > tol*scale) & (count >= min_count)
+
+  logger.debug('Detected %s gross outliers out of %s observations' %
+               (np.sum(out),np.sum(~mask)))
+  de[out] = np.nan
+  sde[out] = np.inf
+  return de,sde
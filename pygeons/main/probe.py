@@ -0,0 +1,74 @@
+''' 
+Module for estimating the diagonals of matrices which are only
+available through matrix products, such as the posterior covariance
+matrices in *fit* and *strain*.
+
+The diagonals are estimated with Hutchinson's estimator. For random
+vectors *v* with independent entries of -1 or 1 (Rademacher
+vectors), the expected value of v*M.dot(v) is the diagonal of *M*.
+Averaging over *k* probe vectors gives an estimate whose standard
+error decreases as 1/sqrt(k), at the cost of *k* products with *M*,
+rather than one product for each row of *M*.
+'''
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+def hutchinson_diagonal(matvec,n,probes,seed=0,block_size=100):
+  ''' 
+  Estimates the diagonals of an (n,n) matrix *M* with *probes*
+  Rademacher probe vectors. *matvec* returns M.dot(V) for an (n,k)
+  array *V*. The probe vectors are given to *matvec* in blocks of
+  *block_size* columns, so that the products for a block can be
+  computed together (e.g., one solve with many right-hand sides).
+  The probe vectors are generated with a random number generator
+  seeded with *seed*, so that the estimates are reproducible.
+
+  Returns the estimated diagonals and their standard errors. The
+  standard errors are infinite if there is only one probe vector.
+  '''
+  rng = np.random.RandomState(seed)
+  total = np.zeros(n)
+  total_sq = np.zeros(n)
+  for start in range(0,probes,block_size):
+    k = min(block_size,probes - start)
+    V = rng.choice([-1.0,1.0],size=(n,k))
+    S = V*matvec(V)
+    total += np.sum(S,axis=1)
+    total_sq += np.sum(S**2,axis=1)
+
+  mean = total/probes
+  if probes > 1:
+    var = (total_sq - probes*mean**2)/(probes - 1)
+    var[var < 0.0] = 0.0
+    se = np.sqrt(var/probes)
+  else:
+    se = np.full(n,np.inf)
+
+  return mean,se
+
+
+def log_convergence(var,se,probes):
+  ''' 
+  Logs a convergence diagnostic for posterior variances *var* which
+  were estimated with *probes* probe vectors and have standard errors
+  *se*. The diagnostic is the relative standard error of the
+  posterior standard deviations.
+  '''
+  with np.errstate(divide='ignore',invalid='ignore'):
+    # the relative error of a standard deviation is half the relative
+    # error of the variance
+    rel = 0.5*se/var
+
+  rel = rel[np.isfinite(rel)]
+  if rel.size == 0:
+    logger.info('The posterior standard deviations were estimated '
+                'with %s probe vectors' % probes)
+    return
+
+  logger.info(
+    'The posterior standard deviations were estimated with %s probe '
+    'vectors. The median and maximum relative standard errors are '
+    '%.2e and %.2e. Use more probe vectors to reduce the errors' %
+    (probes,np.median(rel),np.max(rel)))
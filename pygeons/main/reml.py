@@ -3,27 +3,214 @@ Contains a function for restricted maximum likelihood (REML)
 hyperparameter estimation.
 '''
 import numpy as np
+import scipy.sparse as sp
 import logging
-from scipy.optimize import fmin
+from scipy.optimize import minimize
+from scipy.linalg import cholesky
 from pygeons.main import gpnetwork
 from pygeons.main import gpstation
 from pygeons.main.gptools import (composite,
-                                  station_sigma_and_p)
+                                  composite_derivatives,
+                                  composite_scales,
+                                  log_derivative,
+                                  station_sigma,
+                                  StationStructure)
+from pygeons.main.kron import (kronecker_solver,
+                               kronecker_applicable,
+                               kronecker_likelihood,
+                               _as_dense)
+from pygeons.main.statespace import (statespace_solver,
+                                     statespace_applicable)
+from pygeons.main.factor import (FactorizationContext,
+                                 PartitionedSolver)
+from pygeons.main.vecchia import VecchiaApproximation
 from rbf.gauss import (_as_sparse_or_array,
-                       _as_covariance,
-                       likelihood)
+                       _as_covariance)
 logger = logging.getLogger(__name__)
 
 
-def fmax_pos(func,x0,*args,**kwargs):
-  '''maximize the function with positivity constraint'''
-  def pos_func(x,*blargs):
-    return -func(np.exp(x),*blargs)
+# smallest initial step, in log units, taken from the optimizer state
+# of a previous run. This keeps the optimizer from stalling when the
+# previous run converged to a very small simplex
+_MIN_STEP = 0.05
 
-  xopt,fopt,_,_,_ = fmin(pos_func,np.log(x0),*args,full_output=True,**kwargs)
-  xopt = np.exp(xopt)
-  fopt = -fopt
-  return xopt,fopt
+
+def fmax_pos(func,x0,simplex=None,**kwargs):
+  ''' 
+  maximize the function with positivity constraint using the
+  Nelder-Mead method. *simplex* is the initial simplex for the log of
+  the parameters. Also returns the final simplex.
+  '''
+  def pos_func(x):
+    return -func(np.exp(x))
+
+  options = dict(kwargs)
+  if simplex is not None:
+    options['initial_simplex'] = simplex
+
+  res = minimize(pos_func,np.log(x0),method='Nelder-Mead',
+                 options=options)
+  xopt = np.exp(res.x)
+  fopt = -res.fun
+  return xopt,fopt,res.final_simplex[0]
+
+
+def fmax_pos_grad(func,x0,L=None):
+  ''' 
+  maximize the function with positivity constraint using L-BFGS-B.
+  *func* returns the function value and its gradient with respect to
+  the log of the parameters. The optimization is done in terms of *y*,
+  where log(x) = log(x0) + L*y, so that *L* can be the Cholesky factor
+  of an estimate of the inverse Hessian. Also returns whether the
+  optimization was successful and an estimate of the inverse Hessian
+  with respect to the log of the parameters.
+  '''
+  logx0 = np.log(x0)
+  if L is None:
+    L = np.eye(len(x0))
+
+  def neg_func(y):
+    val,grad = func(np.exp(logx0 + L.dot(y)))
+    if not np.isfinite(val):
+      # make L-BFGS-B backtrack
+      return np.inf,np.zeros_like(y)
+
+    return -val,-L.T.dot(grad)
+
+  res = minimize(neg_func,np.zeros(len(x0)),jac=True,method='L-BFGS-B')
+  xopt = np.exp(logx0 + L.dot(res.x))
+  fopt = -res.fun
+  success = res.success & np.isfinite(fopt)
+  hess_inv = L.dot(np.asarray(res.hess_inv.todense())).dot(L.T)
+  return xopt,fopt,success,hess_inv
+
+
+def _initial_scales(state,n):
+  ''' 
+  Returns the initial step size for each of the *n* free log
+  hyperparameters and a scaling matrix for *fmax_pos_grad* from the
+  optimizer *state* of a previous run. The state can contain the
+  final simplex of the Nelder-Mead method, *simplex*, or the estimated
+  inverse Hessian from L-BFGS-B, *hess_inv*. Returns None for both if
+  the state is not usable.
+  '''
+  if not state:
+    return None,None
+
+  hess_inv = state.get('hess_inv')
+  simplex = state.get('simplex')
+  if hess_inv is not None:
+    hess_inv = np.asarray(hess_inv,dtype=float)
+    if hess_inv.shape == (n,n):
+      scale = np.sqrt(np.abs(np.diag(hess_inv)))
+      try:
+        L = cholesky(hess_inv,lower=True)
+      except np.linalg.LinAlgError:
+        L = np.diag(scale)
+
+      # make sure that the smallest steps are at least _MIN_STEP
+      L = L*np.maximum(_MIN_STEP/np.maximum(scale,1e-300),1.0)[:,None]
+      return np.maximum(scale,_MIN_STEP),L
+
+  if simplex is not None:
+    simplex = np.asarray(simplex,dtype=float)
+    if simplex.shape == (n+1,n):
+      scale = np.max(np.abs(simplex - simplex[0]),axis=0)
+      scale = np.maximum(scale,_MIN_STEP)
+      return scale,np.diag(scale)
+
+  logger.warning('The optimizer state from the previous run does not '
+                 'match the free hyperparameters and is ignored')
+  return None,None
+
+
+def _simplex(x,scale):
+  ''' 
+  Returns an initial simplex for the log of *x* with the step sizes
+  *scale*, or None if *scale* is None
+  '''
+  if scale is None:
+    return None
+
+  logx = np.log(x)
+  return np.vstack((logx,logx + np.diag(scale)))
+
+
+def _likelihood(d,sigma,p,factorization):
+  ''' 
+  Returns the restricted log likelihood of the data *d*. *sigma* is
+  the covariance matrix, including the observation noise, and *p* are
+  the basis vectors, which should be orthonormal so that this is
+  consistent with *rbf.gauss.likelihood*. *sigma* is factored with
+  the *FactorizationContext*, *factorization*.
+  '''
+  n,m = p.shape
+  Afactor = factorization.factor(sigma)
+  solver = PartitionedSolver(Afactor,p)
+  Kd,_ = solver.solve(d,np.zeros(m))
+  out = -0.5*(Afactor.log_det() +
+              solver.log_det_H() +
+              d.dot(Kd) +
+              (n-m)*np.log(2*np.pi))
+  return out
+
+
+def _likelihood_and_gradient(d,sigma,p,dsigma,factorization):
+  ''' 
+  Returns the restricted log likelihood of the data *d* and its
+  gradient with respect to the log hyperparameters. *sigma* is the
+  covariance matrix, including the observation noise, and *p* are the
+  basis vectors, which should be orthonormal so that this is
+  consistent with *rbf.gauss.likelihood*. *dsigma* is an iterable of
+  the derivatives of *sigma* with respect to each log
+  hyperparameter. *sigma* is factored with the *FactorizationContext*,
+  *factorization*.
+  
+  The gradient is computed with the identity
+
+    dL/dh = 1/2*d.T*K*dC/dh*K*d - 1/2*tr(K*dC/dh)
+
+  where K = inv(C) - inv(C)*P*inv(P.T*inv(C)*P)*P.T*inv(C). The
+  traces only need the entries of K at the non-zeros of dC/dh, which
+  are found with a selected inversion of the sparse Cholesky factor
+  (see *PartitionedSolver.quad_trace*).
+  '''
+  n,m = p.shape
+  Afactor = factorization.factor(sigma)
+  solver = PartitionedSolver(Afactor,p)
+  Kd,_ = solver.solve(d,np.zeros(m))
+  out = -0.5*(Afactor.log_det() +
+              solver.log_det_H() +
+              d.dot(Kd) +
+              (n-m)*np.log(2*np.pi))
+  grad = []
+  for dC in dsigma:
+    grad += [0.5*(Kd.dot(dC.dot(Kd)) - solver.quad_trace(dC))]
+
+  return out,np.array(grad)
+
+
+def _vecchia_scale(network_model,network_params,t,x):
+  ''' 
+  Returns the scales for time and the two spatial dimensions which are
+  used to find the nearest neighbors for Vecchia's approximation.
+  These are the smallest time scale and length scale hyperparameters
+  of the network model. If there are no such hyperparameters then the
+  scales are the extents of the observation times and positions.
+  '''
+  time_scales,length_scales = composite_scales(
+    network_model,network_params,gpnetwork.CONSTRUCTORS)
+  if len(time_scales) > 0:
+    tscale = min(time_scales)
+  else:
+    tscale = max(np.ptp(t),1.0)
+
+  if len(length_scales) > 0:
+    lscale = min(length_scales)
+  else:
+    lscale = max(np.ptp(x),1.0)
+
+  return np.array([tscale,lscale,lscale])
 
 
 def reml(t,x,d,sd,
@@ -32,11 +219,37 @@ def reml(t,x,d,sd,
          network_fix,
          station_model,
          station_params,
-         station_fix):
+         station_fix,
+         factorization=None,
+         optimize=True,
+         warm_start=None,
+         vecchia_neighbors=None):
   ''' 
   Returns the Restricted Maximum Likelihood (REML) estimatates of the
-  unknown hyperparameters.
+  unknown hyperparameters, their log likelihood, and the final state
+  of the optimizer.
+
+  *factorization* is a *FactorizationContext* used to factor the
+  sparse covariance matrices, which can be shared between calls so
+  that the sparsity pattern is only analyzed once. If *optimize* is
+  False then this returns the given hyperparameters and their log
+  likelihood without optimizing them.
+
+  *warm_start* is the optimizer state returned by a previous call with
+  the same free hyperparameters, which is used to set the initial
+  simplex for the Nelder-Mead method or to scale the hyperparameters
+  for L-BFGS-B. The state is a dictionary containing either the final
+  simplex, *simplex*, or the estimated inverse Hessian, *hess_inv*,
+  for the log of the free hyperparameters.
+
+  If *vecchia_neighbors* is given then the likelihood is approximated
+  with Vecchia's approximation, where each datum is conditioned on
+  that many of its nearest previous neighbors. This is for networks
+  which are too large for the exact likelihood.
   '''
+  if factorization is None:
+    factorization = FactorizationContext()
+
   t = np.asarray(t,dtype=float)
   x = np.asarray(x,dtype=float)
   d = np.array(d,dtype=float)
@@ -52,6 +265,9 @@ def reml(t,x,d,sd,
 
   # mask indicates missing data
   mask = np.isinf(sd)
+  # keep the data and uncertainties on the grid for the Kronecker and
+  # state space solvers
+  d_grid,sd_grid = d,sd
   z,d,sd = z[~mask.ravel()],d[~mask],sd[~mask]
   # number of network hyperparameters
   n = len(network_params)
@@ -59,7 +275,154 @@ def reml(t,x,d,sd,
   params = np.hstack((network_params,station_params))
   fix = np.hstack((network_fix,station_fix+n))
   free = np.array([i for i in range(len(params)) if i not in fix],dtype=int)
-  
+  # descriptions of how the covariance depends on each hyperparameter
+  derivatives = (composite_derivatives(network_model,gpnetwork.CONSTRUCTORS) +
+                 composite_derivatives(station_model,gpstation.CONSTRUCTORS))
+  # the component that each hyperparameter belongs to
+  owners = []
+  for j,m in enumerate(network_model):
+    owners += [('network',j)]*gpnetwork.CONSTRUCTORS[m].nargs
+
+  for j,m in enumerate(station_model):
+    owners += [('station',j)]*gpstation.CONSTRUCTORS[m].nargs
+
+  # The parts of the covariance matrix that do not depend on the
+  # hyperparameters are only computed once. This includes where the
+  # station covariances go in the covariance matrix, the station basis
+  # vectors, and the observation noise covariance.
+  structure = StationStructure(t,mask)
+  obs_sigma = _as_covariance(sd)
+  approx = None
+  if vecchia_neighbors is not None:
+    # the neighbors are found with the initial hyperparameters and are
+    # then kept fixed
+    approx = VecchiaApproximation(
+      z,_vecchia_scale(network_model,network_params,t,x),
+      vecchia_neighbors)
+    # station index for each unmasked datum
+    station_idx = np.nonzero(~mask)[1]
+
+  # indices of the hyperparameters for each component
+  param_idx = {}
+  for i,owner in enumerate(owners):
+    param_idx.setdefault(owner,[]).append(i)
+
+  def partition(kind,models):
+    ''' 
+    Splits the components into those whose hyperparameters are all
+    fixed and those with free hyperparameters
+    '''
+    fixed,variable = [],[]
+    for j in range(len(models)):
+      if any(i in free for i in param_idx.get((kind,j),[])):
+        variable += [j]
+      else:
+        fixed += [j]
+
+    return fixed,variable
+
+  def sub_composite(kind,models,components,constructors,p):
+    ''' 
+    Returns the composite Gaussian process for a subset of the
+    components, using the hyperparameters in *p*
+    '''
+    idx = [i for j in components for i in param_idx.get((kind,j),[])]
+    return composite([models[j] for j in components],p[idx],constructors)
+
+  net_fixed,net_variable = partition('network',network_model)
+  sta_fixed,sta_variable = partition('station',station_model)
+  # The covariance matrices and basis vectors for the components whose
+  # hyperparameters are all fixed do not change between evaluations of
+  # the likelihood. They are built when they are first needed, and
+  # then added to the covariance matrices and basis vectors for the
+  # other components.
+  fixed_parts = {}
+
+  def fixed_sigma_and_p():
+    ''' 
+    Returns the covariance matrix, including the observation noise,
+    for the fixed components, the basis functions for the fixed station
+    components evaluated at *t*, and the basis vectors for the fixed
+    network components
+    '''
+    if 'sigma' not in fixed_parts:
+      logger.debug('Building the covariance matrix for the fixed '
+                   'components ...')
+      sta_gp = sub_composite('station',station_model,sta_fixed,
+                             gpstation.CONSTRUCTORS,params)
+      net_gp = sub_composite('network',network_model,net_fixed,
+                             gpnetwork.CONSTRUCTORS,params)
+      sta_sigma = station_sigma(sta_gp,t,mask,structure)
+      # add data noise to the diagonals of sta_sigma. Both matrices
+      # are sparse so this is efficient
+      sigma = _as_sparse_or_array(sta_sigma + obs_sigma)
+      sigma = _as_sparse_or_array(sigma + net_gp._covariance(z,z,diff,diff))
+      fixed_parts['sigma'] = sigma
+      fixed_parts['sta_p_i'] = sta_gp._basis(t,np.array([0]))
+      fixed_parts['net_p'] = net_gp._basis(z,diff)
+      logger.debug('Done')
+
+    return (fixed_parts['sigma'],
+            fixed_parts['sta_p_i'],
+            fixed_parts['net_p'])
+
+  def dense_sigma_and_p(test_params):
+    ''' 
+    Returns the covariance matrix, including the observation noise,
+    and the basis vectors for the unmasked data
+    '''
+    sigma,sta_p_i,net_p = fixed_sigma_and_p()
+    sta_gp = sub_composite('station',station_model,sta_variable,
+                           gpstation.CONSTRUCTORS,test_params)
+    net_gp = sub_composite('network',network_model,net_variable,
+                           gpnetwork.CONSTRUCTORS,test_params)
+    # station process
+    sta_sigma = station_sigma(sta_gp,t,mask,structure)
+    sigma = _as_sparse_or_array(sigma + sta_sigma)
+    # network process
+    sigma = _as_sparse_or_array(sigma + net_gp._covariance(z,z,diff,diff))
+    # the station basis vectors are orthonormalized together
+    sta_p_i = np.hstack((sta_p_i,sta_gp._basis(t,np.array([0]))))
+    sta_p = structure.basis(sta_p_i)
+    net_p = np.hstack((net_p,net_gp._basis(z,diff)))
+    # keep the station basis vectors sparse
+    p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
+    return sigma,p
+
+  def vecchia_likelihood(net_gp,sta_gp):
+    ''' 
+    Returns Vecchia's approximation of the restricted log likelihood
+    '''
+    def covariance(idx):
+      zi = z[idx]
+      out = _as_dense(net_gp._covariance(zi,zi,diff,diff))
+      # the station process is uncorrelated between stations
+      same = station_idx[idx][:,None] == station_idx[idx][None,:]
+      out += same*_as_dense(sta_gp._covariance(zi[:,[0]],zi[:,[0]],
+                                               diff[[0]],diff[[0]]))
+      out[range(len(idx)),range(len(idx))] += sd[idx]**2
+      return out
+
+    sta_p = structure.basis(sta_gp._basis(t,np.array([0])))
+    net_p = net_gp._basis(z,diff)
+    # keep the station basis vectors sparse
+    p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
+    return approx.log_likelihood(d,p,covariance)
+
+  def dense_dsigma(net_gp,sta_gp):
+    ''' 
+    Yields the derivative of the covariance matrix with respect to
+    each free log hyperparameter
+    '''
+    for i in free:
+      kind,j = owners[i]
+      if kind == 'network':
+        dgp = log_derivative(net_gp._components[j],derivatives[i])
+        yield dgp._covariance(z,z,diff,diff)
+      else:
+        dgp = log_derivative(sta_gp._components[j],derivatives[i])
+        yield station_sigma(dgp,t,mask,structure)
+
   def objective(theta):
     logger.debug('Current hyperparameters : ' + ' '.join('%0.4e' % i for i in theta))
     test_params = np.copy(params)
@@ -68,22 +431,33 @@ def reml(t,x,d,sd,
     test_station_params = test_params[n:]
     net_gp = composite(network_model,test_network_params,gpnetwork.CONSTRUCTORS)
     sta_gp = composite(station_model,test_station_params,gpstation.CONSTRUCTORS)
-    # station process
-    sta_sigma,sta_p = station_sigma_and_p(sta_gp,t,mask)
-    # add data noise to the diagonals of sta_sigma. Both matrices are
-    # sparse so this is efficient
-    obs_sigma = _as_covariance(sd)
-    sta_sigma = _as_sparse_or_array(sta_sigma + obs_sigma)
-    # network process
-    net_sigma = net_gp._covariance(z,z,diff,diff)
-    net_p = net_gp._basis(z,diff)
-    # combine station gp with the network gp
-    mu = np.zeros(z.shape[0])
-    sigma = _as_sparse_or_array(sta_sigma + net_sigma)
-    p = np.hstack((sta_p,net_p))
-    del sta_sigma,net_sigma,obs_sigma,sta_p,net_p
     try:
-      out = likelihood(d,mu,sigma,p=p)
+      Ssolver,Ksolver = None,None
+      if approx is None:
+        Ssolver = statespace_solver(network_model,test_network_params,
+                                    station_model,test_station_params,
+                                    net_gp,sta_gp,t,x,sd_grid)
+        if Ssolver is None:
+          Ksolver = kronecker_solver(net_gp,sta_gp,t,x,sd_grid,
+                                     structure=structure)
+
+      if approx is not None:
+        out = vecchia_likelihood(net_gp,sta_gp)
+
+      elif Ssolver is not None:
+        # the processes are Markov in time and the likelihood can be
+        # computed with a Kalman filter
+        out = Ssolver.log_likelihood(d_grid)
+
+      elif Ksolver is not None:
+        # the covariance has Kronecker structure which can be
+        # exploited
+        out = kronecker_likelihood(d,Ksolver)
+      
+      else:
+        sigma,p = dense_sigma_and_p(test_params)
+        out = _likelihood(d,sigma,p,factorization)
+
     except np.linalg.LinAlgError as err:
       logger.warning(
         'An error was raised while computing the log '
@@ -94,10 +468,78 @@ def reml(t,x,d,sd,
     logger.debug('Log likelihood : %.8e' % out)
     return out  
 
-  opt,val = fmax_pos(objective,params[free],disp=False)
+  def objective_and_gradient(theta):
+    logger.debug('Current hyperparameters : ' + ' '.join('%0.4e' % i for i in theta))
+    test_params = np.copy(params)
+    test_params[free] = theta 
+    net_gp = composite(network_model,test_params[:n],gpnetwork.CONSTRUCTORS)
+    sta_gp = composite(station_model,test_params[n:],gpstation.CONSTRUCTORS)
+    try:
+      sigma,p = dense_sigma_and_p(test_params)
+      out,grad = _likelihood_and_gradient(d,sigma,p,
+                                          dense_dsigma(net_gp,sta_gp),
+                                          factorization)
+    except np.linalg.LinAlgError as err:
+      logger.warning(
+        'An error was raised while computing the log '
+        'likelihood:\n\n%s\n' % repr(err))
+      logger.warning('Returning -INF for the log likelihood')   
+      out,grad = -np.inf,np.zeros(len(theta))
+
+    logger.debug('Log likelihood : %.8e' % out)
+    return out,grad
+
+  if not optimize:
+    out_likelihood = objective(params[free])
+    return params[:n],params[n:],out_likelihood,{}
+
+  scale,L = _initial_scales(warm_start,len(free))
+
+  # The gradient can be computed from the factorization of the
+  # covariance matrix if the derivatives with respect to each free
+  # hyperparameter are known. The other solvers only provide the
+  # likelihood, so the gradient is only used when they are not
+  # applicable.
+  use_gradient = ((len(free) > 0) & (approx is None) &
+                  all(derivatives[i] is not None for i in free))
+  if use_gradient:
+    net_gp = composite(network_model,network_params,gpnetwork.CONSTRUCTORS)
+    sta_gp = composite(station_model,station_params,gpstation.CONSTRUCTORS)
+    if (statespace_applicable(network_model,network_params,
+                              station_model,station_params,
+                              net_gp,sta_gp,t,sd_grid) or
+        kronecker_applicable(net_gp,sta_gp,t,sd_grid)):
+      use_gradient = False
+
+  if use_gradient:
+    logger.debug('Maximizing the likelihood with L-BFGS-B')
+    opt,val,success,hess_inv = fmax_pos_grad(objective_and_gradient,
+                                             params[free],L=L)
+    state = {'hess_inv':hess_inv}
+    if not success:
+      logger.info('L-BFGS-B did not converge. Falling back to the '
+                  'Nelder-Mead method')
+      if np.isfinite(val):
+        start = opt
+      else:
+        start = params[free]
+
+      opt,val,simplex = fmax_pos(objective,start,
+                                 simplex=_simplex(start,scale),
+                                 disp=False)
+      state = {'simplex':simplex}
+
+  else:
+    opt,val,simplex = fmax_pos(objective,params[free],
+                               simplex=_simplex(params[free],scale),
+                               disp=False)
+    state = {'simplex':simplex}
+
+  logger.debug('Analyzed %s sparsity patterns for %s factorizations' %
+               (factorization.analyses,factorization.factorizations))
   logger.info('Optimal hyperparameters : ' + ' '.join('%.4e' % i for i in opt))
   params[free] = opt
   out_network_params = params[:n]
   out_station_params = params[n:]
   out_likelihood = val
-  return out_network_params,out_station_params,out_likelihood
+  return out_network_params,out_station_params,out_likelihood,state
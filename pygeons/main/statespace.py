@@ -0,0 +1,759 @@
+''' 
+Module for conditioning Gaussian processes with state space methods.
+
+The temporal covariance functions 'exp', 'fogm', 'bm', 'ibm', 'mat32'
+and 'mat52' describe Markov processes, which have low order state
+space representations. Conditioning these processes with a Kalman
+filter and a Rauch-Tung-Striebel (RTS) smoother has a cost that scales
+linearly with the number of observation times, rather than cubically.
+This module can be used when the station process consists of these
+covariance functions and basis functions, and when the network
+process is a single Markov process in time multiplied by a spatial
+covariance function.
+'''
+import numpy as np
+import logging
+from scipy.linalg import expm
+from pygeons.main.gptools import set_units
+from pygeons.main.kron import (kronecker_factors,
+                               _as_dense)
+logger = logging.getLogger(__name__)
+
+
+def _swap(A):
+  '''transposes the last two axes of *A*'''
+  return np.swapaxes(A,-1,-2)
+
+
+def _pos_solve(A,B):
+  ''' 
+  Solves A.dot(X) = B for a stack of positive semi-definite matrices.
+  The pseudo-inverse is used if any of the matrices are singular.
+  '''
+  try:
+    return np.linalg.solve(A,B)
+  except np.linalg.LinAlgError:
+    return np.matmul(np.linalg.pinv(A),B)
+
+
+class _Markov(object):
+  ''' 
+  Base class for state space descriptions of Markov processes. The
+  process is the first component of the state vector and its time
+  derivatives (if they exist) are the subsequent components.
+  '''
+  dim = 0
+
+  def initial(self,t):
+    ''' 
+    Returns the prior covariance of the state at time *t*
+    '''
+    return np.zeros((0,0))
+
+  def transition(self,ta,tb):
+    ''' 
+    Returns the transition matrix and the process noise covariance
+    from time *ta* to time *tb*
+    '''
+    return np.zeros((0,0)),np.zeros((0,0))
+
+  def observation(self,diff):
+    ''' 
+    Returns the vector which maps the state to the *diff* time
+    derivative of the process. Returns None if the process is not
+    sufficiently differentiable.
+    '''
+    if diff >= self.dim:
+      return None
+
+    out = np.zeros(self.dim)
+    out[diff] = 1.0
+    return out
+
+
+class _Stationary(_Markov):
+  ''' 
+  Stationary Markov process described by the feedback matrix *F* and
+  the stationary state covariance *Pinf*
+  '''
+  def __init__(self,F,Pinf):
+    self.F = np.asarray(F,dtype=float)
+    self.Pinf = np.asarray(Pinf,dtype=float)
+    self.dim = self.F.shape[0]
+    # the data are usually on a regular grid, so cache the transition
+    # matrices for each time increment
+    self._cache = {}
+
+  def initial(self,t):
+    return self.Pinf
+
+  def transition(self,ta,tb):
+    dt = tb - ta
+    if dt not in self._cache:
+      A = expm(self.F*dt)
+      Q = self.Pinf - A.dot(self.Pinf).dot(A.T)
+      self._cache[dt] = (A,0.5*(Q + Q.T))
+
+    return self._cache[dt]
+
+
+class _Wiener(_Markov):
+  ''' 
+  Brownian motion (*order* = 1) or integrated Brownian motion (*order*
+  = 2) which starts at time *t0* and has forcing variance *sigma2*
+  '''
+  def __init__(self,sigma2,t0,order):
+    self.sigma2 = sigma2
+    self.t0 = t0
+    self.dim = order
+
+  def _noise(self,dtau):
+    if self.dim == 1:
+      return self.sigma2*np.array([[dtau]])
+    else:
+      return self.sigma2*np.array([[dtau**3/3.0,dtau**2/2.0],
+                                   [dtau**2/2.0,dtau]])
+
+  def initial(self,t):
+    return self._noise(max(t - self.t0,0.0))
+
+  def transition(self,ta,tb):
+    dtau = max(tb - self.t0,0.0) - max(ta - self.t0,0.0)
+    if self.dim == 1:
+      A = np.array([[1.0]])
+    else:
+      A = np.array([[1.0,dtau],[0.0,1.0]])
+
+    return A,self._noise(dtau)
+
+
+class _Sum(_Markov):
+  ''' 
+  Sum of independent Markov processes
+  '''
+  def __init__(self,models):
+    self.models = list(models)
+    self.dim = sum(m.dim for m in self.models)
+
+  def _block_diag(self,mats):
+    out = np.zeros((self.dim,self.dim))
+    start = 0
+    for m,M in zip(self.models,mats):
+      out[start:start+m.dim,start:start+m.dim] = M
+      start += m.dim
+
+    return out
+
+  def initial(self,t):
+    return self._block_diag([m.initial(t) for m in self.models])
+
+  def transition(self,ta,tb):
+    out = [m.transition(ta,tb) for m in self.models]
+    A = self._block_diag([o[0] for o in out])
+    Q = self._block_diag([o[1] for o in out])
+    return A,Q
+
+  def observation(self,diff):
+    out = [m.observation(diff) for m in self.models]
+    if any(o is None for o in out):
+      return None
+
+    return np.hstack([np.zeros(0)] + out)
+
+
+# State space constructors. These have the same names, arguments and
+# units as the constructors in *gpstation*. Basis functions do not
+# contribute to the state.
+#####################################################################
+@set_units([])
+def _basis():
+  return _Sum([])
+
+
+@set_units(['mjd'])
+def _step(t0):
+  return _Sum([])
+
+
+@set_units(['mm/yr^0.5','yr^-1'])
+def fogm(sigma,w):
+  ''' 
+  First-order Gauss Markov process
+  '''
+  return _Stationary([[-w]],[[sigma**2/(2*w)]])
+
+
+@set_units(['mm','yr'])
+def exp(sigma,cts):
+  ''' 
+  Exponential covariance function
+  '''
+  return _Stationary([[-1.0/cts]],[[sigma**2]])
+
+
+@set_units(['mm','yr'])
+def mat32(sigma,cts):
+  ''' 
+  Matern covariance function with nu=3/2
+  '''
+  lam = np.sqrt(3.0)/cts
+  F = [[0.0,1.0],
+       [-lam**2,-2*lam]]
+  Pinf = [[sigma**2,0.0],
+          [0.0,lam**2*sigma**2]]
+  return _Stationary(F,Pinf)
+
+
+@set_units(['mm','yr'])
+def mat52(sigma,cts):
+  ''' 
+  Matern covariance function with nu=5/2
+  '''
+  lam = np.sqrt(5.0)/cts
+  kappa = lam**2*sigma**2/3.0
+  F = [[0.0,1.0,0.0],
+       [0.0,0.0,1.0],
+       [-lam**3,-3*lam**2,-3*lam]]
+  Pinf = [[sigma**2,0.0,-kappa],
+          [0.0,kappa,0.0],
+          [-kappa,0.0,lam**4*sigma**2]]
+  return _Stationary(F,Pinf)
+
+
+@set_units(['mm/yr^0.5','mjd'])
+def bm(sigma,t0):
+  ''' 
+  Brownian motion
+  '''
+  return _Wiener(sigma**2,t0,1)
+
+
+@set_units(['mm/yr^1.5','mjd'])
+def ibm(sigma,t0):
+  ''' 
+  Integrated Brownian motion
+  '''
+  return _Wiener(sigma**2,t0,2)
+
+
+CONSTRUCTORS = {'const':_basis,
+                'linear':_basis,
+                'per':_basis,
+                'step':_step,
+                'bm':bm,
+                'ibm':ibm,
+                'fogm':fogm,
+                'mat32':mat32,
+                'mat52':mat52,
+                'exp':exp}
+
+
+def station_statespace(components,args):
+  ''' 
+  Returns the state space description of a station process. Returns
+  None if any of the components are not Markov processes or basis
+  functions.
+  '''
+  components = list(components)
+  args = list(args)
+  if any(c not in CONSTRUCTORS for c in components):
+    return None
+
+  models = []
+  for c in components:
+    ci = CONSTRUCTORS[c]
+    models += [ci(*(args.pop(0) for i in range(ci.nargs)))]
+
+  return _Sum(models)
+
+
+def network_statespace(components,args):
+  ''' 
+  Returns the state space description of the temporal factor of a
+  network process. Returns None if the network process is not a
+  single Markov process in time multiplied by a spatial covariance
+  function.
+  '''
+  components = list(components)
+  if len(components) != 1:
+    return None
+
+  tname = components[0].split('-')[0]
+  if tname not in CONSTRUCTORS:
+    return None
+
+  ci = CONSTRUCTORS[tname]
+  if ci.nargs == 0:
+    return None
+
+  return ci(*args[:ci.nargs])
+
+
+def _station_basis_grid(p_i,mask):
+  ''' 
+  Returns the orthonormalized basis vectors for each station as a
+  (Nt,Nx,Np) array, which is zero at the masked data, and a (Nx,Np)
+  boolean array indicating which columns are not empty.
+  '''
+  Nt,Nx = mask.shape
+  Np = p_i.shape[1]
+  out = np.zeros((Nt,Nx,Np))
+  valid = np.zeros((Nx,Np),dtype=bool)
+  for i in range(Nx):
+    tidx, = np.nonzero(~mask[:,i])
+    if (tidx.size == 0) | (Np == 0):
+      continue
+
+    u,s,_ = np.linalg.svd(p_i[tidx],full_matrices=False)
+    keep = s > 1e-12*s.max()
+    r = np.sum(keep)
+    out[tidx,i,:r] = u[:,keep]
+    valid[i,:r] = True
+
+  return out,valid
+
+
+class StateSpaceSolver(object):
+  ''' 
+  Conditions a Gaussian process consisting of a station process, an
+  optional network process, and uncorrelated observation noise with a
+  Kalman filter and an RTS smoother. If there is no network process
+  then the stations are independent and they are processed as a batch
+  of small state space models. Otherwise, the state contains the
+  network process and the station process for all stations.
+
+  Parameters
+  ----------
+  t : (Nt,1) array
+    Observation times
+
+  sd : (Nt,Nx) array
+    Standard deviation of the observation noise. Missing data have an
+    infinite standard deviation.
+
+  sta_model : _Markov
+    State space description of the station process
+
+  p_i : (Nt,Np) array
+    Basis vectors for the station process
+
+  net_model : _Markov, optional
+    State space description of the temporal factor of the network
+    process
+
+  Kx : (Nx,Nx) array, optional
+    Spatial covariance matrix for the network process
+
+  '''
+  def __init__(self,t,sd,sta_model,p_i,net_model=None,Kx=None):
+    self.t = np.asarray(t,dtype=float)[:,0]
+    self.sd = np.asarray(sd,dtype=float)
+    self.mask = np.isinf(self.sd)
+    self.sta_model = sta_model
+    self.net_model = net_model
+    Nt,Nx = self.sd.shape
+    self.Nx = Nx
+    self.basis,self.valid = _station_basis_grid(p_i,self.mask)
+    ms = sta_model.dim
+    if net_model is None:
+      # each station is a separate batch with a single observation
+      self.H = np.tile(sta_model.observation(0),(Nx,1,1))
+
+    else:
+      self.Kx = _as_dense(Kx)
+      self.H = np.hstack((np.kron(np.eye(Nx),net_model.observation(0)[None,:]),
+                          np.kron(np.eye(Nx),sta_model.observation(0)[None,:])))
+      self.H = self.H[None,:,:]
+
+  def _batch(self,a):
+    ''' 
+    Converts the (Nt,Nx,...) array *a* to a (Nt,b,p,...) array, where
+    *b* is the number of batches and *p* is the number of
+    observations per batch
+    '''
+    if self.net_model is None:
+      return a.reshape(a.shape[:2] + (1,) + a.shape[2:])
+    else:
+      return a.reshape(a.shape[:1] + (1,) + a.shape[1:])
+
+  def _initial(self,t):
+    ''' 
+    Returns the prior state covariance for each batch at time *t*
+    '''
+    Ps = self.sta_model.initial(t)
+    if self.net_model is None:
+      return np.tile(Ps,(self.Nx,1,1))
+
+    Pn = self.net_model.initial(t)
+    out = np.zeros(self.H.shape[-1:]*2)
+    k = self.Nx*self.net_model.dim
+    out[:k,:k] = np.kron(self.Kx,Pn)
+    out[k:,k:] = np.kron(np.eye(self.Nx),Ps)
+    return out[None,:,:]
+
+  def _transition(self,ta,tb):
+    ''' 
+    Returns the transition matrix and process noise covariance for each
+    batch from time *ta* to *tb*
+    '''
+    As,Qs = self.sta_model.transition(ta,tb)
+    if self.net_model is None:
+      return As[None,:,:],Qs[None,:,:]
+
+    An,Qn = self.net_model.transition(ta,tb)
+    m = self.H.shape[-1]
+    k = self.Nx*self.net_model.dim
+    A = np.zeros((m,m))
+    A[:k,:k] = np.kron(np.eye(self.Nx),An)
+    A[k:,k:] = np.kron(np.eye(self.Nx),As)
+    Q = np.zeros((m,m))
+    Q[:k,:k] = np.kron(self.Kx,Qn)
+    Q[k:,k:] = np.kron(np.eye(self.Nx),Qs)
+    return A[None,:,:],Q[None,:,:]
+
+  def _rhs(self,d):
+    ''' 
+    Returns the right-hand-side for the Kalman filter, where the first
+    *nd* columns are the data and the remaining columns are the basis
+    vectors. *d* is a (Nt,Nx) or (Nt,Nx,nd) array. Also returns a
+    (b,k-nd) boolean array indicating which basis vectors are not
+    empty.
+    '''
+    Nt,Nx,Np = self.basis.shape
+    d = np.where(self.mask[:,:,None],0.0,d.reshape((Nt,Nx,-1)))
+    if self.net_model is None:
+      Y = np.concatenate((d,self.basis),axis=2)
+      valid = self.valid
+
+    else:
+      # each station has its own set of basis vectors
+      P = np.zeros((Nt,Nx,Nx*Np))
+      for i in range(Nx):
+        P[:,i,i*Np:(i+1)*Np] = self.basis[:,i,:]
+
+      Y = np.concatenate((d,P),axis=2)
+      valid = self.valid.reshape((1,Nx*Np))
+
+    return self._batch(Y),valid
+
+  def _filter(self,times,Y,obs,var,store=False):
+    ''' 
+    Runs the Kalman filter over *times*. *Y* is the (n,b,p,k)
+    right-hand-side, *obs* is a (n,b,p) boolean array indicating
+    which data are observed and *var* contains the observation noise
+    variances. Returns the whitened innovations and the log
+    determinant of the data covariance matrix. If *store* is True then
+    the filtered states and covariances are also returned.
+    '''
+    n,b,p,k = Y.shape
+    m = self.H.shape[-1]
+    W = np.zeros((n,b,p,k))
+    logdet = 0.0
+    if store:
+      xf = np.zeros((n,b,m,k))
+      Pf = np.zeros((n,b,m,m))
+
+    x = np.zeros((b,m,k))
+    P = self._initial(times[0])
+    for i in range(n):
+      if i > 0:
+        A,Q = self._transition(times[i-1],times[i])
+        x = np.matmul(A,x)
+        P = np.matmul(np.matmul(A,P),_swap(A)) + Q
+
+      if np.any(obs[i]):
+        # missing data are given a unit variance and a zero row in the
+        # observation matrix so that they do not affect the state
+        H = self.H*obs[i][:,:,None]
+        R = np.where(obs[i],var[i],1.0)
+        PHt = np.matmul(P,_swap(H))
+        S = np.matmul(H,PHt)
+        S[:,range(p),range(p)] += R
+        L = np.linalg.cholesky(S)
+        e = Y[i] - np.matmul(H,x)
+        W[i] = np.linalg.solve(L,e)
+        logdet += 2*np.sum(np.log(np.diagonal(L,axis1=1,axis2=2)))
+        Kt = np.linalg.solve(S,_swap(PHt))
+        x = x + np.matmul(_swap(Kt),e)
+        P = P - np.matmul(_swap(Kt),_swap(PHt))
+        P = 0.5*(P + _swap(P))
+
+      if store:
+        xf[i] = x
+        Pf[i] = P
+
+    if store:
+      return W,logdet,xf,Pf
+    else:
+      return W,logdet
+
+  def _smooth(self,times,xf,Pf,outputs):
+    ''' 
+    Runs the RTS smoother. *outputs* is a dictionary where the keys
+    are the indices of *times* and the values are (b,q,m) arrays
+    that map the state to the output. Returns the mean and the
+    variance of the outputs as (n_out,b,q,k) and (n_out,b,q) arrays.
+    '''
+    n = len(times)
+    idx = sorted(outputs.keys())
+    means = {}
+    variances = {}
+    xs,Ps = xf[n-1],Pf[n-1]
+    for i in range(n-1,-1,-1):
+      if (i < n-1) & (xf.shape[2] > 0):
+        A,Q = self._transition(times[i],times[i+1])
+        xp = np.matmul(A,xf[i])
+        Pp = np.matmul(np.matmul(A,Pf[i]),_swap(A)) + Q
+        # smoother gain
+        J = _swap(_pos_solve(Pp,np.matmul(A,Pf[i])))
+        xs = xf[i] + np.matmul(J,xs - xp)
+        Ps = Pf[i] + np.matmul(np.matmul(J,Ps - Pp),_swap(J))
+
+      if i in outputs:
+        O = outputs[i]
+        means[i] = np.matmul(O,xs)
+        variances[i] = np.sum(np.matmul(O,Ps)*O,axis=2)
+
+    mean = np.array([means[i] for i in idx])
+    var = np.array([variances[i] for i in idx])
+    return mean,var
+
+  def _basis_solve(self,W,valid,nd=1):
+    ''' 
+    Returns the basis vector coefficients, the Cholesky decomposition
+    of P.T.dot(inv(C)).dot(P) for each batch, the log determinant
+    of P.T.dot(inv(C)).dot(P), and the whitened data with the basis
+    vectors projected out. The first *nd* columns of *W* are data.
+    '''
+    n,b,p,k = W.shape
+    coeff = np.zeros((b,k-nd,nd))
+    chol = np.zeros((b,k-nd,k-nd))
+    logdet = 0.0
+    quad = 0.0
+    for j in range(b):
+      Wj = W[:,j].reshape((n*p,k))
+      wd = Wj[:,:nd]
+      WP = Wj[:,nd:][:,valid[j]]
+      quad += np.sum(wd**2)
+      if WP.shape[1] == 0:
+        continue
+
+      L = np.linalg.cholesky(WP.T.dot(WP))
+      a = np.linalg.solve(L,WP.T.dot(wd))
+      quad -= np.sum(a**2)
+      logdet += 2*np.sum(np.log(np.diag(L)))
+      coeff[j,valid[j]] = np.linalg.solve(L.T,a)
+      chol[np.ix_([j],valid[j],valid[j])] = L
+
+    return coeff,chol,logdet,quad
+
+  def log_likelihood(self,d):
+    ''' 
+    Returns the restricted log likelihood of the data *d*, which is a
+    (Nt,Nx) array. This is consistent with *rbf.gauss.likelihood*.
+    '''
+    Y,valid = self._rhs(d)
+    obs = self._batch(~self.mask)
+    var = self._batch(self.sd**2)
+    W,logdet = self._filter(self.t,Y,obs,var)
+    _,_,logdet_H,quad = self._basis_solve(W,valid)
+    n = np.sum(~self.mask)
+    m = np.sum(valid)
+    out = -0.5*(logdet + logdet_H + quad + (n-m)*np.log(2*np.pi))
+    return out
+
+  def _posterior(self,d,times,obs,var,outputs,basis_outputs):
+    ''' 
+    Returns the posterior mean and variance of the outputs, which
+    accounts for the uncertainty in the basis vector coefficients.
+    *basis_outputs* is a (n_out,b,q,k-nd) array describing the basis
+    vectors at the outputs, which should be zero if the basis vectors
+    are not part of the output. The mean has shape (n_out,b,q,nd),
+    where *nd* is the number of data columns.
+    '''
+    Y,valid = self._rhs(d)
+    nd = Y.shape[-1] - basis_outputs.shape[-1]
+    # pad the right-hand-side for times without data
+    Yt = np.zeros((len(times),) + Y.shape[1:])
+    Yt[np.searchsorted(times,self.t)] = Y
+    W,_,xf,Pf = self._filter(times,Yt,obs,var,store=True)
+    coeff,chol,_,_ = self._basis_solve(W,valid,nd)
+    mean,var = self._smooth(times,xf,Pf,outputs)
+    # difference between the basis vectors and their smoothed values
+    F = basis_outputs - mean[...,nd:]
+    mean = mean[...,:nd] + np.einsum('ijkl,jlm->ijkm',F,coeff)
+    b = chol.shape[0]
+    for j in range(b):
+      vj = valid[j]
+      if not np.any(vj):
+        continue
+
+      Fj = F[:,j][...,vj]
+      G = np.linalg.solve(chol[j][np.ix_(vj,vj)],
+                          Fj.reshape((-1,np.sum(vj))).T)
+      var[:,j] += np.sum(G**2,axis=0).reshape(var[:,j].shape)
+
+    return mean,var
+
+  def fit(self,d):
+    ''' 
+    Returns the posterior mean and standard deviation of the
+    combined network and station process at the observation points.
+    *d* can be a (Nt,Nx) array or a (Nt,Nx,K) array of data sharing
+    the same uncertainties. The mean has the same shape as *d* and the
+    standard deviation has shape (Nt,Nx).
+    '''
+    Nt,Nx = self.sd.shape
+    obs = self._batch(~self.mask)
+    var = self._batch(self.sd**2)
+    outputs = dict((i,self.H) for i in range(Nt))
+    if self.net_model is None:
+      basis_outputs = self._batch(self.basis)
+    else:
+      Np = self.basis.shape[2]
+      basis_outputs = np.zeros((Nt,Nx,Nx*Np))
+      for i in range(Nx):
+        basis_outputs[:,i,i*Np:(i+1)*Np] = self.basis[:,i,:]
+
+      basis_outputs = self._batch(basis_outputs)
+
+    mean,var = self._posterior(d,self.t,obs,var,outputs,basis_outputs)
+    mean = mean.reshape(d.shape)
+    var = var.reshape((Nt,Nx))
+    var[var < 0.0] = 0.0
+    return mean,np.sqrt(var)
+
+  def meansd(self,d,out_t,out_x,tdiff,B,Bxx):
+    ''' 
+    Returns the posterior mean and standard deviation for the network
+    process at the output times *out_t* and positions *out_x*. The
+    posterior is for the *tdiff* time derivative. *B* is the spatial
+    covariance between the output positions and the stations, and
+    *Bxx* is the diagonal of the spatial covariance at the output
+    positions, which may have been differentiated. The standard
+    deviation has shape (Nt_out,Nx_out). The mean has the same shape
+    if *d* is a (Nt,Nx) array, and it has shape (Nt_out,Nx_out,K) if
+    *d* is a (Nt,Nx,K) array.
+    '''
+    if self.net_model is None:
+      raise ValueError('There is no network process')
+
+    Hd = self.net_model.observation(tdiff)
+    if Hd is None:
+      raise ValueError(
+        'The network process is not sufficiently differentiable')
+
+    out_t = np.asarray(out_t,dtype=float)[:,0]
+    times = np.union1d(self.t,out_t)
+    n = len(times)
+    tidx = np.searchsorted(times,self.t)
+    obs = np.zeros((n,self.Nx),dtype=bool)
+    obs[tidx] = ~self.mask
+    var = np.ones((n,self.Nx))
+    var[tidx] = np.where(self.mask,1.0,self.sd**2)
+    # the network process at the output positions is a linear
+    # combination of the network process at the stations plus an
+    # independent residual
+    Bk = np.linalg.lstsq(self.Kx,B.T,rcond=1e-12)[0].T
+    resid = Bxx - np.sum(Bk*B,axis=1)
+    m = self.H.shape[-1]
+    k = self.Nx*self.net_model.dim
+    O = np.zeros((B.shape[0],m))
+    O[:,:k] = np.kron(Bk,Hd[None,:])
+    oidx = np.searchsorted(times,out_t)
+    outputs = dict((i,O[None,:,:]) for i in oidx)
+    Np = self.basis.shape[2]
+    basis_outputs = np.zeros((len(out_t),1,B.shape[0],self.Nx*Np))
+    mean,var = self._posterior(d,times,self._batch(obs),self._batch(var),
+                               outputs,basis_outputs)
+    mean = mean[:,0].reshape((len(out_t),B.shape[0]) + d.shape[2:])
+    var = var[:,0]
+    # add the variance of the residual
+    prior_var = np.array([Hd.dot(self.net_model.initial(ti)).dot(Hd)
+                          for ti in out_t])
+    var += prior_var[:,None]*resid[None,:]
+    var[var < 0.0] = 0.0
+    return mean,np.sqrt(var)
+
+
+def _statespace_models(network_model,network_params,
+                       station_model,station_params,
+                       net_gp,sta_gp,t,sd):
+  ''' 
+  Returns the state space models for the station and network
+  processes, or None if a *StateSpaceSolver* cannot be used or is not
+  expected to be faster than a dense solver. The network model is None
+  if there is no network process. This does not build any covariance
+  matrices.
+  '''
+  sta_model = station_statespace(station_model,station_params)
+  if sta_model is None:
+    logger.debug('The station process is not a Markov process')
+    return None
+
+  Nt,Nx = sd.shape
+  if len(network_model) == 0:
+    net_model = None
+    m = sta_model.dim
+
+  else:
+    net_model = network_statespace(network_model,network_params)
+    if (net_model is None) | (kronecker_factors(net_gp) is None):
+      logger.debug('The network process is not a Markov process')
+      return None
+
+    m = Nx*(net_model.dim + sta_model.dim)
+
+  Nu = np.sum(~np.isinf(sd))
+  Np = sta_gp._basis(t[:1],np.array([0])).shape[1]
+  if net_model is None:
+    cost = Nt*Nx*(m + 1)**3
+  else:
+    cost = Nt*(m + Nx)**3 + Nt*m**2*Nx*Np
+
+  if cost > Nu**3/3.0:
+    logger.debug('The state space solver is not expected to be faster '
+                 'than a dense solver')
+    return None
+
+  return sta_model,net_model
+
+
+def statespace_applicable(network_model,network_params,
+                          station_model,station_params,
+                          net_gp,sta_gp,t,sd):
+  ''' 
+  Returns True if *statespace_solver* would build a solver for these
+  processes, without building or factoring any matrices
+  '''
+  models = _statespace_models(network_model,network_params,
+                              station_model,station_params,
+                              net_gp,sta_gp,t,sd)
+  return models is not None
+
+
+def statespace_solver(network_model,network_params,
+                      station_model,station_params,
+                      net_gp,sta_gp,t,x,sd):
+  ''' 
+  Attempts to build a *StateSpaceSolver* for the network and station
+  processes. Returns None if the processes are not Markov in time or
+  if the state space solver is not expected to be faster than a dense
+  solver.
+  '''
+  models = _statespace_models(network_model,network_params,
+                              station_model,station_params,
+                              net_gp,sta_gp,t,sd)
+  if models is None:
+    return None
+
+  sta_model,net_model = models
+  if net_model is None:
+    Kx = None
+  else:
+    sgp = kronecker_factors(net_gp)[1]
+    Kx = sgp._covariance(x,x,np.array([0,0]),np.array([0,0]))
+
+  logger.debug('Using the state space solver')
+  p_i = sta_gp._basis(t,np.array([0]))
+  return StateSpaceSolver(t,sd,sta_model,p_i,net_model=net_model,Kx=Kx)
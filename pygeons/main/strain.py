@@ -2,6 +2,7 @@
 Contains a function for computing strain or strain rates.
 '''
 import numpy as np
+import scipy.sparse as sp
 import logging
 from pygeons.main import gpnetwork
 from pygeons.main import gpstation
@@ -9,10 +10,105 @@ from rbf.gauss import (_as_sparse_or_array,
                        _as_covariance)
 from pygeons.main.gptools import (composite,
                                   station_sigma_and_p)
+from pygeons.main.kron import (kronecker_solver,
+                               kronecker_factors,
+                               _kron_dot,
+                               _as_dense)
+from pygeons.main.statespace import statespace_solver
+from pygeons.main.factor import (FactorizationContext,
+                                 PartitionedSolver)
+from pygeons.main.probe import (hutchinson_diagonal,
+                                log_convergence)
 
 logger = logging.getLogger(__name__)
 
 
+def _kronecker_meansd(Ksolver,prior_gp,t,x,d,out_t,out_x,diff):
+  ''' 
+  Returns the mean and standard deviation of the specified derivative
+  of the posterior Gaussian process at the grid of output times and
+  positions. The covariance of the prior Gaussian process and the
+  noise is described by the *PartitionedKroneckerSolver*, *Ksolver*.
+  '''
+  tgp,sgp = kronecker_factors(prior_gp)
+  m = Ksolver.P.shape[1]
+  vec,_ = Ksolver.solve(d,np.zeros((m,) + d.shape[1:]))
+  vec = Ksolver.Csolver.expand(vec)
+  # the cross covariance between the output points and the observation
+  # points is kron(A,B)
+  A = _as_dense(tgp._covariance(out_t,t,diff[[0]],np.array([0])))
+  B = _as_dense(sgp._covariance(out_x,x,diff[[1,2]],np.array([0,0])))
+  mean = _kron_dot(A,B,vec)
+  # diagonals of the prior covariance at the output points
+  At = _as_dense(tgp._covariance(out_t,out_t,diff[[0]],diff[[0]]))
+  Bx = _as_dense(sgp._covariance(out_x,out_x,diff[[1,2]],diff[[1,2]]))
+  var = np.outer(np.diag(At),np.diag(Bx)).ravel()
+  var -= Ksolver.quad_diag(A,B)
+  var[var < 0.0] = 0.0
+  sd = np.sqrt(var)
+  return mean,sd
+
+
+def _statespace_meansd(Ssolver,prior_gp,x,d,out_t,out_x,diff):
+  ''' 
+  Returns the mean and standard deviation of the specified derivative
+  of the posterior Gaussian process at the grid of output times and
+  positions. The prior and noise processes are described by the
+  *StateSpaceSolver*, *Ssolver*.
+  '''
+  _,sgp = kronecker_factors(prior_gp)
+  B = _as_dense(sgp._covariance(out_x,x,diff[[1,2]],np.array([0,0])))
+  Bxx = _as_dense(sgp._covariance(out_x,out_x,diff[[1,2]],diff[[1,2]]))
+  mean,sd = Ssolver.meansd(d,out_t,out_x,diff[0],B,np.diag(Bxx))
+  return mean.reshape((-1,) + d.shape[2:]),sd.ravel()
+
+
+def _probe_meansd(Ksolver,prior_gp,z,d,out_z,diff,probes,seed=0,
+                  chunk_size=1000):
+  ''' 
+  Returns the mean and standard deviation of the specified derivative
+  of the posterior Gaussian process at the output points. The
+  covariance of the prior Gaussian process and the noise is described
+  by the *PartitionedSolver*, *Ksolver*, and the prior must not have
+  basis functions. The posterior variances are estimated with *probes*
+  probe vectors, generated with the random seed *seed*. The cross covariance between the output points and
+  the observation points is built in chunks of *chunk_size* output
+  points.
+  '''
+  N = out_z.shape[0]
+  m = Ksolver.P.shape[1]
+  zero = np.zeros(z.shape[1],dtype=int)
+  chunks = [slice(i,min(i + chunk_size,N)) for i in range(0,N,chunk_size)]
+  cross = lambda c: _as_dense(prior_gp._covariance(out_z[c],z,diff,zero))
+  vec,_ = Ksolver.solve(d,np.zeros((m,) + d.shape[1:]))
+  mean = np.empty((N,) + d.shape[1:])
+  # diagonals of the prior covariance at the output points
+  prior_var = np.empty(N)
+  for c in chunks:
+    mean[c] = cross(c).dot(vec)
+    prior_var[c] = np.diag(_as_dense(
+      prior_gp._covariance(out_z[c],out_z[c],diff,diff)))
+
+  def matvec(V):
+    # B.dot(M).dot(B.T).dot(V), where B is the cross covariance and M
+    # is the upper left block of the inverse of the partitioned
+    # covariance matrix
+    BtV = sum(cross(c).T.dot(V[c]) for c in chunks)
+    MBtV,_ = Ksolver.solve(BtV,np.zeros((m,V.shape[1])))
+    out = np.empty(V.shape)
+    for c in chunks:
+      out[c] = cross(c).dot(MBtV)
+
+    return out
+
+  quad,quad_se = hutchinson_diagonal(matvec,N,probes,seed)
+  var = prior_var - quad
+  log_convergence(var,quad_se,probes)
+  var[var < 0.0] = 0.0
+  sd = np.sqrt(var)
+  return mean,sd
+
+
 def strain(t,x,d,sd,
            network_prior_model,
            network_prior_params,
@@ -21,9 +117,24 @@ def strain(t,x,d,sd,
            station_noise_model,
            station_noise_params,
            out_t,out_x,rate,
-           covariance):
+           covariance,
+           probes=None,
+           seed=0):
   ''' 
   Computes deformation gradients from displacement data.
+
+  *d* can be a (Nt,Nx) array or a (Nt,Nx,K) array containing *K*
+  datasets which share the uncertainties *sd*. In the latter case,
+  the deformation gradients have an additional trailing axis of
+  length *K*, and the uncertainties are the same for each dataset.
+
+  If *probes* is given then the posterior standard deviations are
+  estimated with that many Rademacher probe vectors (see
+  *pygeons.main.probe*). This is used when the covariance matrix is
+  factored directly, *covariance* is False, and the prior has no basis
+  functions. The covariance matrix is then factored once for both
+  deformation gradients. *seed* seeds the random number generator for
+  the probe vectors.
   '''  
   t = np.asarray(t,dtype=float)
   x = np.asarray(x,dtype=float)
@@ -51,8 +162,73 @@ def strain(t,x,d,sd,
 
   # find missing data
   mask = np.isinf(sd)
+  if rate:
+    dx_diff,dy_diff = np.array([1,1,0]),np.array([1,0,1])
+  else:
+    dx_diff,dy_diff = np.array([0,1,0]),np.array([0,0,1])
+
+  Ssolver,Ksolver = None,None
+  if (not covariance) & (len(noise_gp._components) == 0):
+    # the network noise is empty. Attempt to use a solver which
+    # exploits the Markov property or the Kronecker structure of the
+    # prior covariance
+    Ssolver = statespace_solver(network_prior_model,network_prior_params,
+                                station_noise_model,station_noise_params,
+                                prior_gp,sta_gp,t,x,sd)
+    if Ssolver is not None:
+      if ((Ssolver.net_model is None) or
+          (Ssolver.net_model.observation(dx_diff[0]) is None)):
+        # the prior is empty or it is not sufficiently differentiable
+        # in time
+        Ssolver = None
+
+    if Ssolver is None:
+      Ksolver = kronecker_solver(prior_gp,sta_gp,t,x,sd)
+
+  if Ssolver is not None:
+    dudx,sdudx = _statespace_meansd(Ssolver,prior_gp,x,d,out_t,out_x,dx_diff)
+    dudy,sdudy = _statespace_meansd(Ssolver,prior_gp,x,d,out_t,out_x,dy_diff)
+    dudx = dudx.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[2:])
+    sdudx = sdudx.reshape((out_t.shape[0],out_x.shape[0]))
+    dudy = dudy.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[2:])
+    sdudy = sdudy.reshape((out_t.shape[0],out_x.shape[0]))
+    return (dudx,sdudx,dudy,sdudy)
+
+  use_probes = ((probes is not None) & (not covariance) &
+                (prior_gp._basis(z[:1],diff).shape[1] == 0))
+  if (probes is not None) & (not use_probes) & (Ksolver is None):
+    logger.warning('The posterior standard deviations cannot be '
+                   'estimated with probe vectors when covariances are '
+                   'returned or when the prior has basis functions. '
+                   'They will be computed exactly')
+
+  if (Ksolver is None) & (not use_probes) & (d.ndim == 3):
+    # rbf.gauss conditions one dataset at a time, so compute the
+    # deformation gradients for each dataset separately
+    solns = [strain(t,x,d[:,:,i],sd,
+                    network_prior_model,network_prior_params,
+                    network_noise_model,network_noise_params,
+                    station_noise_model,station_noise_params,
+                    out_t,out_x,rate,covariance,probes,seed)
+             for i in range(d.shape[2])]
+    out = list(solns[0])
+    # the means are the first and middle outputs
+    for i in [0,len(out)//2]:
+      out[i] = np.array([s[i] for s in solns]).transpose((1,2,0))
+
+    return tuple(out)
+
   # get unmasked data and uncertainties
   z,d,sd = z[~mask.ravel()],d[~mask],sd[~mask]
+  if Ksolver is not None:
+    dudx,sdudx = _kronecker_meansd(Ksolver,prior_gp,t,x,d,out_t,out_x,dx_diff)
+    dudy,sdudy = _kronecker_meansd(Ksolver,prior_gp,t,x,d,out_t,out_x,dy_diff)
+    dudx = dudx.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[1:])
+    sdudx = sdudx.reshape((out_t.shape[0],out_x.shape[0]))
+    dudy = dudy.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[1:])
+    sdudy = sdudy.reshape((out_t.shape[0],out_x.shape[0]))
+    return (dudx,sdudx,dudy,sdudy)
+
   # build noise covariance and basis vectors
   sta_sigma,sta_p = station_sigma_and_p(sta_gp,t,mask)
   # add data noise to the station noise
@@ -63,10 +239,30 @@ def strain(t,x,d,sd,
   net_p = noise_gp._basis(z,diff)
   # combine noise processes
   noise_sigma = _as_sparse_or_array(sta_sigma + net_sigma)
-  noise_p = np.hstack((sta_p,net_p))
+  # keep the station basis vectors sparse
+  noise_p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
   del sta_sigma,net_sigma,obs_sigma,sta_p,net_p
-  # condition the prior with the data
-  post_gp = prior_gp.condition(z,d,sigma=noise_sigma,p=noise_p)
+  if use_probes:
+    # factor the covariance matrix once for both deformation
+    # gradients
+    prior_sigma = prior_gp._covariance(z,z,diff,diff)
+    A = _as_sparse_or_array(noise_sigma + prior_sigma)
+    Ksolver = PartitionedSolver(FactorizationContext().factor(A),noise_p)
+    del prior_sigma,A
+    dudx,sdudx = _probe_meansd(Ksolver,prior_gp,z,d,out_z,dx_diff,probes,
+                                 seed)
+    dudy,sdudy = _probe_meansd(Ksolver,prior_gp,z,d,out_z,dy_diff,probes,
+                                 seed)
+    dudx = dudx.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[1:])
+    sdudx = sdudx.reshape((out_t.shape[0],out_x.shape[0]))
+    dudy = dudy.reshape((out_t.shape[0],out_x.shape[0]) + d.shape[1:])
+    sdudy = sdudy.reshape((out_t.shape[0],out_x.shape[0]))
+    return (dudx,sdudx,dudy,sdudy)
+
+  # condition the prior with the data. *GaussianProcess.condition*
+  # does not accept sparse basis vectors
+  post_gp = prior_gp.condition(z,d,sigma=noise_sigma,
+                               p=noise_p.toarray())
   if rate:
     dudx_gp = post_gp.differentiate((1,1,0)) # x derivative of velocity
     dudy_gp = post_gp.differentiate((1,0,1)) # y derivative of velocity
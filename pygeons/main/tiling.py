@@ -0,0 +1,121 @@
+''' 
+Module for splitting a dataset into overlapping spatio-temporal tiles,
+so that a Gaussian process can be fit to each tile independently.
+
+The stations are partitioned into spatial clusters with k-means, and
+the times are partitioned into windows. The interior of a tile is the
+stations in one cluster and the times in one window, and each datum
+is in the interior of exactly one tile. Each tile also contains a halo
+of the stations and times within some distance of its interior, so
+that the data near the edges of the interior are constrained from
+both sides.
+'''
+import numpy as np
+import logging
+from scipy.spatial import cKDTree
+from scipy.cluster.vq import kmeans2
+logger = logging.getLogger(__name__)
+
+
+def _initial_centroids(x,n):
+  ''' 
+  Returns *n* stations from *x* which are spread out over the network,
+  to be used as the initial centroids for k-means. The first is the
+  station closest to the center of the network, and each subsequent
+  station is the one farthest from those already chosen. This is
+  deterministic, so the clusters are the same for every run.
+  '''
+  idx = [np.argmin(np.sum((x - np.mean(x,axis=0))**2,axis=1))]
+  dist = np.sum((x - x[idx[0]])**2,axis=1)
+  for i in range(1,n):
+    idx += [np.argmax(dist)]
+    dist = np.minimum(dist,np.sum((x - x[idx[-1]])**2,axis=1))
+
+  return x[idx]
+
+
+def station_clusters(x,n):
+  ''' 
+  Partitions the stations at positions *x* into at most *n* clusters
+  with k-means. Returns the cluster index for each station. The
+  cluster indices are consecutive integers starting at zero.
+  '''
+  x = np.asarray(x,dtype=float)
+  n = min(n,x.shape[0])
+  if n <= 1:
+    return np.zeros(x.shape[0],dtype=int)
+
+  _,labels = kmeans2(x,_initial_centroids(x,n),minit='matrix')
+  # k-means can leave clusters empty, so make the labels consecutive
+  _,labels = np.unique(labels,return_inverse=True)
+  return labels
+
+
+def make_tiles(t,x,clusters,window,time_halo,space_halo):
+  ''' 
+  Returns the overlapping tiles for observations at times *t* and
+  stations *x*.
+
+  Parameters
+  ----------
+  t : (Nt,) array
+    Observation times
+
+  x : (Nx,2) array
+    Station positions
+
+  clusters : (Nx,) int array
+    Cluster index for each station (see *station_clusters*)
+
+  window : float
+    Length of the time windows. If this is None, then there is one
+    window containing all the times
+
+  time_halo : float
+    The halo of each tile contains the times within this distance of
+    its window
+
+  space_halo : float
+    The halo of each tile contains the stations within this distance
+    of a station in its cluster
+
+  Returns
+  -------
+  list of (tidx,xidx,tint,xint) tuples
+    The tile contains the times *t[tidx]* and the stations *x[xidx]*.
+    *tint* and *xint* are boolean arrays indicating which of those
+    times and stations are in the interior of the tile
+
+  '''
+  t = np.asarray(t,dtype=float)
+  x = np.asarray(x,dtype=float)
+  if window is None:
+    window_idx = np.zeros(t.shape[0],dtype=int)
+  else:
+    window_idx = np.floor((t - np.min(t))/window).astype(int)
+
+  tree = cKDTree(x)
+  space = []
+  for c in np.unique(clusters):
+    members = np.nonzero(clusters == c)[0]
+    near = tree.query_ball_point(x[members],space_halo)
+    xidx = np.unique(np.hstack([members] + [np.array(i,dtype=int) for i in near]))
+    space += [(xidx,clusters[xidx] == c)]
+
+  time = []
+  for w in np.unique(window_idx):
+    start = np.min(t[window_idx == w])
+    stop = np.max(t[window_idx == w])
+    tidx = np.nonzero((t >= start - time_halo) &
+                      (t <= stop + time_halo))[0]
+    time += [(tidx,window_idx[tidx] == w)]
+
+  tiles = [(tidx,xidx,tint,xint)
+           for tidx,tint in time
+           for xidx,xint in space]
+  logger.debug('Split the dataset into %s tiles with up to %s times '
+               'and %s stations' %
+               (len(tiles),
+                max(len(i[0]) for i in tiles),
+                max(len(i[1]) for i in tiles)))
+  return tiles
@@ -0,0 +1,90 @@
+''' 
+Module for stationary covariance functions evaluated on a uniform
+grid of times.
+
+PyGeoNS stores data on a daily grid, so the covariance matrix for a
+stationary temporal covariance function is a symmetric Toeplitz
+matrix, which is completely described by its first column. This
+module evaluates only the first column of such matrices, which takes
+O(Nt) covariance function evaluations rather than O(Nt^2), and then
+expands it into a sparse matrix. The expanded matrix stores every
+non-zero diagonal, so it only uses less memory than the full matrix
+when the covariance function has compact support.
+'''
+import numpy as np
+import scipy.sparse as sp
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _as_dense_row(A):
+  '''convert the (1,N) matrix *A* to a one-dimensional array'''
+  if sp.issparse(A):
+    A = A.toarray()
+
+  return np.asarray(A)[0]
+
+
+def toeplitz_column(gp,t):
+  ''' 
+  Returns the first column of the covariance matrix for *gp* evaluated
+  at the times *t*. Returns None if *t* is not uniformly spaced or if
+  the covariance function is not stationary, in which case the
+  covariance matrix is not Toeplitz.
+
+  Parameters
+  ----------
+  gp : GaussianProcess
+    One-dimensional Gaussian process
+
+  t : (Nt,1) array
+    Observation times
+
+  Returns
+  -------
+  (Nt,) array or None
+  '''
+  t = np.asarray(t,dtype=float)
+  Nt = t.shape[0]
+  if Nt < 2:
+    return None
+
+  dt = np.diff(t[:,0])
+  if np.any(np.abs(dt - dt[0]) > 1e-10*np.abs(dt[0])):
+    logger.debug('The times are not uniformly spaced')
+    return None
+
+  diff = np.array([0])
+  col = _as_dense_row(gp._covariance(t[:1],t,diff,diff))
+  # check for stationarity by comparing the first row to the middle
+  # and last rows
+  tol = 1e-10*np.max(np.abs(col))
+  for i in [Nt//2,Nt-1]:
+    row = _as_dense_row(gp._covariance(t[[i]],t,diff,diff))
+    if (np.any(np.abs(row[i:] - col[:Nt-i]) > tol) |
+        np.any(np.abs(row[i::-1] - col[:i+1]) > tol)):
+      logger.debug('The covariance function is not stationary')
+      return None
+
+  return col
+
+
+def toeplitz_coo(c):
+  ''' 
+  Returns the symmetric Toeplitz matrix with the first column *c* as a
+  sparse COO matrix, which only includes the non-zero diagonals
+  '''
+  c = np.asarray(c,dtype=float)
+  n = c.shape[0]
+  lags, = np.nonzero(c)
+  # include the diagonals below the main diagonal
+  lags = np.hstack((-lags[lags > 0][::-1],lags))
+  counts = n - np.abs(lags)
+  idx = np.arange(np.sum(counts))
+  # the row index and lag for each non-zero
+  start = np.repeat(np.cumsum(counts) - counts,counts)
+  lag = np.repeat(lags,counts)
+  rows = idx - start + np.maximum(-lag,0)
+  cols = rows + lag
+  data = c[np.abs(lag)]
+  return sp.coo_matrix((data,(rows,cols)),(n,n))
@@ -0,0 +1,204 @@
+''' 
+Module for approximating the restricted log likelihood with Vecchia's
+approximation.
+
+The joint density of the data is written as a product of conditional
+densities, where each datum is conditioned on all the data that come
+before it in some ordering. Vecchia's approximation conditions each
+datum on only its *m* nearest previous neighbors. The approximate
+inverse covariance matrix is then W.T.dot(W), where *W* is a sparse
+triangular matrix with *m* + 1 non-zeros in each row. Computing *W*
+takes O(N*m**3) operations and only needs the covariances between
+each datum and its neighbors, so the likelihood can be evaluated for
+networks that are too large for the exact likelihood.
+'''
+import numpy as np
+import scipy.sparse as sp
+import logging
+from scipy.spatial import cKDTree
+from scipy.linalg import (cho_factor,
+                          cho_solve)
+logger = logging.getLogger(__name__)
+
+
+def nearest_previous(z,m):
+  ''' 
+  Returns the indices of the *m* nearest neighbors of each point in
+  *z* which come before it. The neighbors are sorted by distance. The
+  first *m* points have fewer than *m* previous points, and their
+  missing neighbors are indicated with -1.
+
+  Parameters
+  ----------
+  z : (N,D) array
+
+  m : int
+
+  Returns
+  -------
+  (N,m) int array
+  '''
+  N = z.shape[0]
+  out = np.full((N,m),-1,dtype=int)
+  if (N == 0) | (m == 0):
+    return out
+
+  tree = cKDTree(z)
+  # points whose neighbors have not been found yet
+  todo = np.arange(N)
+  # About half of the nearest neighbors come before each point, so
+  # start by searching for 2*m + 1 neighbors. The search is repeated
+  # with twice as many neighbors for points with too few previous
+  # neighbors.
+  k = 2*m + 1
+  while todo.size > 0:
+    k = min(k,N)
+    _,idx = tree.query(z[todo],k=k)
+    idx = idx.reshape((todo.size,k))
+    prev = idx < todo[:,None]
+    # the number of neighbors which should be found for each point
+    avail = np.minimum(todo,m)
+    done = (np.sum(prev,axis=1) >= avail) | (k == N)
+    # move the previous neighbors to the front, keeping them sorted
+    # by distance
+    order = np.argsort(~prev[done],axis=1,kind='mergesort')[:,:m]
+    rows = np.arange(order.shape[0])[:,None]
+    nbr = idx[done][rows,order]
+    cols = np.arange(order.shape[1])[None,:]
+    nbr[cols >= avail[done][:,None]] = -1
+    out[todo[done],:order.shape[1]] = nbr
+    todo = todo[~done]
+    k *= 2
+
+  return out
+
+
+class VecchiaApproximation(object):
+  ''' 
+  Vecchia's approximation of the covariance matrix for a set of
+  ordered points. The neighbors of each point do not depend on the
+  covariance function, so they are found once, and the approximation
+  can be evaluated for many covariance functions, as in *reml*.
+
+  The points are processed in chunks of consecutive points. The
+  covariance matrix for the points in a chunk and all of their
+  neighbors is built once, and the conditional distributions for the
+  chunk are computed from it with batched linear algebra.
+
+  Parameters
+  ----------
+  z : (N,D) array
+    Ordered observation points
+
+  scale : (D,) array
+    The coordinates are divided by *scale* before finding the nearest
+    neighbors, so that distances in time and space are comparable
+
+  m : int
+    Number of neighbors for each point
+
+  chunk_size : int, optional
+    Number of points in each chunk
+
+  '''
+  def __init__(self,z,scale,m,chunk_size=100):
+    logger.debug('Finding the %s nearest previous neighbors for %s '
+                 'points ...' % (m,z.shape[0]))
+    z = np.asarray(z,dtype=float)
+    N = z.shape[0]
+    self.N,self.m = N,m
+    self.neighbors = nearest_previous(z/scale,m)
+    self.chunks = []
+    for start in range(0,N,chunk_size):
+      stop = min(start + chunk_size,N)
+      idx = np.arange(start,stop)
+      nbr = self.neighbors[start:stop]
+      valid = nbr >= 0
+      # the points needed for the conditional distributions in this
+      # chunk
+      union = np.unique(np.hstack((idx,nbr[valid])))
+      # the indices in *union* of the neighbors followed by the point
+      # itself. Missing neighbors are -1
+      local = np.full((stop - start,m + 1),-1,dtype=int)
+      local[:,:m][valid] = np.searchsorted(union,nbr[valid])
+      local[:,m] = np.searchsorted(union,idx)
+      self.chunks.append((idx,union,local))
+
+    logger.debug('Done')
+
+  def factor(self,covariance):
+    ''' 
+    Returns the sparse matrix *W*, where W.T.dot(W) is the
+    approximate inverse covariance matrix, and the log determinant of
+    the approximate covariance matrix. *covariance* is a function
+    which takes an array of point indices and returns their dense
+    covariance matrix. Raises a *np.linalg.LinAlgError* if a
+    conditional variance is not positive.
+    '''
+    m = self.m
+    data,rows,cols = [],[],[]
+    logdet = 0.0
+    for idx,union,local in self.chunks:
+      C = covariance(union)
+      n = idx.shape[0]
+      valid = local >= 0
+      loc = np.where(valid,local,0)
+      # covariance matrices for each point and its neighbors. The
+      # rows and columns for missing neighbors are replaced with the
+      # rows and columns of the identity matrix so that they do not
+      # affect the conditional distributions
+      G = C[loc[:,:,None],loc[:,None,:]]
+      G *= valid[:,:,None] & valid[:,None,:]
+      diag = np.arange(m)
+      G[:,diag,diag] += ~valid[:,:m]
+      if m > 0:
+        # regression coefficients of each point on its neighbors
+        a = np.linalg.solve(G[:,:m,:m],G[:,:m,m:])[:,:,0]
+      else:
+        a = np.zeros((n,0))
+
+      # conditional variances
+      var = G[:,m,m] - np.sum(G[:,:m,m]*a,axis=1)
+      if np.any(var <= 0.0):
+        raise np.linalg.LinAlgError(
+          'The conditional variances for Vecchia\'s approximation '
+          'are not positive')
+
+      logdet += np.sum(np.log(var))
+      w = 1.0/np.sqrt(var)
+      # each row of *W* has *w* on the diagonal and -w*a at the
+      # neighbors
+      nbr = self.neighbors[idx]
+      keep = nbr >= 0
+      data += [w,(-w[:,None]*a)[keep]]
+      rows += [idx,np.repeat(idx,np.sum(keep,axis=1))]
+      cols += [idx,nbr[keep]]
+
+    W = sp.csr_matrix((np.hstack(data),(np.hstack(rows),np.hstack(cols))),
+                      (self.N,self.N))
+    return W,logdet
+
+  def log_likelihood(self,d,p,covariance):
+    ''' 
+    Returns the approximate restricted log likelihood of the data *d*
+    given the basis vectors *p*, which can be sparse, and the
+    covariance function *covariance* (see *factor*). This is
+    consistent with *rbf.gauss.likelihood* when the exact covariance
+    matrix is used.
+    '''
+    n,mp = p.shape
+    W,logdet = self.factor(covariance)
+    Wd = W.dot(d)
+    out = logdet + Wd.dot(Wd) + (n - mp)*np.log(2*np.pi)
+    if mp > 0:
+      WP = W.dot(p)
+      H = WP.T.dot(WP)
+      if sp.issparse(H):
+        H = H.toarray()
+
+      b = WP.T.dot(Wd)
+      H_factor = cho_factor(H,lower=True)
+      out += 2*np.sum(np.log(np.diag(H_factor[0])))
+      out -= b.dot(cho_solve(H_factor,b))
+
+    return -0.5*out
@@ -8,6 +8,13 @@ try:
 except ImportError:
   _HAS_MKL = False    
 
+try:
+  # threadpoolctl can limit the threads for OpenBLAS as well as MKL
+  from threadpoolctl import threadpool_limits
+  _HAS_THREADPOOLCTL = True
+except ImportError:
+  _HAS_THREADPOOLCTL = False
+
 class ParmapError(Exception):
   def __init__(self,errors):
     msg = 'errors were raised when evaluating parmap:\n'
@@ -67,10 +74,11 @@ def parmap(f,args,workers=None):
 
   NOTES
   -----
-  If the *mkl* package is installed then this function first sets the 
-  maximum number of allowed threads per process to 1. This is to help 
-  prevents spawned subprocesses from using multiple cores. The number 
-  of allowed threads is reset after all subprocesses have finished.
+  If the *mkl* or *threadpoolctl* package is installed then this 
+  function first divides the maximum number of allowed BLAS threads 
+  between the worker processes, so that the spawned subprocesses do 
+  not use more cores than are available. The number of allowed 
+  threads is reset after all subprocesses have finished.
     
   '''
   if workers is None:
@@ -84,10 +92,15 @@ def parmap(f,args,workers=None):
     # perform the map on the parent process
     return [f(i) for i in args]
 
-  # attempt to prevent lower level functions from running in parallel
+  # divide the threads used by lower level functions between the 
+  # worker processes
+  threads = max(cpu_count()//workers,1)
   if _HAS_MKL:
     starting_threads = mkl.get_max_threads()
-    mkl.set_num_threads(1)
+    mkl.set_num_threads(max(starting_threads//workers,1))
+
+  if _HAS_THREADPOOLCTL:
+    limiter = threadpool_limits(limits=threads,user_api='blas')
 
   # q_in has a max size of 1 so that args is not copied over to 
   # the next process until absolutely necessary
@@ -133,14 +146,17 @@ def parmap(f,args,workers=None):
   q_out.close()
   q_err.close()
 
+  # reset the number of threads to its original value
+  if _HAS_MKL:
+    mkl.set_num_threads(starting_threads)
+
+  if _HAS_THREADPOOLCTL:
+    limiter.restore_original_limits()
+
   # raise an error if any were found
   if any([e is not None for e in err_list]):
     raise ParmapError(err_list)
 
-  # reset the number of threads to its original value
-  if _HAS_MKL:
-    mkl.set_num_threads(starting_threads)
-    
   return val_list
 
 
@@ -0,0 +1,115 @@
+''' 
+Tests the outlier detection algorithms used by *autoclean*
+'''
+import numpy as np
+import scipy.sparse as sp
+import unittest
+from rbf.gauss import outliers
+from pygeons.main.autoclean import (_restrict,
+                                    _outliers,
+                                    _exclusion_vectors,
+                                    _loo_outliers)
+from pygeons.main.factor import (FactorizationContext,
+                                 PartitionedSolver,
+                                 HAS_CHOLMOD)
+
+
+def _problem(N=200,seed=1):
+  ''' 
+  Returns data with a few gross outliers, their uncertainties, and
+  the prior mean, sparse covariance matrix, and basis vectors of a
+  Gaussian process
+  '''
+  rng = np.random.RandomState(seed)
+  t = np.arange(float(N))
+  # compactly supported Wendland covariance function
+  r = np.abs(t[:,None] - t[None,:])/10.0
+  sigma = np.where(r < 1.0,(1.0 - r)**4*(4*r + 1.0),0.0)
+  sigma = sp.csc_matrix(sigma)
+  s = np.full(N,0.1)
+  mu = np.zeros(N)
+  p = np.array([np.ones(N),t/N]).T
+  d = np.sin(t/15.0) + 0.5 + t/N + s*rng.normal(size=N)
+  d[[20,75,140]] += 5.0
+  return d,s,mu,sigma,p
+
+
+class TestRefit(unittest.TestCase):
+  def test_matches_rbf(self):
+    # the refit method should find the same outliers as
+    # rbf.gauss.outliers, which it replaces
+    d,s,mu,sigma,p = _problem()
+    expected = outliers(d,s,mu=mu,sigma=sigma,p=p,tol=4.0)
+    out = _outliers(d,s,mu,sigma,p,4.0,FactorizationContext())
+    self.assertTrue(np.array_equal(np.sort(out),np.sort(expected)))
+    # the basis vectors can be sparse
+    out = _outliers(d,s,mu,sigma,sp.csc_matrix(p),4.0,
+                    FactorizationContext())
+    self.assertTrue(np.array_equal(np.sort(out),np.sort(expected)))
+    self.assertTrue(set([20,75,140]).issubset(out))
+
+  def test_restrict(self):
+    # solving with the restricted matrix is the same as solving with
+    # only the kept data
+    d,s,mu,sigma,p = _problem()
+    A = sigma + sp.diags(s**2)
+    keep = np.ones(len(d),dtype=bool)
+    keep[[3,50,51,199]] = False
+    for Ai in [A,A.toarray()]:
+      Ar = _restrict(Ai,keep)
+      solver = PartitionedSolver(FactorizationContext().factor(Ar),
+                                 p*keep[:,None])
+      x,y = solver.solve(d*keep,np.zeros(2))
+      Ak = A.toarray()[np.ix_(keep,keep)]
+      solver = PartitionedSolver(FactorizationContext().factor(Ak),
+                                 p[keep])
+      xk,yk = solver.solve(d[keep],np.zeros(2))
+      self.assertTrue(np.allclose(x[keep],xk))
+      self.assertTrue(np.allclose(x[~keep],0.0))
+      self.assertTrue(np.allclose(y,yk))
+
+
+class TestLOO(unittest.TestCase):
+  @unittest.skipUnless(HAS_CHOLMOD,'requires CHOLMOD')
+  def test_update_matches_refactor(self):
+    # excluding data with updates and downdates of the Cholesky factor
+    # should give the same solves and diagonals as factoring the
+    # restricted matrix
+    d,s,mu,sigma,p = _problem()
+    A = sp.csc_matrix(sigma + sp.diags(s**2))
+    keep = np.ones(len(d),dtype=bool)
+    keep[75] = False
+    Afactor = FactorizationContext().factor(_restrict(A,keep)).copy()
+    # compute a selected inversion before the update so that a stale
+    # inversion would be detected
+    Afactor.inverse_diagonal()
+    new_idx = np.array([20,140])
+    U,D = _exclusion_vectors(A,new_idx,keep)
+    Afactor.update(U)
+    Afactor.update(D,subtract=True)
+    keep[new_idx] = False
+    pk = sp.diags(keep.astype(float)).dot(p)
+    updated = PartitionedSolver(Afactor,pk)
+    refactored = PartitionedSolver(
+      FactorizationContext().factor(_restrict(A,keep)),pk)
+    x1,y1 = updated.solve(d*keep,np.zeros(2))
+    x2,y2 = refactored.solve(d*keep,np.zeros(2))
+    self.assertTrue(np.allclose(x1,x2))
+    self.assertTrue(np.allclose(y1,y2))
+    self.assertTrue(np.allclose(updated.quad_diag()[keep],
+                                refactored.quad_diag()[keep]))
+    self.assertTrue(np.isclose(updated.Afactor.log_det(),
+                               refactored.Afactor.log_det()))
+
+  def test_finds_outliers(self):
+    d,s,mu,sigma,p = _problem()
+    out = _loo_outliers(d,s,mu,sigma,p,4.0,FactorizationContext())
+    self.assertTrue(set([20,75,140]).issubset(out))
+    # the dense path should find the same outliers
+    dense = _loo_outliers(d,s,mu,sigma.toarray(),p,4.0,
+                          FactorizationContext())
+    self.assertTrue(np.array_equal(np.sort(out),np.sort(dense)))
+
+
+if __name__ == '__main__':
+  unittest.main()
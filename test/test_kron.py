@@ -0,0 +1,133 @@
+''' 
+Tests the solvers for covariance matrices that are block diagonal or
+have Kronecker structure
+'''
+import numpy as np
+import scipy.sparse as sp
+import unittest
+from pygeons.main.kron import (StationBlockSolver,
+                               PartitionedKroneckerSolver,
+                               kronecker_likelihood,
+                               _EIG_COST)
+
+
+def _problem(Nt=30,Nx=5,seed=1,constant=False,shared_mask=False):
+  ''' 
+  Returns a station covariance matrix, uncertainties with missing
+  data, and the dense covariance matrix for the unmasked data. If
+  *constant* is True then each station has a constant uncertainty. If
+  *shared_mask* is True then the stations have the same missing data.
+  '''
+  rng = np.random.RandomState(seed)
+  t = np.arange(float(Nt))
+  St = np.exp(-((t[:,None] - t[None,:])/5.0)**2)
+  if constant:
+    sd = np.repeat(rng.uniform(0.2,0.4,(1,Nx)),Nt,axis=0)
+  else:
+    sd = rng.uniform(0.2,0.4,(Nt,Nx))
+
+  if shared_mask:
+    sd[rng.uniform(size=Nt) < 0.2] = np.inf
+  else:
+    sd[rng.uniform(size=(Nt,Nx)) < 0.2] = np.inf
+
+  return St,sd,_dense(St,sd)
+
+
+def _dense(St,sd):
+  ''' 
+  Returns the dense covariance matrix for the unmasked data
+  '''
+  mask = np.isinf(sd)
+  idx, = np.nonzero(~mask.ravel())
+  tidx,xidx = idx//sd.shape[1],idx%sd.shape[1]
+  A = St[np.ix_(tidx,tidx)]*(xidx[:,None] == xidx[None,:])
+  A += np.diag(sd[~mask]**2)
+  return A
+
+
+def _likelihood(d,A,P):
+  ''' 
+  Returns the restricted log likelihood computed with dense matrices
+  '''
+  n,m = P.shape
+  Aid = np.linalg.solve(A,d)
+  out = np.linalg.slogdet(A)[1] + d.dot(Aid) + (n-m)*np.log(2*np.pi)
+  if m > 0:
+    AiP = np.linalg.solve(A,P)
+    H = P.T.dot(AiP)
+    Pd = P.T.dot(Aid)
+    out += np.linalg.slogdet(H)[1] - Pd.dot(np.linalg.solve(H,Pd))
+
+  return -0.5*out
+
+
+class TestPartitionedKroneckerSolver(unittest.TestCase):
+  def _check(self,P):
+    St,sd,A = _problem()
+    d = np.random.RandomState(2).normal(size=A.shape[0])
+    solver = PartitionedKroneckerSolver(StationBlockSolver(St,sd),P)
+    self.assertTrue(np.isclose(kronecker_likelihood(d,solver),
+                               _likelihood(d,A,P)))
+    x,y = solver.solve(d,np.zeros(P.shape[1]))
+    self.assertEqual(y.shape,(P.shape[1],))
+    # the solution satisfies the partitioned system
+    self.assertTrue(np.allclose(A.dot(x) + P.dot(y),d))
+    self.assertTrue(np.allclose(P.T.dot(x),0.0))
+    # diagonals of the upper left block of the inverse
+    Ai = np.linalg.inv(A)
+    if P.shape[1] > 0:
+      AiP = Ai.dot(P)
+      Ai -= AiP.dot(np.linalg.solve(P.T.dot(AiP),AiP.T))
+
+    self.assertTrue(np.allclose(solver.quad_diag(),np.diag(Ai)))
+
+  def test_no_basis(self):
+    St,sd,A = _problem()
+    self._check(np.zeros((A.shape[0],0)))
+
+  def test_basis(self):
+    St,sd,A = _problem()
+    self._check(np.ones((A.shape[0],1)))
+
+
+class TestStationBlockSolver(unittest.TestCase):
+  def _check(self,St,sd,A):
+    solver = StationBlockSolver(St,sd)
+    n = A.shape[0]
+    self.assertTrue(np.isclose(solver.log_det(),np.linalg.slogdet(A)[1]))
+    self.assertTrue(np.allclose(solver.quad_diag(),
+                                np.diag(np.linalg.inv(A))))
+    b = np.random.RandomState(3).normal(size=(n,2))
+    self.assertTrue(np.allclose(solver.solve(b),np.linalg.solve(A,b)))
+    self.assertTrue(np.allclose(solver.solve(b[:,0]),
+                                np.linalg.solve(A,b[:,0])))
+    # sparse right-hand sides, like the station basis vectors
+    B = sp.csc_matrix(np.where(np.arange(n)[:,None] % 3 == 0,b,0.0))
+    self.assertTrue(np.allclose(solver.solve(B),
+                                np.linalg.solve(A,B.toarray())))
+    return solver
+
+  def test_heteroscedastic(self):
+    solver = self._check(*_problem(shared_mask=True))
+    self.assertEqual(len(solver.eig_blocks),0)
+
+  def test_shared_factor(self):
+    # stations with the same missing data and constant uncertainties
+    # share a factorization
+    St,sd,_ = _problem(shared_mask=True,constant=True)
+    sd[:,1] = sd[:,0]
+    solver = self._check(St,sd,_dense(St,sd))
+    self.assertEqual(len(solver.blocks),4)
+
+  def test_shared_eigendecomposition(self):
+    # many stations with the same missing data and constant
+    # uncertainties share an eigendecomposition
+    St,sd,A = _problem(Nx=_EIG_COST + 5,shared_mask=True,constant=True)
+    solver = self._check(St,sd,A)
+    self.assertEqual(len(solver.eig_blocks),1)
+    self.assertEqual(len(solver.blocks),0)
+
+
+if __name__ == '__main__':
+  unittest.main()
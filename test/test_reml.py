@@ -0,0 +1,143 @@
+''' 
+Tests the gradient of the restricted log likelihood, which is used by
+*pygeons.main.reml.reml* when the derivatives of the covariance
+function are known.
+'''
+import numpy as np
+import scipy.sparse as sp
+import unittest
+from rbf.gauss import _as_sparse_or_array,_as_covariance
+from pygeons.main import gpnetwork
+from pygeons.main import gpstation
+from pygeons.main.gptools import (composite,
+                                  composite_derivatives,
+                                  log_derivative,
+                                  station_sigma,
+                                  station_sigma_and_p,
+                                  StationStructure)
+from pygeons.main.kron import _as_dense
+from pygeons.main.factor import FactorizationContext
+from pygeons.main.reml import _likelihood,_likelihood_and_gradient
+
+# step size for the central differences, in log units
+STEP = 1e-5
+
+
+def _problem(seed=1):
+  ''' 
+  Returns the observation points, data, uncertainties, and mask for a
+  small network with some missing data
+  '''
+  rng = np.random.RandomState(seed)
+  t = 50000.0 + np.arange(20.0)
+  x = rng.uniform(0.0,20000.0,(5,2))
+  Nt,Nx = t.shape[0],x.shape[0]
+  sd = np.full((Nt,Nx),1e-4)
+  sd[rng.uniform(size=(Nt,Nx)) < 0.1] = np.inf
+  mask = np.isinf(sd)
+  d = 1e-3*rng.normal(size=(Nt,Nx))
+  t_grid,x0_grid = np.meshgrid(t,x[:,0],indexing='ij')
+  t_grid,x1_grid = np.meshgrid(t,x[:,1],indexing='ij')
+  z = np.array([t_grid.ravel(),x0_grid.ravel(),x1_grid.ravel()]).T
+  return t,z[~mask.ravel()],d[~mask],sd[~mask],mask
+
+
+def _sigma_and_p(network_model,network_params,
+                 station_model,station_params,
+                 t,z,sd,mask,structure):
+  ''' 
+  Builds the covariance matrix and basis vectors in the same way as
+  *reml*
+  '''
+  diff = np.array([0,0,0])
+  net_gp = composite(network_model,network_params,gpnetwork.CONSTRUCTORS)
+  sta_gp = composite(station_model,station_params,gpstation.CONSTRUCTORS)
+  sta_sigma,sta_p = station_sigma_and_p(sta_gp,t,mask,structure)
+  sigma = _as_sparse_or_array(sta_sigma + _as_covariance(sd))
+  sigma = _as_sparse_or_array(sigma + net_gp._covariance(z,z,diff,diff))
+  net_p = net_gp._basis(z,diff)
+  p = sp.hstack((sta_p,sp.csc_matrix(net_p))).tocsc()
+  return sigma,p
+
+
+def _dsigma(network_model,network_params,
+            station_model,station_params,
+            t,z,mask,structure):
+  ''' 
+  Returns the derivatives of the covariance matrix with respect to
+  each log hyperparameter in the same way as *reml*
+  '''
+  diff = np.array([0,0,0])
+  net_gp = composite(network_model,network_params,gpnetwork.CONSTRUCTORS)
+  sta_gp = composite(station_model,station_params,gpstation.CONSTRUCTORS)
+  net_der = composite_derivatives(network_model,gpnetwork.CONSTRUCTORS)
+  sta_der = composite_derivatives(station_model,gpstation.CONSTRUCTORS)
+  out = []
+  i = 0
+  for j,m in enumerate(network_model):
+    for k in range(gpnetwork.CONSTRUCTORS[m].nargs):
+      dgp = log_derivative(net_gp._components[j],net_der[i])
+      out += [dgp._covariance(z,z,diff,diff)]
+      i += 1
+
+  i = 0
+  for j,m in enumerate(station_model):
+    for k in range(gpstation.CONSTRUCTORS[m].nargs):
+      dgp = log_derivative(sta_gp._components[j],sta_der[i])
+      out += [station_sigma(dgp,t,mask,structure)]
+      i += 1
+
+  return out
+
+
+class TestGradient(unittest.TestCase):
+  def _check(self,network_model,network_params,
+             station_model,station_params):
+    t,z,d,sd,mask = _problem()
+    structure = StationStructure(t,mask)
+    factorization = FactorizationContext()
+    n = len(network_params)
+    params = np.hstack((network_params,station_params)).astype(float)
+
+    def build(p):
+      return _sigma_and_p(network_model,p[:n],station_model,p[n:],
+                          t,z,sd,mask,structure)
+
+    sigma,p = build(params)
+    dsigma = _dsigma(network_model,params[:n],station_model,params[n:],
+                     t,z,mask,structure)
+    self.assertEqual(len(dsigma),len(params))
+    out,grad = _likelihood_and_gradient(d,sigma,p,dsigma,factorization)
+    self.assertTrue(np.isclose(out,_likelihood(d,sigma,p,factorization)))
+    for i in range(len(params)):
+      # central differences of the covariance matrix and the
+      # likelihood with respect to the log hyperparameter
+      pos,neg = np.copy(params),np.copy(params)
+      pos[i] *= np.exp(STEP)
+      neg[i] *= np.exp(-STEP)
+      sigma_pos,p_pos = build(pos)
+      sigma_neg,p_neg = build(neg)
+      dC = (_as_dense(sigma_pos) - _as_dense(sigma_neg))/(2*STEP)
+      self.assertTrue(np.allclose(_as_dense(dsigma[i]),dC,
+                                  rtol=1e-4,atol=1e-8*np.max(np.abs(dC))))
+      dL = (_likelihood(d,sigma_pos,p_pos,factorization) -
+            _likelihood(d,sigma_neg,p_neg,factorization))/(2*STEP)
+      self.assertTrue(np.isclose(grad[i],dL,rtol=1e-4,atol=1e-6))
+
+  def test_network_se_se(self):
+    self._check(['se-se'],[1.0,0.02,5.0],['linear'],[])
+
+  def test_network_fogm_se(self):
+    self._check(['fogm-se'],[1.0,30.0,5.0],['const'],[])
+
+  def test_station_fogm(self):
+    self._check([],[],['linear','fogm'],[1.0,20.0])
+
+  def test_station_sparse(self):
+    # compactly supported station covariance, which is factored with
+    # the sparse solver
+    self._check([],[],['const','spwen12'],[1.0,0.05])
+
+
+if __name__ == '__main__':
+  unittest.main()
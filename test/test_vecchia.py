@@ -0,0 +1,67 @@
+''' 
+Tests Vecchia's approximation of the restricted log likelihood
+'''
+import numpy as np
+import scipy.sparse as sp
+import unittest
+from pygeons.main.vecchia import (nearest_previous,
+                                  VecchiaApproximation)
+from pygeons.main.factor import FactorizationContext
+from pygeons.main.reml import _likelihood
+
+
+def _problem(N=40,seed=1):
+  ''' 
+  Returns observation points, data, a dense covariance matrix, and
+  basis vectors
+  '''
+  rng = np.random.RandomState(seed)
+  z = rng.uniform(0.0,1.0,(N,3))
+  dist = np.sqrt(np.sum((z[:,None,:] - z[None,:,:])**2,axis=2))
+  sigma = np.exp(-(dist/0.3)**2) + 0.01*np.eye(N)
+  d = rng.normal(size=N)
+  p = np.array([np.ones(N),z[:,0]]).T
+  return z,d,sigma,p
+
+
+class TestVecchia(unittest.TestCase):
+  def test_nearest_previous(self):
+    z,_,_,_ = _problem()
+    nbr = nearest_previous(z,5)
+    for i in range(z.shape[0]):
+      found = nbr[i][nbr[i] >= 0]
+      self.assertEqual(len(found),min(i,5))
+      self.assertTrue(np.all(found < i))
+      # the neighbors are the closest previous points
+      dist = np.sqrt(np.sum((z[:i] - z[i])**2,axis=1))
+      self.assertTrue(np.allclose(np.sort(dist)[:len(found)],
+                                  dist[found]))
+
+  def test_exact(self):
+    # the approximation is exact when each point is conditioned on all
+    # the previous points
+    z,d,sigma,p = _problem()
+    N = z.shape[0]
+    covariance = lambda idx: sigma[np.ix_(idx,idx)]
+    exact = _likelihood(d,sigma,p,FactorizationContext())
+    for m in [N - 1,N]:
+      # small chunks so that the points are split between chunks
+      approx = VecchiaApproximation(z,np.ones(3),m,chunk_size=7)
+      self.assertTrue(np.isclose(approx.log_likelihood(d,p,covariance),
+                                 exact))
+      self.assertTrue(np.isclose(
+        approx.log_likelihood(d,sp.csc_matrix(p),covariance),exact))
+
+  def test_no_basis(self):
+    z,d,sigma,_ = _problem()
+    N = z.shape[0]
+    p = np.zeros((N,0))
+    covariance = lambda idx: sigma[np.ix_(idx,idx)]
+    exact = _likelihood(d,sigma,p,FactorizationContext())
+    approx = VecchiaApproximation(z,np.ones(3),N - 1)
+    self.assertTrue(np.isclose(approx.log_likelihood(d,p,covariance),
+                               exact))
+
+
+if __name__ == '__main__':
+  unittest.main()